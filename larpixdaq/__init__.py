@@ -52,6 +52,15 @@ suggested order is the order of data flow::
     python -m larpixdaq.offline_storage
     python -m larpixdaq.online_monitor
 
+For a bench test with a single board, the Core, producer, aggregator,
+offline storage and online monitor can instead all be run in one
+process, with the data passed between them in memory (see
+:py:mod:`larpixdaq.embedded`)::
+
+    python -m larpixdaq.embedded --io-config FakeIO
+
+The Operator is used in the same way in either case.
+
 Interacting with the DAQ
 ------------------------
 
@@ -7,6 +7,7 @@ from larpix.larpix import Controller, Packet
 
 from larpixdaq.packetformat import fromBytes
 from larpixdaq.core import CORE_PORT
+from larpixdaq.telemetry import acknowledge_state
 
 class LArPixAggregator(object):
     """The data aggregator for LArPix.
@@ -58,8 +59,9 @@ class LArPixAggregator(object):
                             (message[1], message[2]))
                     self.aggregator.rebroadcast_info(message[1], message[2])
             if self.state != self.aggregator.state:
-                self.aggregator.log('DEBUG', 'State update. New state: %s' % aggregator.state)
+                self.aggregator.log('DEBUG', 'State update. New state: %s' % self.aggregator.state)
                 self.state = self.aggregator.state
+                acknowledge_state(self.aggregator)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launch the data '
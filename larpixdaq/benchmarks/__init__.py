@@ -0,0 +1,192 @@
+'''
+Benchmarks for the LArPix DAQ system.
+
+Each benchmark is a script which launches its own local DAQ system (see
+:py:class:`LocalDAQ`), drives it through the Operator API and reports
+summary statistics, e.g.::
+
+    python -m larpixdaq.benchmarks.operator_latency
+
+Benchmarks use the same ports as a normal DAQ system, so they must not
+be run while another DAQ system is running on the same machine (unless
+``--no-launch`` is given, in which case the running system is used).
+'''
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+#: The default base address for the local DAQ system
+DEFAULT_ADDRESS = 'tcp://127.0.0.1'
+#: The default DAQ Log port
+DEFAULT_LOG_PORT = 56789
+
+def launch(module, *args, **kwargs):
+    '''
+    Launch ``python -m <module> <args>`` in a new process.
+
+    :param module: the module to run, e.g. ``'larpixdaq.core'``
+    :param args: the command-line arguments
+    :param log_file: a file name to write the process's output to
+        (optional, default: discard the output)
+    :returns: the ``subprocess.Popen`` object
+    '''
+    log_file = kwargs.pop('log_file', None)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s' % kwargs)
+    if log_file is None:
+        output = open(os.devnull, 'w')
+    else:
+        output = open(log_file, 'w')
+    try:
+        return subprocess.Popen([sys.executable, '-m', module] +
+                [str(arg) for arg in args], stdout=output,
+                stderr=subprocess.STDOUT)
+    finally:
+        output.close()
+
+class LocalDAQ(object):
+    '''
+    A DAQ system running in local processes, for the duration of a
+    ``with`` block.
+
+    The DAQ Log, Core, producer (on ``FakeIO``), aggregator and online
+    monitor are launched in the usual startup order and terminated in
+    reverse order on exit.
+
+    :var processes: the list of ``(module, subprocess.Popen)`` tuples
+    :var pids: a dict of component module name to process ID
+
+    :param address: the base address (optional, default:
+        ``DEFAULT_ADDRESS``)
+    :param log_dir: a directory to write each process's output to
+        (optional, default: discard the output)
+    :param components: the modules to launch after the Core, with their
+        arguments (optional, default: producer, aggregator and online
+        monitor)
+    :param startup_time: the time in seconds to wait after launching
+        each component (optional, default: ``1``)
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, log_dir=None,
+            components=None, startup_time=1):
+        self.address = address
+        self.log_address = '%s:%d' % (address, DEFAULT_LOG_PORT)
+        self.log_dir = log_dir
+        if components is None:
+            components = [
+                    ('larpixdaq.producer', '%s:50001' % address,
+                        '--io-config', 'FakeIO'),
+                    ('larpixdaq.aggregator', '%s:50002' % address),
+                    ('larpixdaq.online_monitor',),
+                    ]
+        self.components = components
+        self.startup_time = startup_time
+        self.processes = []
+        self.pids = {}
+
+    def __enter__(self):
+        try:
+            self._launch('xylem.Log', '-p', self.log_address, '-o',
+                    os.devnull)
+            self._launch('larpixdaq.core', '--address', self.address,
+                    '--log-address', self.log_address)
+            for component in self.components:
+                self._launch(component[0], *(tuple(component[1:]) +
+                    ('--core', self.address, '--log-address',
+                        self.log_address)))
+        except:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _launch(self, module, *args):
+        log_file = None
+        if self.log_dir is not None:
+            log_file = os.path.join(self.log_dir, module + '.log')
+        process = launch(module, *args, log_file=log_file)
+        self.processes.append((module, process))
+        self.pids[module] = process.pid
+        time.sleep(self.startup_time)
+        if process.poll() is not None:
+            raise RuntimeError('%s exited with code %d' % (module,
+                process.returncode))
+
+    def stop(self, timeout=5):
+        '''Terminate all processes, newest first.'''
+        for module, process in reversed(self.processes):
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+        self.processes = []
+
+def cpu_time(pid):
+    '''
+    Return the CPU time (user + system) in seconds used so far by a
+    process, from ``/proc/<pid>/stat`` (Linux only).
+
+    :param pid: the process ID
+    '''
+    with open('/proc/%d/stat' % pid) as f:
+        stat = f.read()
+    # The command name (field 2) may contain spaces; it ends with ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def rss(pid):
+    '''
+    Return the resident set size in bytes of a process, from
+    ``/proc/<pid>/status`` (Linux only).
+
+    :param pid: the process ID
+    '''
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def percentiles(values, qs=(50, 99)):
+    '''
+    Return the given percentiles of the values.
+
+    :param values: a sequence of numbers
+    :param qs: the percentiles to compute (optional, default: ``(50,
+        99)``)
+    :returns: a dict mapping ``'p<q>'`` to the percentile, or to ``None``
+        if there are no values
+    '''
+    if len(values) == 0:
+        return dict(('p%g' % q, None) for q in qs)
+    result = np.percentile(values, qs)
+    return dict(('p%g' % q, float(x)) for q, x in zip(qs, result))
+
+def summarize_latencies(latencies, elapsed):
+    '''
+    Return the summary statistics of a set of request latencies.
+
+    :param latencies: the latencies in seconds of the completed requests
+    :param elapsed: the wall time in seconds taken by all requests
+    :returns: a dict with keys ``'count'``, ``'p50'``, ``'p99'``,
+        ``'max'``, ``'mean'`` (latencies in ms) and ``'throughput'``
+        (completed requests per second)
+    '''
+    latencies_ms = np.asarray(latencies, dtype=float) * 1000
+    summary = {'count': len(latencies_ms)}
+    summary.update(percentiles(latencies_ms))
+    if len(latencies_ms) > 0:
+        summary['max'] = float(latencies_ms.max())
+        summary['mean'] = float(latencies_ms.mean())
+    else:
+        summary['max'] = summary['mean'] = None
+    summary['throughput'] = len(latencies_ms) / elapsed if elapsed else 0
+    return summary
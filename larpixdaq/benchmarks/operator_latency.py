@@ -0,0 +1,179 @@
+'''
+Measure the round-trip latency of Operator requests through the Core.
+
+The benchmark launches a local DAQ system (Core, producer on
+``FakeIO``, aggregator and online monitor), then sends a mix of
+requests with an :py:class:`~larpixdaq.operator.AsyncOperator`, first
+with the system idle (``STOP`` state) and then while data is flowing
+(``RUN`` state). For each condition it reports the p50, p99 and maximum
+latency and the throughput, per request type and overall.
+
+Example::
+
+    python -m larpixdaq.benchmarks.operator_latency -n 500 \\
+        --concurrency 1 4 --mix get_state=2 rate_history get_boards
+
+The available request types are the keys of :py:data:`REQUESTS`.
+'''
+from __future__ import print_function
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from larpixdaq.operator import AsyncOperator
+from larpixdaq.benchmarks import (LocalDAQ, DEFAULT_ADDRESS,
+        summarize_latencies)
+
+#: The request types, mapping name to a function of the AsyncOperator
+#: and the DAQ state of the current condition which returns the
+#: request coroutine
+REQUESTS = {
+        'get_state': lambda o, state: o.get_state(),
+        'get_clients': lambda o, state: o.get_clients(),
+        'state_change': lambda o, state: o.request('STATE', state),
+        'get_boards': lambda o, state: o.get_boards(),
+        'list_routines': lambda o, state: o.list_routines(),
+        'rate_history': lambda o, state: o.rate_history(),
+        'retrieve_pixel_layout': lambda o, state:
+            o.retrieve_pixel_layout(),
+        }
+
+def parse_mix(entries):
+    '''
+    Parse ``name[=weight]`` mix entries into a list of ``(name,
+    weight)`` tuples.
+    '''
+    mix = []
+    for entry in entries:
+        name, _, weight = entry.partition('=')
+        if name not in REQUESTS:
+            raise ValueError('Unknown request type %s (choose from %s)' %
+                    (name, ', '.join(sorted(REQUESTS))))
+        mix.append((name, float(weight) if weight else 1.0))
+    return mix
+
+async def measure(operator, state, mix, nrequests, concurrency, timeout):
+    '''
+    Send ``nrequests`` requests drawn from ``mix`` with at most
+    ``concurrency`` in flight, and return the summary statistics.
+    '''
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    schedule = random.choices(names, weights, k=nrequests)
+    latencies = dict((name, []) for name in names)
+    failures = dict((name, 0) for name in names)
+    semaphore = asyncio.Semaphore(concurrency)
+    async def send(name):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(REQUESTS[name](operator, state),
+                        timeout)
+            except asyncio.TimeoutError:
+                failures[name] += 1
+                return
+            latencies[name].append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*[send(name) for name in schedule])
+    elapsed = time.perf_counter() - start
+    summary = {'overall': summarize_latencies(sum(latencies.values(), []),
+        elapsed)}
+    summary['overall']['timeouts'] = sum(failures.values())
+    for name in names:
+        summary[name] = summarize_latencies(latencies[name], elapsed)
+        summary[name]['timeouts'] = failures[name]
+    return summary
+
+async def run_benchmark(address, conditions, mix, nrequests,
+        concurrencies, timeout, settle_time):
+    '''Run the benchmark for each condition and concurrency and return
+    the results.'''
+    operator = AsyncOperator(address)
+    results = []
+    try:
+        for condition in conditions:
+            state = 'RUN' if condition == 'loaded' else 'STOP'
+            if state == 'RUN':
+                await operator.prepare_physics_run(timeout)
+            await operator.request('STATE', state, timeout)
+            await asyncio.sleep(settle_time)
+            for concurrency in concurrencies:
+                summary = await measure(operator, state, mix, nrequests,
+                        concurrency, timeout)
+                results.append({
+                    'condition': condition,
+                    'concurrency': concurrency,
+                    'results': summary,
+                    })
+        await operator.end_physics_run(timeout)
+    finally:
+        operator.close()
+    return results
+
+def format_results(results):
+    '''Return a plain-text table of the results.'''
+    lines = ['%-8s %4s %-22s %6s %8s %8s %8s %9s %5s' % ('cond', 'conc',
+        'request', 'count', 'p50 ms', 'p99 ms', 'max ms', 'req/s',
+        'tmo')]
+    for result in results:
+        for name, summary in result['results'].items():
+            if summary['count'] == 0:
+                lines.append('%-8s %4d %-22s %6d %8s %8s %8s %9.1f %5d' %
+                        (result['condition'], result['concurrency'], name,
+                            0, '-', '-', '-', 0, summary['timeouts']))
+                continue
+            lines.append('%-8s %4d %-22s %6d %8.2f %8.2f %8.2f %9.1f %5d'
+                    % (result['condition'], result['concurrency'], name,
+                        summary['count'], summary['p50'], summary['p99'],
+                        summary['max'], summary['throughput'],
+                        summary['timeouts']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure Operator '
+            'request latency and throughput through the DAQ Core')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS,
+            help='The base address of the DAQ system (default: %s)' %
+            DEFAULT_ADDRESS)
+    parser.add_argument('--no-launch', action='store_true',
+            help='Use an already-running DAQ system instead of '
+            'launching one')
+    parser.add_argument('-n', '--requests', type=int, default=200,
+            help='Number of requests per condition and concurrency '
+            '(default: 200)')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+            default=[1, 8],
+            help='Numbers of requests in flight (default: 1 8)')
+    parser.add_argument('--mix', nargs='+', default=['get_state',
+        'state_change', 'get_boards', 'rate_history'],
+            help='Request types to send, as name[=weight] (default: '
+            'get_state state_change get_boards rate_history)')
+    parser.add_argument('--conditions', nargs='+', default=['idle',
+        'loaded'], choices=['idle', 'loaded'],
+            help='Conditions to measure (default: idle loaded)')
+    parser.add_argument('--timeout', type=float, default=10,
+            help='Timeout for each request in seconds (default: 10)')
+    parser.add_argument('--settle-time', type=float, default=2,
+            help='Time to wait after each state change in seconds '
+            '(default: 2)')
+    parser.add_argument('--log-dir', default=None,
+            help='Directory to save the output of launched processes')
+    parser.add_argument('-o', '--output', default=None,
+            help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    def run():
+        return asyncio.run(run_benchmark(args.address, args.conditions,
+            mix, args.requests, args.concurrency, args.timeout,
+            args.settle_time))
+    if args.no_launch:
+        results = run()
+    else:
+        with LocalDAQ(args.address, args.log_dir):
+            results = run()
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
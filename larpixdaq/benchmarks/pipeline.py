@@ -0,0 +1,342 @@
+'''
+Measure the throughput ceiling of the DAQ pipeline.
+
+The benchmark launches a local DAQ system (Core, producer on ``FakeIO``,
+aggregator, offline storage and online monitor), starts a run and steps
+the producer's fake data rate (see the producer's ``set_fake_rate``
+action) through the requested rates. At each step it measures, after a
+settling time:
+
+- the packet rate generated by the producer and the rate received at
+  the aggregator output by a subscriber in this process
+- the packets lost between the two (``'drops'``, accurate to within
+  the packets in flight at either end of the measurement)
+- for each of the offline storage and online monitor, the packet rate
+  it received and the packets it lost (``'components'``), from its
+  ``data_stats`` action, together with the data messages it lost from
+  shared memory and, for the monitor, the messages its workers
+  dropped. Packets dropped at a consumer's ZMQ input show up as the
+  difference between the generated and received packets.
+- the end-to-end latency from the producer sending a message to the
+  subscriber receiving it
+- the CPU usage (fraction of one core) and peak RSS of each component,
+  from ``/proc`` (Linux only)
+
+Example::
+
+    python -m larpixdaq.benchmarks.pipeline --rates 1000 5000 20000 \\
+        --duration 10 -o pipeline.json
+
+With ``--shm-ring``, the producer sends the data through shared memory
+(see :py:mod:`larpixdaq.shm_transport`), for comparison with the
+default ZMQ transport.
+
+The JSON report also records the host, Python version and benchmark
+parameters, so that reports from different machines and releases can
+be compared.
+'''
+from __future__ import print_function
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+from xylem import protocol
+
+from larpixdaq.operator import AsyncOperator
+from larpixdaq.benchmarks import (LocalDAQ, DEFAULT_ADDRESS, cpu_time,
+        rss, summarize_latencies)
+import larpixdaq.packetformat as pformat
+from larpixdaq.shm_transport import payload_size
+
+#: The aggregator port used by :py:func:`components`
+AGGREGATOR_PORT = 50002
+#: The consumers whose ``data_stats`` counters are read at each step,
+#: and their component names
+CONSUMERS = {
+        'offline_storage': 'Offline storage',
+        'online_monitor': 'Online monitor',
+        }
+
+def components(address, output_dir, shm_ring=None):
+    '''Return the :py:class:`~larpixdaq.benchmarks.LocalDAQ` components
+    for the benchmark.'''
+    producer = ('larpixdaq.producer', '%s:50001' % address, '--io-config',
+            'FakeIO')
+    if shm_ring is not None:
+        producer += ('--shm-ring', shm_ring)
+    return [
+            producer,
+            ('larpixdaq.aggregator', '%s:%d' % (address,
+                AGGREGATOR_PORT)),
+            ('larpixdaq.offline_storage', '-o', output_dir),
+            ('larpixdaq.online_monitor',),
+            ]
+
+class PipelineTap(object):
+    '''
+    Subscribe to the aggregator output in a background thread and count
+    the data packets and latencies.
+
+    :param address: the aggregator's full address
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.packets = 0
+        self.messages = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='Pipeline tap')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def take(self):
+        '''Return ``(packets, messages, latencies)`` received since the
+        last call, and reset them.'''
+        with self._lock:
+            result = (self.packets, self.messages, self.latencies)
+            self.packets = 0
+            self.messages = 0
+            self.latencies = []
+        return result
+
+    def close(self):
+        '''Stop the subscriber thread.'''
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'DATA')
+        socket.connect(self.address)
+        try:
+            while not self._stop.is_set():
+                if not socket.poll(100):
+                    continue
+                message = socket.recv_multipart()
+                now = time.time()
+                data = protocol.data_parse(message)
+                npackets = ((payload_size(data['header'], data['data'])
+                    - pformat.HEADER_LENGTH) // pformat.PACKET_LENGTH)
+                latency = now - data['header'].get('timestamp', now)
+                with self._lock:
+                    self.packets += npackets
+                    self.messages += 1
+                    self.latencies.append(latency)
+        finally:
+            socket.close(linger=0)
+
+def _process_stats(pids):
+    '''Return a dict of module name to ``(cpu time, rss)``.'''
+    stats = {}
+    for module, pid in pids.items():
+        try:
+            stats[module] = (cpu_time(pid), rss(pid))
+        except (IOError, OSError):
+            stats[module] = (None, None)
+    return stats
+
+async def consumer_stats(operator, timeout):
+    '''Return a dict of consumer to the result of its ``data_stats``
+    action.'''
+    stats = {}
+    for consumer, name in CONSUMERS.items():
+        response = await operator.send_action(name, 'data_stats', [],
+                timeout)
+        stats[consumer] = response['message']['result']
+    return stats
+
+def _consumer_results(before, after, generated, elapsed):
+    '''Return the per-consumer results of a step from the counters
+    before and after it.'''
+    results = {}
+    for consumer in CONSUMERS:
+        delta = dict((key, after[consumer][key] - before[consumer][key])
+                for key in after[consumer])
+        received = delta.pop('received_packets')
+        result = {
+                'received_rate': received / elapsed,
+                'drops': max(0, generated - received),
+                'drop_fraction': (max(0, generated - received) / generated
+                    if generated else 0),
+                }
+        if 'stored_packets' in delta:
+            result['stored_rate'] = delta.pop('stored_packets') / elapsed
+        result.update(delta)
+        results[consumer] = result
+    return results
+
+async def measure_step(operator, tap, pids, rate, duration, settle_time,
+        timeout, sample_interval=0.5):
+    '''
+    Set the producer's fake data rate, wait for ``settle_time``, then
+    measure the pipeline for ``duration`` seconds and return the
+    results.
+    '''
+    await operator.send_action('LArPix board', 'set_fake_rate', [rate],
+            timeout)
+    await asyncio.sleep(settle_time)
+    before = (await operator.send_action('LArPix board', 'set_fake_rate',
+        [rate], timeout))['message']['result']['generated']
+    consumers_before = await consumer_stats(operator, timeout)
+    tap.take()
+    start_stats = _process_stats(pids)
+    peak_rss = dict((module, stat[1]) for module, stat in
+            start_stats.items())
+    start = time.time()
+    while time.time() - start < duration:
+        await asyncio.sleep(min(sample_interval, duration - (time.time() -
+            start)))
+        for module, (_, resident) in _process_stats(pids).items():
+            if resident is not None:
+                peak_rss[module] = max(peak_rss[module] or 0, resident)
+    elapsed = time.time() - start
+    received, messages, latencies = tap.take()
+    end_stats = _process_stats(pids)
+    after = (await operator.send_action('LArPix board', 'set_fake_rate',
+        [rate], timeout))['message']['result']['generated']
+    consumers_after = await consumer_stats(operator, timeout)
+    generated = after - before
+    latency = summarize_latencies(latencies, elapsed)
+    processes = {}
+    for module in pids:
+        cpu_start, _ = start_stats[module]
+        cpu_end, _ = end_stats[module]
+        processes[module] = {
+                'cpu': (None if cpu_start is None or cpu_end is None else
+                    (cpu_end - cpu_start) / elapsed),
+                'peak_rss': peak_rss[module],
+                }
+    return {
+            'target_rate': rate,
+            'duration': elapsed,
+            'generated_rate': generated / elapsed,
+            'received_rate': received / elapsed,
+            'message_rate': messages / elapsed,
+            'drops': max(0, generated - received),
+            'drop_fraction': (max(0, generated - received) / generated if
+                generated else 0),
+            'latency': dict((key, latency[key]) for key in ('p50', 'p99',
+                'max', 'mean')),
+            'processes': processes,
+            'components': _consumer_results(consumers_before,
+                consumers_after, generated, elapsed),
+            }
+
+async def run_benchmark(address, pids, rates, duration, settle_time,
+        timeout):
+    '''Run the benchmark at each rate and return the list of step
+    results.'''
+    operator = AsyncOperator(address)
+    tap = PipelineTap('%s:%d' % (address, AGGREGATOR_PORT))
+    results = []
+    try:
+        await operator.prepare_physics_run(timeout)
+        await operator.begin_physics_run(timeout)
+        for rate in rates:
+            results.append(await measure_step(operator, tap, pids, rate,
+                duration, settle_time, timeout))
+        await operator.end_physics_run(timeout)
+    finally:
+        tap.close()
+        operator.close()
+    return results
+
+def format_results(results):
+    '''Return a plain-text table of the results.'''
+    lines = ['%9s %9s %9s %7s %7s %7s %8s %8s  %s' % ('target',
+        'generated', 'received', 'drop %', 'sto %', 'mon %', 'p50 ms',
+        'p99 ms', 'cpu % / rss MiB')]
+    for step in results:
+        latency = step['latency']
+        cpu = ' '.join('%s %s/%.0f' % (module.split('.')[-1],
+            '-' if p['cpu'] is None else '%.0f' % (100 * p['cpu']),
+            (p['peak_rss'] or 0) / 2**20) for module, p in
+            sorted(step['processes'].items()))
+        components = step['components']
+        lines.append('%9.0f %9.0f %9.0f %7.2f %7.2f %7.2f %8s %8s  %s' % (
+            step['target_rate'], step['generated_rate'],
+            step['received_rate'], 100 * step['drop_fraction'],
+            100 * components['offline_storage']['drop_fraction'],
+            100 * components['online_monitor']['drop_fraction'],
+            '-' if latency['p50'] is None else '%.1f' % latency['p50'],
+            '-' if latency['p99'] is None else '%.1f' % latency['p99'],
+            cpu))
+    return '\n'.join(lines)
+
+def host_info():
+    '''Return a dict describing the host and software, for the
+    report.'''
+    return {
+            'hostname': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': sys.version,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the DAQ '
+            'pipeline throughput, drops, latency and resource usage at '
+            'stepped data rates')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS,
+            help='The base address of the DAQ system (default: %s)' %
+            DEFAULT_ADDRESS)
+    parser.add_argument('--rates', type=float, nargs='+',
+            default=[1000, 2000, 5000, 10000, 20000],
+            help='Fake data rates to step through, in packets per second '
+            '(default: 1000 2000 5000 10000 20000)')
+    parser.add_argument('--duration', type=float, default=10,
+            help='Measurement time at each rate in seconds (default: 10)')
+    parser.add_argument('--settle-time', type=float, default=3,
+            help='Time to wait after each rate change in seconds '
+            '(default: 3)')
+    parser.add_argument('--timeout', type=float, default=10,
+            help='Timeout for each Operator request in seconds '
+            '(default: 10)')
+    parser.add_argument('--log-dir', default=None,
+            help='Directory to save the output of launched processes')
+    parser.add_argument('--output-dir', default=None,
+            help='Directory for the offline storage files (default: a '
+            'temporary directory, deleted afterwards)')
+    parser.add_argument('--shm-ring', default=None,
+            help='Send the data through a shared-memory ring with this '
+            'name instead of over ZMQ')
+    parser.add_argument('-o', '--output', default='pipeline-report.json',
+            help='The JSON report file (default: pipeline-report.json)')
+    args = parser.parse_args()
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix='larpixdaq-benchmark-')
+    try:
+        with LocalDAQ(args.address, args.log_dir,
+                components(args.address, output_dir, args.shm_ring)) as daq:
+            pids = dict((module, pid) for module, pid in daq.pids.items()
+                    if module != 'xylem.Log')
+            results = asyncio.run(run_benchmark(args.address, pids,
+                args.rates, args.duration, args.settle_time,
+                args.timeout))
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    print(format_results(results))
+    report = {
+            'benchmark': 'pipeline',
+            'host': host_info(),
+            'parameters': vars(args),
+            'results': results,
+            }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Report written to %s' % args.output)
@@ -4,7 +4,9 @@ from xylem import Core
 from xylem.EventHandler import EventHandler
 import os
 import argparse
-import requests
+
+from larpixdaq.publisher import WebPublisher
+from larpixdaq.telemetry import CoreTelemetry
 
 CORE_PORT = 50000
 
@@ -22,42 +24,61 @@ class LArPixCore(object):
     Operator module. See the :py:class:`Operator documentation
     <.Operator>` for available commands.
 
+    Component and state changes are announced to the webapp server by
+    a :py:class:`~larpixdaq.publisher.WebPublisher` in the background,
+    so a slow or missing server never delays the Core. Component
+    announcements are sent in order; only the latest state change is
+    sent if several happen while the server is unreachable. The
+    ``NOTIFIER`` controller message returns the notifier's health.
+
+    The Core also records each component's heartbeat intervals and
+    state-change acknowledgement latency (see
+    :py:mod:`larpixdaq.telemetry`), returned by the ``TELEMETRY``
+    controller message.
+
     """
     def __init__(self, address, log_address):
         self.core = Core(address, log_address)
         self._allowed_states = ['READY', 'RUN', 'STOP']
         self.core.state = 'STOP'
         self.core.isStateAllowed = lambda x: x in self._allowed_states
-        server = 'http://localhost:5000/api'
+        self.notifier = WebPublisher(timeout=1)
 
         def announce_new_client(client_name, all_client_names):
-            try:
-                r = requests.post(server + '/component',
-                        json={'new':client_name, 'all':all_client_names})
-            except:
-                pass
+            self.notifier.publish_event('/component', {'new':client_name,
+                'all':all_client_names})
         def announce_lost_client(client_name, all_client_names):
-            try:
-                r = requests.delete(server + '/component',
-                        json={'lost':client_name, 'all':all_client_names})
-            except:
-                pass
+            self.notifier.publish_event('/component', {'lost':client_name,
+                'all':all_client_names}, method='DELETE')
         def announce_state_change(new_state, old_state):
-            try:
-                r = requests.post(server + '/state', json={'new':
-                    new_state, 'old': old_state})
-            except:
-                pass
+            self.notifier.publish('state', '/state', {'new': new_state,
+                'old': old_state})
         announce = EventHandler('new_component', announce_new_client)
         announce_lost = EventHandler('lost_component', announce_lost_client)
         announce_state = EventHandler('state_change', announce_state_change)
         self.core.addHandler(announce)
         self.core.addHandler(announce_lost)
         self.core.addHandler(announce_state)
+        self.core.controller_handlers['NOTIFIER'] = self.notifier_handler
+        self.telemetry = CoreTelemetry(self.core)
+
+    def notifier_handler(self, message):
+        """Respond to a ``NOTIFIER`` controller message with the health
+        of the webapp notifier (see
+        :py:meth:`larpixdaq.publisher.WebPublisher.health`)."""
+        return {
+                'header': 'NOTIFIER',
+                'message': {
+                    'result': self.notifier.health(),
+                }
+        }
 
     def run(self):
         """Enter the event loop for the Core."""
-        self.core.run()
+        try:
+            self.core.run()
+        finally:
+            self.notifier.close(timeout=1)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
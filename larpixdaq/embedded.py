@@ -0,0 +1,361 @@
+'''
+Run a small DAQ system in a single process.
+
+For bench tests with one board, :py:class:`EmbeddedDAQ` runs the Core,
+producer, aggregator, offline storage and online monitor as threads of
+one process, instead of five processes. Each component is the usual
+LArPix DAQ class with the usual xylem connection to the Core, so the
+DAQ state machine and the Operator actions are unchanged, and an
+Operator connects to the embedded Core as usual.
+
+Only the data path is different: data and info messages are passed
+between the components' threads through bounded in-memory queues
+(:py:class:`MemoryLink`) instead of ZMQ PUB/SUB sockets, so they are
+never serialized or copied. Each queue is polled by its component's
+event loop alongside the component's ZMQ sockets. As with a ZMQ PUB
+socket, messages are dropped (and counted) if a queue is full.
+
+Run from the command line with e.g.::
+
+    python -m larpixdaq.embedded --io-config FakeIO -o data/
+
+and then use the Operator as usual.
+'''
+from __future__ import print_function
+import argparse
+import ast
+import os
+import threading
+import time
+from collections import deque
+
+import zmq
+
+from larpixdaq.core import LArPixCore, CORE_PORT
+from larpixdaq.operator import Operator
+
+class MemoryLink(object):
+    '''
+    A bounded in-memory queue of data and info messages for one xylem
+    component.
+
+    The queue is attached to the component's poller through a pipe, so
+    the component's ``receive`` method handles queued messages as if
+    they had arrived on its ZMQ input socket: the component's
+    ``data_message`` and ``info_message`` event handlers are called,
+    and ``receive`` returns the same ``('DATA', metadata, data)`` and
+    ``('INFO', header, message)`` tuples, one message per call. The pipe
+    is kept readable for as long as the queue is not empty, however many
+    messages are queued.
+
+    :var dropped: the number of messages dropped because the queue was
+        full
+
+    :param maxlen: the maximum number of queued messages (optional,
+        default: ``10000``)
+    '''
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._queue = deque()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def put(self, kind, header, payload):
+        '''
+        Queue a message, or drop it if the queue is full.
+
+        :param kind: ``'DATA'`` or ``'INFO'``
+        :param header: the metadata dict of a data message or the header
+            dict of an info message
+        :param payload: the data bytes or the info message
+        '''
+        if len(self._queue) >= self.maxlen:
+            self.dropped += 1
+            return
+        self._queue.append((kind, header, payload))
+        self._wake()
+
+    def attach(self, component):
+        '''
+        Poll this queue in a xylem component's ``receive`` method. Must
+        be called from the thread which runs the component.
+
+        :param component: the xylem ``Aggregator`` or ``Consumer``
+        '''
+        component.poller.register(self._read_fd, zmq.POLLIN)
+        component.handlers[self._read_fd] = lambda: self._handle(
+                component)
+
+    def close(self):
+        '''Close the pipe.'''
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _wake(self):
+        '''Make the pipe readable.'''
+        try:
+            os.write(self._write_fd, b'\x00')
+        except BlockingIOError:
+            # The pipe is full, so it is already readable
+            pass
+
+    def _handle(self, component):
+        '''Handle the next queued message, like a xylem component's
+        ``handle_in_socket`` method.
+
+        The wakeup bytes are only read once the queue is empty, so the
+        pipe stays readable while messages are waiting.'''
+        if self._queue:
+            message = self._queue.popleft()
+        else:
+            message = None
+        if not self._queue:
+            try:
+                while os.read(self._read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            # A message queued while the pipe was drained may have had
+            # its wakeup byte read
+            if self._queue:
+                self._wake()
+        if message is None:
+            return None
+        kind, header, payload = message
+        if kind == 'DATA':
+            for handler in component._event_handlers['data_message']:
+                handler.handle(component.name, header, payload)
+        else:
+            for handler in component._event_handlers['info_message']:
+                handler.handle(component.name, header, payload)
+        return kind, header, payload
+
+def link_producer(producer, links):
+    '''
+    Send a xylem Producer's data and info messages to the given
+    :py:class:`MemoryLink` objects instead of its output socket.
+    '''
+    def produce(data, metadata=None):
+        if metadata is None:
+            metadata = {}
+        metadata.update({'name': producer.name, 'timestamp': time.time()})
+        for link in links:
+            link.put('DATA', metadata, data)
+    def send_info(message):
+        header = {'timestamp': time.time(), 'component': producer.name}
+        for link in links:
+            link.put('INFO', header, message)
+    producer.produce = produce
+    producer.send_info = send_info
+
+def link_aggregator(aggregator, links):
+    '''
+    Send a xylem Aggregator's broadcasts to the given
+    :py:class:`MemoryLink` objects instead of its output socket.
+    '''
+    def broadcast(metadata, data):
+        for link in links:
+            link.put('DATA', metadata, data)
+    def rebroadcast_info(header, message):
+        header = {'timestamp': header['timestamp'], 'component':
+                header['component']}
+        for link in links:
+            link.put('INFO', header, message)
+    def broadcast_info(message):
+        rebroadcast_info({'timestamp': time.time(), 'component':
+            aggregator.name}, message)
+    aggregator.broadcast = broadcast
+    aggregator.rebroadcast_info = rebroadcast_info
+    aggregator.broadcast_info = broadcast_info
+
+class EmbeddedDAQ(object):
+    '''
+    A DAQ system running as threads of the current process.
+
+    The components are started in the usual order, each in its own
+    daemon thread: Core, producer, aggregator, offline storage and
+    online monitor.
+
+    :var components: a dict of component name (``'producer'``,
+        ``'aggregator'``, ``'offline_storage'``, ``'online_monitor'``)
+        to the component object
+    :var links: a dict of component name to the :py:class:`MemoryLink`
+        it reads from
+
+    :param address: the base address of the Core (optional, default:
+        ``'tcp://127.0.0.1'``)
+    :param log_address: the address of the DAQ Log (optional, default:
+        ``'tcp://127.0.0.1:56789'``)
+    :param io_config: the producer's IO configuration (optional,
+        default: ``['FakeIO']``)
+    :param output_dir: the offline storage output directory (optional,
+        default: ``'.'``)
+    :param fake_rate: the producer's fake data rate (optional)
+    :param storage_args: a dict of extra keyword arguments for
+        :py:class:`~larpixdaq.offline_storage.OfflineStorage` (optional)
+    :param monitor_args: a dict of extra keyword arguments for
+        :py:class:`~larpixdaq.online_monitor.OnlineMonitor` (optional)
+    :param queue_size: the maximum number of messages in each
+        component's queue (optional, default: ``10000``)
+    '''
+    def __init__(self, address='tcp://127.0.0.1',
+            log_address='tcp://127.0.0.1:56789', io_config=None,
+            output_dir='.', fake_rate=None, storage_args=None,
+            monitor_args=None, queue_size=10000):
+        self.address = address
+        self.core_address = '%s:%d' % (address, CORE_PORT)
+        self.log_address = log_address
+        self.io_config = io_config or ['FakeIO']
+        self.output_dir = output_dir
+        self.fake_rate = fake_rate
+        self.storage_args = storage_args or {}
+        self.monitor_args = monitor_args or {}
+        self.core = None
+        self.components = {}
+        self.links = {
+                'aggregator': MemoryLink(queue_size),
+                'offline_storage': MemoryLink(queue_size),
+                'online_monitor': MemoryLink(queue_size),
+                }
+        self._threads = []
+
+    def start(self, timeout=30):
+        '''
+        Start the Core and the components, waiting for each to connect
+        to the Core before starting the next.
+
+        :param timeout: the maximum time in seconds to wait for each
+            component (optional, default: ``30``)
+        :raises RuntimeError: if a component fails to start
+        '''
+        # Imported here so that the embedded Core can be used without
+        # the component dependencies (e.g. HDF5)
+        from larpixdaq.producer import LArPixProducer
+        from larpixdaq.aggregator import LArPixAggregator
+        from larpixdaq.offline_storage import OfflineStorage
+        from larpixdaq.online_monitor import OnlineMonitor
+        self.core = LArPixCore(self.core_address, self.log_address)
+        self._start_thread('core', self.core.run)
+        consumers = [self.links['offline_storage'],
+                self.links['online_monitor']]
+        self._start_component('producer', lambda: LArPixProducer(
+            'inproc://producer', self.core_address, self.log_address,
+            self.io_config, self.fake_rate),
+            lambda c: link_producer(c.producer, [self.links['aggregator']]),
+            timeout)
+        self._start_component('aggregator', lambda: LArPixAggregator(
+            'inproc://aggregator', self.core_address, self.log_address),
+            lambda c: (self.links['aggregator'].attach(c.aggregator),
+                link_aggregator(c.aggregator, consumers)), timeout)
+        self._start_component('offline_storage', lambda: OfflineStorage(
+            self.core_address, self.log_address, self.output_dir,
+            **self.storage_args),
+            lambda c: self.links['offline_storage'].attach(c.consumer),
+            timeout)
+        self._start_component('online_monitor', lambda: OnlineMonitor(
+            self.core_address, self.log_address, **self.monitor_args),
+            lambda c: self.links['online_monitor'].attach(c._consumer),
+            timeout)
+
+    def stop(self, timeout=10):
+        '''
+        End any run (so that the offline storage closes its files) and
+        wait for the components to reach the STOP state.
+
+        The component threads are daemon threads, so they end with the
+        process.
+
+        :param timeout: the maximum time in seconds to wait (optional,
+            default: ``10``)
+        '''
+        operator = Operator(self.address)
+        try:
+            for _ in operator.end_physics_run(timeout):
+                pass
+        finally:
+            operator.cleanup()
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(c.state != 'STOP' for c in
+                self.components.values()):
+            time.sleep(0.05)
+
+    def dropped(self):
+        '''Return a dict of component name to the number of messages
+        dropped from its queue.'''
+        return dict((name, link.dropped) for name, link in
+                self.links.items())
+
+    def _start_thread(self, name, target):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _start_component(self, name, create, connect, timeout):
+        '''Create, connect and run a component in its own thread, and
+        wait until it is ready.'''
+        ready = threading.Event()
+        errors = []
+        def run():
+            try:
+                component = create()
+                connect(component)
+            except Exception as e:
+                errors.append(e)
+                ready.set()
+                raise
+            self.components[name] = component
+            ready.set()
+            component.run()
+        self._start_thread(name, run)
+        if not ready.wait(timeout):
+            raise RuntimeError('Timed out starting %s' % name)
+        if errors:
+            raise RuntimeError('Failed to start %s: %s' % (name,
+                errors[0]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the LArPix DAQ '
+            'Core, producer, aggregator, offline storage and online '
+            'monitor in a single process')
+    parser.add_argument('--address', default='tcp://127.0.0.1',
+            help='The base address of the DAQ Core, not including port '
+            'number')
+    parser.add_argument('--log-address', default='tcp://127.0.0.1:56789',
+            help='Address to connect to global log, including port number')
+    parser.add_argument('--io-config', nargs='+', default=['FakeIO'],
+            help='<IO class> [constructor arguments], e.g. "ZMQ_IO '
+            'io/default.json" (default: FakeIO)')
+    parser.add_argument('--fake-rate', type=float, default=None,
+            help='Rate of fake data in packets per second when using '
+            'FakeIO (default: 300 packets per event loop iteration)')
+    parser.add_argument('-o', '--output-dir', default='.',
+            help='Directory to save output files (default: ".")')
+    parser.add_argument('--raw', action='store_true',
+            help='Append raw data messages to a journal instead of '
+            'writing LArPix+HDF5')
+    parser.add_argument('--queue-size', type=int, default=10000,
+            help='Maximum number of messages queued for each component '
+            '(default: 10000)')
+    args = parser.parse_args()
+    io_config = [args.io_config[0]]
+    for arg in args.io_config[1:]:
+        try:
+            parsed_arg = ast.literal_eval(arg)
+        except ValueError:
+            parsed_arg = arg
+        io_config.append(parsed_arg)
+    daq = EmbeddedDAQ(args.address, args.log_address, io_config,
+            args.output_dir, args.fake_rate, {'raw': args.raw},
+            queue_size=args.queue_size)
+    daq.start()
+    print('Embedded DAQ running; press Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daq.stop()
@@ -0,0 +1,217 @@
+'''
+Append-only raw journal of LArPix DAQ data messages.
+
+The raw journal is the cheapest possible write path for offline
+storage: each data message payload (in the
+:py:mod:`larpixdaq.packetformat` format) is appended verbatim to a
+segment file, without decoding. Journals are converted to LArPix+HDF5
+after the run, one process per segment.
+
+Journal layout
+--------------
+
+A journal is a series of segment files named
+``<prefix>-<segment number>.ljr``. Once a segment grows past the
+segment size, a new segment is started. Each segment has a sidecar
+index file ``<segment>.idx`` with one fixed-size record per message:
+
+- byte offset of the message in the segment (8-byte unsigned int)
+- number of packets in the message (4-byte unsigned int)
+- receive time as a Unix timestamp (8-byte float)
+
+All values are little-endian. The length of a message is the difference
+between its offset and the next message's offset (or the segment
+size for the last message).
+
+Converting journals
+-------------------
+
+Journals are converted with::
+
+    python -m larpixdaq.journal -j 4 rawlog_2019_07_15_12_48_04_PDT-*.ljr
+
+which writes one LArPix+HDF5 file per segment, named after the segment
+with a ``.h5`` extension, using 4 processes.
+'''
+from __future__ import print_function
+import argparse
+import os
+import struct
+import time
+from multiprocessing import Pool
+
+from larpix.logger.h5_logger import HDF5Logger
+
+from larpixdaq.packetformat import fromBytes, packet_count
+
+#: The ``struct`` format of each index record
+INDEX_RECORD = struct.Struct('<QId')
+#: The file extension for journal segments
+SEGMENT_EXTENSION = '.ljr'
+#: The file extension for segment indexes (appended to the segment name)
+INDEX_EXTENSION = '.idx'
+
+class JournalWriter(object):
+    '''
+    Append raw data messages to a segmented journal.
+
+    The interface mirrors the parts of ``larpix.logger.Logger`` used by
+    :py:class:`~larpixdaq.offline_storage.OfflineStorage`, except that
+    ``record`` accepts the raw bytes of a data message rather than a
+    list of packets.
+
+    :var filename: the name of the current segment file
+    :var filenames: the names of all segment files written so far
+
+    :param prefix: the segment file name prefix (optional, default:
+        ``'rawlog_<date and time>'``)
+    :param directory: the directory to save the journal in (optional,
+        default: ``''``)
+    :param segment_size: the size in bytes after which to start a new
+        segment (optional, default: 256 MiB)
+    :param buffer_size: the write buffer size in bytes for segment files
+        (optional, default: 1 MiB)
+    '''
+    def __init__(self, prefix=None, directory='', segment_size=2**28,
+            buffer_size=2**20):
+        if not prefix:
+            prefix = 'rawlog_' + time.strftime('%Y_%m_%d_%H_%M_%S_%Z')
+        self.prefix = os.path.join(directory, prefix)
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.filename = None
+        self.filenames = []
+        self._enabled = False
+        self._segment_number = -1
+        self._segment = None
+        self._index = None
+        self._offset = 0
+
+    def is_enabled(self):
+        return self._enabled
+
+    def enable(self):
+        '''Open the first segment and begin accepting data.'''
+        if self._segment is None:
+            self._open_segment()
+        self._enabled = True
+
+    def disable(self):
+        '''Stop accepting data and close the current segment.'''
+        self._enabled = False
+        self._close_segment()
+
+    def flush(self):
+        '''Flush buffered data in the current segment to disk.'''
+        if self._segment is not None:
+            self._segment.flush()
+            self._index.flush()
+
+    def record(self, data, receive_time=None):
+        '''
+        Append the given data message to the journal.
+
+        :param data: the data message payload (bytes)
+        :param receive_time: the Unix timestamp to store with the
+            message (optional, default: now)
+        '''
+        if not self._enabled:
+            return
+        if receive_time is None:
+            receive_time = time.time()
+        if self._offset >= self.segment_size:
+            self._close_segment()
+            self._open_segment()
+        self._segment.write(data)
+        self._index.write(INDEX_RECORD.pack(self._offset,
+            packet_count(data), receive_time))
+        self._offset += len(data)
+
+    def _open_segment(self):
+        self._segment_number += 1
+        self.filename = '%s-%04d%s' % (self.prefix, self._segment_number,
+                SEGMENT_EXTENSION)
+        self.filenames.append(self.filename)
+        self._segment = open(self.filename, 'ab', self.buffer_size)
+        self._index = open(self.filename + INDEX_EXTENSION, 'ab')
+        self._offset = self._segment.tell()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = None
+            self._index = None
+
+def read_index(segment):
+    '''
+    Return the index of the given segment as a list of ``(offset,
+    count, receive_time)`` tuples.
+
+    :param segment: the segment file name
+    '''
+    with open(segment + INDEX_EXTENSION, 'rb') as f:
+        index_bytes = f.read()
+    nrecords = len(index_bytes) // INDEX_RECORD.size
+    return [INDEX_RECORD.unpack_from(index_bytes, i * INDEX_RECORD.size)
+            for i in range(nrecords)]
+
+def read_segment(segment):
+    '''
+    Iterate over the messages stored in the given segment.
+
+    :param segment: the segment file name
+    :returns: a generator of ``(receive_time, data)`` tuples
+    '''
+    index = read_index(segment)
+    with open(segment, 'rb') as f:
+        contents = f.read()
+    ends = [offset for offset, _, _ in index[1:]] + [len(contents)]
+    for (offset, _, receive_time), end in zip(index, ends):
+        yield receive_time, contents[offset:end]
+
+def convert_segment(segment, output=None):
+    '''
+    Convert the given segment to a LArPix+HDF5 file.
+
+    :param segment: the segment file name
+    :param output: the output file name (optional, default: the
+        segment file name with a ``.h5`` extension)
+    :returns: the output file name
+    '''
+    if output is None:
+        output = os.path.splitext(segment)[0] + '.h5'
+    logger = HDF5Logger(filename=output)
+    logger.enable()
+    for _, data in read_segment(segment):
+        logger.record(fromBytes(data))
+    logger.flush()
+    logger.disable()
+    return output
+
+def convert(segments, processes=None):
+    '''
+    Convert the given segments to LArPix+HDF5 in parallel.
+
+    :param segments: the segment file names
+    :param processes: the number of worker processes (optional,
+        default: one per CPU)
+    :returns: the list of output file names
+    '''
+    pool = Pool(processes)
+    try:
+        return pool.map(convert_segment, segments)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert raw journal '
+            'segments to LArPix+HDF5 files')
+    parser.add_argument('segments', nargs='+',
+            help='The journal segment files to convert')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+            help='Number of conversion processes (default: one per CPU)')
+    args = parser.parse_args()
+    for output in convert(args.segments, args.processes):
+        print(output)
@@ -0,0 +1,128 @@
+'''
+Persistent cache of parsed pixel layouts.
+
+Parsing a larpix-geometry YAML layout file is slow for large layouts, so
+the :py:class:`~larpixdaq.online_monitor.OnlineMonitor` loads layouts
+through a :py:class:`LayoutCache`. The parsed layout and any derived
+lookup tables are pickled to a cache directory, keyed by the layout
+version and the SHA-256 hash of the layout file, so a cache entry is
+automatically replaced when the layout file changes. Entries are also
+kept in memory once loaded, so switching back to a previously used
+layout does not touch the disk at all.
+
+Layout files are located the same way as in
+``larpixgeometry.layouts.load``: relative to the current directory
+first, then relative to the larpixgeometry package.
+'''
+import hashlib
+import os
+import pickle
+import tempfile
+
+import yaml
+from larpixgeometry import layouts
+
+#: The default cache directory
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+        'larpixdaq', 'layouts')
+#: The cache format version. Cache entries with a different version are
+#: rebuilt.
+CACHE_VERSION = 1
+
+def layout_path(layout_version):
+    '''
+    Return the path of the layout file for the given layout version.
+
+    :param layout_version: the layout version, e.g. ``'1.0.0'``
+    :raises IOError: if the layout file cannot be found
+    '''
+    filename = 'layout-%s.yaml' % layout_version
+    if os.path.isfile(filename):
+        return filename
+    package_file = os.path.join(os.path.dirname(layouts.__file__),
+            filename)
+    if os.path.isfile(package_file):
+        return package_file
+    raise IOError('File not found: %s' % filename)
+
+class LayoutCache(object):
+    '''
+    Load pixel layouts and derived lookup tables, reusing cached
+    results when the layout file has not changed.
+
+    The ``derive`` function passed to :py:meth:`load` computes the
+    values to cache from the parsed layout. It must be deterministic
+    and should not depend on anything other than the layout, since its
+    results are reused until the layout file changes. Callers must not
+    modify the returned objects, which are shared between calls.
+
+    :param directory: the cache directory, or ``None`` to only cache in
+        memory (optional, default: ``DEFAULT_CACHE_DIR``)
+    '''
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        self._memo = {}
+
+    def load(self, layout_version, derive=None):
+        '''
+        Return the parsed layout and its derived values.
+
+        :param layout_version: the layout version, e.g. ``'1.0.0'``
+        :param derive: a function of the parsed layout returning the
+            values to cache with it (optional, default: no derived
+            values)
+        :returns: a tuple ``(layout, derived)``
+        '''
+        with open(layout_path(layout_version), 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha256(source).hexdigest()
+        key = (layout_version, digest)
+        if key in self._memo:
+            return self._memo[key]
+        entry = self._read(layout_version, digest)
+        if entry is None:
+            layout = yaml.load(source, Loader=yaml.SafeLoader)
+            derived = derive(layout) if derive is not None else None
+            entry = (layout, derived)
+            self._write(layout_version, digest, entry)
+        self._memo[key] = entry
+        return entry
+
+    def clear(self):
+        '''Forget the in-memory entries (the files on disk are kept).'''
+        self._memo.clear()
+
+    def _filename(self, layout_version, digest):
+        return os.path.join(self.directory, 'layout-%s-%s.pickle' %
+                (layout_version, digest))
+
+    def _read(self, layout_version, digest):
+        '''Return the cached entry, or None if there isn't a usable
+        one.'''
+        if self.directory is None:
+            return None
+        try:
+            with open(self._filename(layout_version, digest), 'rb') as f:
+                version, entry = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError,
+                pickle.UnpicklingError):
+            return None
+        if version != CACHE_VERSION:
+            return None
+        return entry
+
+    def _write(self, layout_version, digest, entry):
+        '''Atomically write the entry to the cache, ignoring errors.'''
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temp_name = tempfile.mkstemp(dir=self.directory,
+                    suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump((CACHE_VERSION, entry), f,
+                        pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_name, self._filename(layout_version, digest))
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,602 @@
+'''
+Streaming statistics used by the online monitor.
+
+All statistics are updated in batches from packets decoded with
+``larpixdaq.packetformat.decode`` and are stored in preallocated NumPy
+arrays.
+
+'''
+import numpy as np
+
+import larpixdaq.packetformat as pformat
+from larpixdaq.ringbuffer import RingBuffer
+
+def _add_counts(counts, flat_indices, sign=1):
+    '''Add (or subtract) 1 to ``counts.flat`` at each of the given
+    indices, which may contain duplicates.'''
+    if len(flat_indices) == 0:
+        return
+    indices, n = np.unique(flat_indices, return_counts=True)
+    counts.flat[indices] += sign * n
+
+def pixel_ids(data_packets, chip_codes, pixel_table):
+    '''
+    Return the pixel IDs of the given decoded data packets, skipping
+    packets which are not in the pixel layout.
+
+    :param data_packets: a structured array of decoded data packets
+    :param chip_codes: the sorted array of chip codes in the layout
+    :param pixel_table: the array of pixel IDs indexed by ``(row in
+        chip_codes, channel)``, with -1 for unconnected channels
+    :returns: an array of pixel IDs
+    '''
+    if len(chip_codes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    codes = pformat.chip_code(data_packets['io_group'],
+            data_packets['io_channel'], data_packets['chipid'])
+    rows = np.searchsorted(chip_codes, codes)
+    rows = np.minimum(rows, len(chip_codes) - 1)
+    found = chip_codes[rows] == codes
+    ids = pixel_table[rows[found], data_packets['channel'][found]]
+    return ids[ids >= 0]
+
+class AdcHistograms(object):
+    '''
+    Fixed-bin ADC histograms for every chip and channel.
+
+    Histograms are stored in a 2D array with one row per (chip,
+    channel) and one column per bin. Rows for a chip are allocated the
+    first time it sends data.
+
+    In whole-run mode (``window=None``), the histograms accumulate every
+    data packet until ``reset`` is called. In sliding-window mode, they
+    contain only the most recent ``window`` data packets.
+
+    The decoded ``dataword`` always has its least significant bit
+    cleared (as ``larpix.Packet.dataword``), so the default bins are 2
+    ADC counts wide, to avoid empty odd bins.
+
+    :var counts: the histogram counts, with shape ``(nchips * nchannels,
+        nbins)``. Only the first ``len(chip_codes) * nchannels`` rows are
+        in use.
+    :var underflow: the number of values below the ADC range in each
+        row, with shape ``(nchips * nchannels,)``
+    :var overflow: the number of values at or above the top of the ADC
+        range in each row, with shape ``(nchips * nchannels,)``
+    :var chip_codes: the list of chip codes (see
+        ``larpixdaq.packetformat.chip_code``) in row order
+
+    :param nbins: the number of bins (optional, default: ``128``)
+    :param adc_range: the ``(low, high)`` ADC range covered by the bins.
+        Values outside the range are counted in ``underflow`` and
+        ``overflow``. (optional, default: ``(0, 256)``)
+    :param nchannels: the number of channels per chip (optional,
+        default: ``32``)
+    :param window: the number of data packets in the sliding window, or
+        ``None`` for whole-run histograms (optional, default: ``None``)
+    '''
+    def __init__(self, nbins=128, adc_range=(0, 256), nchannels=32,
+            window=None):
+        self.nbins = nbins
+        self.adc_range = adc_range
+        self.nchannels = nchannels
+        self.window = window
+        self.bin_edges = np.linspace(adc_range[0], adc_range[1], nbins + 1)
+        # Columns: underflow, the nbins bins, overflow
+        self._counts = np.zeros((0, nbins + 2), dtype=np.int64)
+        self.chip_codes = []
+        self._rows = {}
+        if window is None:
+            self._window = None
+        else:
+            self._window = RingBuffer(window, np.int64)
+
+    @property
+    def counts(self):
+        return self._counts[:, 1:-1]
+
+    @property
+    def underflow(self):
+        return self._counts[:, 0]
+
+    @property
+    def overflow(self):
+        return self._counts[:, -1]
+
+    def fill(self, data_packets):
+        '''
+        Add the given decoded data packets to the histograms.
+
+        :param data_packets: a structured array of decoded data packets
+        '''
+        if len(data_packets) == 0:
+            return
+        codes = pformat.chip_code(data_packets['io_group'],
+                data_packets['io_channel'], data_packets['chipid'])
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        for code in unique_codes:
+            if int(code) not in self._rows:
+                self._add_chip(int(code))
+        chip_rows = np.array([self._rows[int(code)] for code in
+            unique_codes], dtype=np.int64)[inverse]
+        low, high = self.adc_range
+        adcs = data_packets['dataword'].astype(np.int64)
+        # Column 0 is the underflow and column nbins + 1 the overflow
+        columns = np.clip((adcs - low) * self.nbins // (high - low), -1,
+                self.nbins) + 1
+        channels = data_packets['channel'].astype(np.int64)
+        valid = channels < self.nchannels
+        flat = ((chip_rows[valid] * self.nchannels + channels[valid])
+                * (self.nbins + 2) + columns[valid])
+        _add_counts(self._counts, flat)
+        if self._window is not None:
+            _add_counts(self._counts, self._window.extend(flat), -1)
+
+    def _add_chip(self, code):
+        '''Allocate histogram rows for a new chip.'''
+        self._rows[code] = len(self.chip_codes)
+        self.chip_codes.append(code)
+        needed = len(self.chip_codes) * self.nchannels
+        if needed > len(self._counts):
+            new_counts = np.zeros((max(needed, 2 * len(self._counts)),
+                self.nbins + 2), dtype=np.int64)
+            new_counts[:len(self._counts)] = self._counts
+            self._counts = new_counts
+
+    def merge(self, chip_codes, counts, underflow=None, overflow=None):
+        '''
+        Add histograms from another ``AdcHistograms`` with the same
+        binning, e.g. a partial result from a monitor worker.
+
+        Only supported in whole-run mode.
+
+        :param chip_codes: the other object's ``chip_codes``
+        :param counts: the other object's in-use ``counts`` rows, with
+            shape ``(len(chip_codes) * nchannels, nbins)``
+        :param underflow: the other object's in-use ``underflow`` rows
+            (optional)
+        :param overflow: the other object's in-use ``overflow`` rows
+            (optional)
+        '''
+        if self._window is not None:
+            raise ValueError('Cannot merge sliding-window histograms')
+        for i, code in enumerate(chip_codes):
+            if code not in self._rows:
+                self._add_chip(code)
+            start = self._rows[code] * self.nchannels
+            rows = slice(start, start + self.nchannels)
+            other = slice(i * self.nchannels, (i + 1) * self.nchannels)
+            self.counts[rows] += counts[other]
+            if underflow is not None:
+                self.underflow[rows] += underflow[other]
+            if overflow is not None:
+                self.overflow[rows] += overflow[other]
+
+    def in_use(self):
+        '''Return the in-use rows of ``counts``.'''
+        return self.counts[:len(self.chip_codes) * self.nchannels]
+
+    def reset(self):
+        '''Clear all histograms.'''
+        self._counts[:] = 0
+        if self._window is not None:
+            self._window.clear()
+
+    def chip(self, chip_key):
+        '''
+        Return the histograms for every channel of the given chip.
+
+        :param chip_key: the chip key, e.g. ``'1-1-3'``
+        :returns: an array with shape ``(nchannels, nbins)``
+        '''
+        return self._chip_columns(chip_key)[:, 1:-1]
+
+    def chip_out_of_range(self, chip_key):
+        '''
+        Return the underflow and overflow counts for every channel of the
+        given chip.
+
+        :param chip_key: the chip key, e.g. ``'1-1-3'``
+        :returns: a tuple ``(underflow, overflow)`` of arrays with shape
+            ``(nchannels,)``
+        '''
+        columns = self._chip_columns(chip_key)
+        return columns[:, 0], columns[:, -1]
+
+    def _chip_columns(self, chip_key):
+        row = self._rows.get(pformat.chip_key_code(chip_key))
+        if row is None:
+            return np.zeros((self.nchannels, self.nbins + 2),
+                    dtype=np.int64)
+        start = row * self.nchannels
+        return self._counts[start:start + self.nchannels]
+
+    def channel(self, chip_key, channel):
+        '''
+        Return the histogram for the given chip and channel.
+
+        :param chip_key: the chip key, e.g. ``'1-1-3'``
+        :param channel: the channel ID
+        :returns: an array with shape ``(nbins,)``
+        '''
+        return self.chip(chip_key)[channel]
+
+    def total(self):
+        '''Return the sum of all histograms, with shape ``(nbins,)``.'''
+        return self.counts.sum(axis=0)
+
+class RateHistory(object):
+    '''
+    Rolling packet counts at several time resolutions.
+
+    Each resolution (level) has a fixed number of circular buckets for
+    the total packet count and for the packet count of each pixel. New
+    counts are added to the current bucket of the finest level. When a
+    bucket closes, its counts are added to the current bucket of the
+    next coarser level, so coarser levels are downsampled incrementally
+    and never rescan finer data. All arrays are allocated up front.
+
+    Each resolution must be a multiple of the previous one.
+
+    :var resolutions: the bucket widths in seconds, finest first
+
+    :param npixels: the number of pixels
+    :param resolutions: the bucket widths in seconds (optional, default:
+        ``(1, 10, 60, 600)``)
+    :param nbuckets: the number of buckets kept at each resolution
+        (optional, default: ``120``)
+    '''
+    def __init__(self, npixels, resolutions=(1, 10, 60, 600),
+            nbuckets=120):
+        for finer, coarser in zip(resolutions[:-1], resolutions[1:]):
+            if coarser % finer != 0:
+                raise ValueError('Resolution %s is not a multiple of %s'
+                        % (coarser, finer))
+        self.npixels = npixels
+        self.resolutions = tuple(resolutions)
+        self.nbuckets = nbuckets
+        nlevels = len(resolutions)
+        self._totals = np.zeros((nlevels, nbuckets), dtype=np.int64)
+        self._pixels = np.zeros((nlevels, nbuckets, npixels),
+                dtype=np.int64)
+        self._current = [None] * nlevels
+        self._first = [None] * nlevels
+
+    def reset(self):
+        '''Clear all buckets.'''
+        self._totals[:] = 0
+        self._pixels[:] = 0
+        self._current = [None] * len(self.resolutions)
+        self._first = [None] * len(self.resolutions)
+
+    def add(self, now, total, pixel_counts=None):
+        '''
+        Add counts to the current bucket.
+
+        :param now: the current Unix time
+        :param total: the number of packets to add to the total count
+        :param pixel_counts: an array of per-pixel counts to add, with
+            shape ``(npixels,)`` (optional)
+        '''
+        self._roll(0, int(now // self.resolutions[0]))
+        slot = self._current[0] % self.nbuckets
+        self._totals[0, slot] += total
+        if pixel_counts is not None:
+            self._pixels[0, slot] += pixel_counts
+
+    def add_pixels(self, now, pixel_counts):
+        '''
+        Add per-pixel counts to the bucket containing the given time,
+        even if it has already closed (e.g. for counts which were
+        computed elsewhere and arrive late). Counts for buckets which
+        are no longer kept are discarded.
+
+        :param now: the Unix time which the counts belong to
+        :param pixel_counts: an array of per-pixel counts to add, with
+            shape ``(npixels,)``
+        '''
+        bucket_id = int(now // self.resolutions[0])
+        if self._current[0] is None or bucket_id > self._current[0]:
+            self._roll(0, bucket_id)
+        for level, resolution in enumerate(self.resolutions):
+            bucket_id = int(now // resolution)
+            current = self._current[level]
+            if current is None or bucket_id <= current - self.nbuckets:
+                return
+            self._pixels[level, bucket_id % self.nbuckets] += pixel_counts
+            if bucket_id == current:
+                # The counts reach the coarser levels when it closes
+                return
+
+    def advance(self, now):
+        '''
+        Close all buckets which end before ``now`` at every level.
+
+        :param now: the current Unix time
+        '''
+        for level, resolution in enumerate(self.resolutions):
+            self._roll(level, int(now // resolution))
+
+    def _roll(self, level, bucket_id):
+        '''Make ``bucket_id`` the current bucket of the given level,
+        closing the previous current bucket.'''
+        current = self._current[level]
+        if current is None:
+            self._current[level] = bucket_id
+            self._first[level] = bucket_id
+            self._clear(level, bucket_id, bucket_id)
+            return
+        if bucket_id <= current:
+            return
+        if level + 1 < len(self.resolutions):
+            parent_id = (current * self.resolutions[level]
+                    // self.resolutions[level + 1])
+            self._roll(level + 1, parent_id)
+            slot = current % self.nbuckets
+            parent_slot = self._current[level + 1] % self.nbuckets
+            self._totals[level + 1, parent_slot] += self._totals[level, slot]
+            self._pixels[level + 1, parent_slot] += self._pixels[level, slot]
+        self._clear(level, max(current + 1, bucket_id - self.nbuckets + 1),
+                bucket_id)
+        self._current[level] = bucket_id
+
+    def _clear(self, level, first_id, last_id):
+        slots = np.arange(first_id, last_id + 1) % self.nbuckets
+        self._totals[level, slots] = 0
+        self._pixels[level, slots] = 0
+
+    def _level(self, resolution):
+        try:
+            return self.resolutions.index(resolution)
+        except ValueError:
+            raise ValueError('Unknown resolution: %s' % resolution)
+
+    def _completed_ids(self, level):
+        current = self._current[level]
+        if current is None:
+            return np.zeros((0,), dtype=np.int64)
+        first = max(self._first[level], current - self.nbuckets + 1)
+        return np.arange(first, current)
+
+    def current_pixels(self):
+        '''Return the per-pixel counts of the current finest bucket.'''
+        if self._current[0] is None:
+            return np.zeros(self.npixels, dtype=np.int64)
+        return self._pixels[0, self._current[0] % self.nbuckets]
+
+    def pixels_at(self, now):
+        '''
+        Return the per-pixel counts of the finest bucket containing the
+        given time (all zeros if it is not kept).
+
+        :param now: a Unix time
+        '''
+        bucket_id = int(now // self.resolutions[0])
+        current = self._current[0]
+        if (current is None or bucket_id > current
+                or bucket_id < max(self._first[0],
+                    current - self.nbuckets + 1)):
+            return np.zeros(self.npixels, dtype=np.int64)
+        return self._pixels[0, bucket_id % self.nbuckets]
+
+    def series(self, resolution):
+        '''
+        Return the completed buckets at the given resolution, oldest
+        first.
+
+        :param resolution: the bucket width in seconds
+        :returns: a tuple ``(start_times, totals)`` of arrays
+        '''
+        level = self._level(resolution)
+        ids = self._completed_ids(level)
+        return (ids * self.resolutions[level],
+                self._totals[level, ids % self.nbuckets])
+
+    def pixel_series(self, resolution, pixel):
+        '''
+        Return the counts of one pixel in the completed buckets at the
+        given resolution, oldest first.
+
+        :param resolution: the bucket width in seconds
+        :param pixel: the pixel ID
+        :returns: an array of counts, aligned with ``series``
+        '''
+        level = self._level(resolution)
+        ids = self._completed_ids(level)
+        return self._pixels[level, ids % self.nbuckets, pixel]
+
+    def pixel_buckets(self, resolution, since=None, until=None):
+        '''
+        Return the per-pixel counts of the completed buckets at the given
+        resolution, oldest first.
+
+        :param resolution: the bucket width in seconds
+        :param since: only return buckets starting after this Unix time
+            (optional)
+        :param until: only return buckets starting before this Unix
+            time (optional)
+        :returns: a tuple ``(start_times, counts)`` where ``counts`` has
+            shape ``(len(start_times), npixels)``
+        '''
+        level = self._level(resolution)
+        ids = self._completed_ids(level)
+        times = ids * self.resolutions[level]
+        if since is not None:
+            ids = ids[times > since]
+            times = times[times > since]
+        if until is not None:
+            ids = ids[times < until]
+            times = times[times < until]
+        return times, self._pixels[level, ids % self.nbuckets]
+
+    def latest_pixels(self, resolution):
+        '''
+        Return the per-pixel counts of the most recently completed
+        bucket at the given resolution (all zeros if there is none).
+
+        :param resolution: the bucket width in seconds
+        '''
+        level = self._level(resolution)
+        ids = self._completed_ids(level)
+        if len(ids) == 0:
+            return np.zeros(self.npixels, dtype=np.int64)
+        return self._pixels[level, ids[-1] % self.nbuckets]
+
+class ChannelHealth(object):
+    '''
+    Detect hot and dead pixels from running per-pixel rate statistics.
+
+    For each pixel, an exponentially-weighted moving average (EWMA) of
+    the rate and of its variance is updated from each new interval of
+    per-pixel counts. After ``min_samples`` intervals, an active pixel
+    is flagged as hot if its mean rate is above ``hot_rate`` and as dead
+    if its mean rate is below ``dead_rate``.
+
+    :var mean: the EWMA rate of each pixel, in Hz
+    :var variance: the EWMA variance of each pixel's rate, in Hz^2
+    :var hot: boolean array of pixels currently flagged as hot
+    :var dead: boolean array of pixels currently flagged as dead
+
+    :param npixels: the number of pixels
+    :param active: boolean array of pixels which are connected and
+        should be checked (optional, default: all pixels)
+    :param hot_rate: the mean rate in Hz above which a pixel is hot
+        (optional, default: ``100``)
+    :param dead_rate: the mean rate in Hz below which a pixel is dead
+        (optional, default: ``0.01``)
+    :param alpha: the EWMA weight of each new interval (optional,
+        default: ``0.05``)
+    :param min_samples: the number of intervals before pixels are
+        flagged (optional, default: ``30``)
+    '''
+    def __init__(self, npixels, active=None, hot_rate=100, dead_rate=0.01,
+            alpha=0.05, min_samples=30):
+        self.npixels = npixels
+        if active is None:
+            active = np.ones(npixels, dtype=bool)
+        self.active = active
+        self.hot_rate = hot_rate
+        self.dead_rate = dead_rate
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.mean = np.zeros(npixels)
+        self.variance = np.zeros(npixels)
+        self.hot = np.zeros(npixels, dtype=bool)
+        self.dead = np.zeros(npixels, dtype=bool)
+        self.nsamples = 0
+
+    def reset(self):
+        '''Clear all statistics and flags.'''
+        self.mean[:] = 0
+        self.variance[:] = 0
+        self.hot[:] = False
+        self.dead[:] = False
+        self.nsamples = 0
+
+    def update(self, pixel_counts, interval=1):
+        '''
+        Update the statistics with one interval of per-pixel counts.
+
+        :param pixel_counts: an array of counts with shape
+            ``(npixels,)``
+        :param interval: the length of the interval in seconds
+            (optional, default: ``1``)
+        :returns: a tuple ``(new_hot, new_dead)`` of arrays of the
+            pixel IDs which were flagged by this update
+        '''
+        rates = pixel_counts / float(interval)
+        if self.nsamples == 0:
+            self.mean[:] = rates
+        else:
+            delta = rates - self.mean
+            self.mean += self.alpha * delta
+            self.variance = (1 - self.alpha) * (self.variance
+                    + self.alpha * delta**2)
+        self.nsamples += 1
+        if self.nsamples < self.min_samples:
+            empty = np.zeros((0,), dtype=np.int64)
+            return empty, empty
+        hot = self.active & (self.mean > self.hot_rate)
+        dead = self.active & (self.mean < self.dead_rate)
+        new_hot = np.flatnonzero(hot & ~self.hot)
+        new_dead = np.flatnonzero(dead & ~self.dead)
+        self.hot = hot
+        self.dead = dead
+        return new_hot, new_dead
+
+class AdaptiveSampler(object):
+    '''
+    Choose which data messages get full (expensive) processing, so that
+    the monitor keeps up with the data stream.
+
+    Messages are selected deterministically so that the selected
+    fraction of messages is ``fraction``. The fraction is adjusted at
+    most once per ``interval`` seconds: it is halved (down to
+    ``min_fraction``) if during the last interval the monitor was
+    overloaded, i.e. the largest message lag exceeded ``target_lag`` or
+    the duty cycle (the fraction of wall time spent processing messages)
+    exceeded ``max_duty``, and it is increased by a quarter (up to 1) if
+    both were below half of their limits.
+
+    :var fraction: the current fraction of messages to process
+
+    :param target_lag: the maximum acceptable delay in seconds between
+        a message being produced and being processed (optional,
+        default: ``1``)
+    :param max_duty: the maximum acceptable duty cycle (optional,
+        default: ``0.8``)
+    :param min_fraction: the smallest fraction of messages to process
+        (optional, default: ``0.01``)
+    :param interval: the minimum time in seconds between adjustments
+        (optional, default: ``1``)
+    '''
+    def __init__(self, target_lag=1, max_duty=0.8, min_fraction=0.01,
+            interval=1):
+        self.target_lag = target_lag
+        self.max_duty = max_duty
+        self.min_fraction = min_fraction
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        '''Process every message again and forget past measurements.'''
+        self.fraction = 1.0
+        self._credit = 0.0
+        self._interval_start = None
+        self._max_lag = 0
+        self._busy = 0
+
+    def sample(self):
+        '''Return whether the next message should be processed.'''
+        self._credit += self.fraction
+        if self._credit >= 1:
+            self._credit -= 1
+            return True
+        return False
+
+    def update(self, now, lag, busy):
+        '''
+        Record the measurements for one message and adjust the fraction
+        if the interval is over.
+
+        :param now: the current Unix time
+        :param lag: the delay in seconds between the message being
+            produced and its processing starting
+        :param busy: the time in seconds spent processing the message
+        '''
+        if self._interval_start is None:
+            self._interval_start = now
+        self._max_lag = max(self._max_lag, lag)
+        self._busy += busy
+        elapsed = now - self._interval_start
+        if elapsed < self.interval:
+            return
+        duty = self._busy / elapsed
+        if self._max_lag > self.target_lag or duty > self.max_duty:
+            self.fraction = max(self.min_fraction, self.fraction / 2)
+        elif (self._max_lag < self.target_lag / 2
+                and duty < self.max_duty / 2):
+            self.fraction = min(1.0, self.fraction * 1.25)
+        self._interval_start = now
+        self._max_lag = 0
+        self._busy = 0
@@ -0,0 +1,297 @@
+'''
+Worker processes which share the online monitor's statistics load.
+
+In sharded mode, the :py:class:`~larpixdaq.online_monitor.OnlineMonitor`
+only does the cheap per-message work itself (exact packet and byte
+counts and the recent packet buffer), and hands each data message to one
+of N worker processes in turn, labelled with the time it was received.
+Each worker decodes its messages and accumulates mergeable partial
+statistics in a :py:class:`MonitorPartial`: per-pixel packet counts for
+each second, and ADC histograms. Once per update tick, the monitor asks
+every worker for its partial statistics (which the worker then clears)
+and adds the pixel counts to the buckets of the seconds they belong to.
+
+Workers never block the monitor: data messages are passed through
+bounded queues, and a message is dropped (and counted) if its worker's
+queue is full. A flush request is skipped for a worker whose queue is
+full; its partial statistics are collected after a later flush instead.
+Control commands (reset, new pixel layout, stop) go through a separate
+unbounded queue per worker, which the worker reads before its data.
+
+The workers are started with the ``spawn`` method, since the monitor
+already runs threads and a ZMQ context, which are not safe to fork.
+'''
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import larpixdaq.packetformat as pformat
+from larpixdaq.monitor_stats import AdcHistograms, pixel_ids
+
+class MonitorPartial(object):
+    '''
+    Mergeable partial statistics for a share of the data messages.
+
+    :var pixel_counts: a dict of Unix time (whole seconds) to the number
+        of data packets from each pixel received in that second
+    :var adc_histograms: the
+        :py:class:`~larpixdaq.monitor_stats.AdcHistograms` of the data
+        packets
+
+    :param npixels: the number of pixels
+    :param chip_codes: the sorted array of chip codes in the pixel
+        layout
+    :param pixel_table: the pixel ID table (see
+        ``OnlineMonitor.create_pixel_table``)
+    :param adc_args: a dict of keyword arguments for
+        :py:class:`~larpixdaq.monitor_stats.AdcHistograms` (optional)
+    '''
+    def __init__(self, npixels, chip_codes, pixel_table, adc_args=None):
+        self.set_layout(npixels, chip_codes, pixel_table)
+        self.adc_histograms = AdcHistograms(**(adc_args or {}))
+
+    def set_layout(self, npixels, chip_codes, pixel_table):
+        '''Use a new pixel layout, clearing the pixel counts.'''
+        self.npixels = npixels
+        self._chip_codes = chip_codes
+        self._pixel_table = pixel_table
+        self.pixel_counts = {}
+
+    def add(self, data, now):
+        '''
+        Add the packets in a data message.
+
+        :param data: the data message payload (bytes)
+        :param now: the Unix time the message was received
+        '''
+        decoded = pformat.decode(pformat.toArray(data))
+        data_packets = decoded[decoded['packet_type'] ==
+                pformat.DATA_PACKET_TYPE]
+        ids = pixel_ids(data_packets, self._chip_codes, self._pixel_table)
+        if len(ids) > 0:
+            second = int(now)
+            counts = self.pixel_counts.get(second)
+            if counts is None:
+                counts = np.zeros(self.npixels, dtype=np.int64)
+                self.pixel_counts[second] = counts
+            counts += np.bincount(ids, minlength=self.npixels)
+        self.adc_histograms.fill(data_packets)
+
+    def take(self):
+        '''
+        Return the statistics accumulated since the last call and clear
+        them.
+
+        :returns: a dict with keys ``'pixel_counts'`` (a list of
+            ``(time, counts)`` pairs, oldest first), ``'adc_chip_codes'``,
+            ``'adc_counts'``, ``'adc_underflow'`` and ``'adc_overflow'``
+            (the arguments to ``AdcHistograms.merge``)
+        '''
+        histograms = self.adc_histograms
+        nrows = len(histograms.chip_codes) * histograms.nchannels
+        result = {
+                'pixel_counts': sorted(self.pixel_counts.items()),
+                'adc_chip_codes': list(histograms.chip_codes),
+                'adc_counts': histograms.in_use().copy(),
+                'adc_underflow': histograms.underflow[:nrows].copy(),
+                'adc_overflow': histograms.overflow[:nrows].copy(),
+                }
+        self.pixel_counts = {}
+        self.adc_histograms.reset()
+        return result
+
+def _control(partial, command, value):
+    '''Apply a control command in a worker process, returning the new
+    generation, or ``None`` to stop.'''
+    if command == 'stop':
+        return None
+    partial.take()
+    if command == 'layout':
+        generation = value[0]
+        partial.set_layout(*value[1:])
+    else:
+        generation = value
+    return generation
+
+def _run_worker(inbox, control, outbox, npixels, chip_codes, pixel_table,
+        adc_args):
+    '''
+    The main loop of a worker process.
+
+    Data messages and flush requests arrive in order on ``inbox``, and
+    control commands on ``control``. Each message carries the generation
+    it was sent in: messages from an older generation are skipped, and a
+    message from a newer one waits for that generation's control
+    command.
+    '''
+    partial = MonitorPartial(npixels, chip_codes, pixel_table, adc_args)
+    generation = 0
+    while True:
+        try:
+            command, value = control.get_nowait()
+        except queue.Empty:
+            try:
+                command, value = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        if command not in ('data', 'flush'):
+            generation = _control(partial, command, value)
+            if generation is None:
+                return
+            continue
+        while generation is not None and value[0] > generation:
+            generation = _control(partial, *control.get())
+        if generation is None:
+            return
+        if value[0] < generation:
+            continue
+        if command == 'data':
+            partial.add(value[2], value[1])
+        else:
+            outbox.put((generation, value[1], partial.take()))
+
+class MonitorWorkers(object):
+    '''
+    A pool of monitor worker processes.
+
+    Data messages are distributed round-robin. Flush results are
+    labelled with the generation in which they were requested, and
+    results from before the last :py:meth:`reset` are discarded.
+
+    :var dropped: the number of data messages dropped because a worker
+        queue was full
+    :var skipped_flushes: the number of flush requests skipped because a
+        worker queue was full
+    :var complete_time: the time of the most recent flush which every
+        worker has answered, so that the statistics of all data messages
+        received before it have been collected, or ``None``
+
+    :param nworkers: the number of worker processes
+    :param npixels: the number of pixels
+    :param chip_codes: the sorted array of chip codes in the pixel
+        layout
+    :param pixel_table: the pixel ID table
+    :param adc_args: a dict of keyword arguments for the workers'
+        :py:class:`~larpixdaq.monitor_stats.AdcHistograms` (optional)
+    :param queue_size: the maximum number of messages waiting for each
+        worker (optional, default: ``1000``)
+    '''
+    def __init__(self, nworkers, npixels, chip_codes, pixel_table,
+            adc_args=None, queue_size=1000):
+        self.dropped = 0
+        self.skipped_flushes = 0
+        self.complete_time = None
+        self._replies = {}
+        self._generation = 0
+        self._next = 0
+        context = multiprocessing.get_context('spawn')
+        self._outbox = context.Queue()
+        self._inboxes = []
+        self._controls = []
+        self._processes = []
+        for i in range(nworkers):
+            inbox = context.Queue(queue_size)
+            control = context.Queue()
+            process = context.Process(target=_run_worker,
+                    args=(inbox, control, self._outbox, npixels,
+                        chip_codes, pixel_table, adc_args),
+                    name='Online monitor worker %d' % i)
+            process.daemon = True
+            process.start()
+            self._inboxes.append(inbox)
+            self._controls.append(control)
+            self._processes.append(process)
+
+    def submit(self, data, now):
+        '''
+        Send a data message to the next worker, or drop it if that
+        worker's queue is full.
+
+        :param data: the data message payload (bytes)
+        :param now: the Unix time the message was received
+        '''
+        inbox = self._inboxes[self._next]
+        self._next = (self._next + 1) % len(self._inboxes)
+        try:
+            inbox.put_nowait(('data', (self._generation, now, data)))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, now):
+        '''
+        Ask every worker to send its partial statistics, without
+        waiting for a worker whose queue is full.
+
+        :param now: the current Unix time, which labels the request
+        '''
+        for inbox in self._inboxes:
+            try:
+                inbox.put_nowait(('flush', (self._generation, now)))
+            except queue.Full:
+                self.skipped_flushes += 1
+
+    def collect(self):
+        '''
+        Return the partial statistics which have arrived so far, without
+        waiting, and update :py:attr:`complete_time`.
+
+        :returns: a list of dicts as returned by
+            :py:meth:`MonitorPartial.take`
+        '''
+        results = []
+        while True:
+            try:
+                generation, now, partial = self._outbox.get_nowait()
+            except queue.Empty:
+                return results
+            if generation != self._generation:
+                continue
+            results.append(partial)
+            replies = self._replies.get(now, 0) + 1
+            if replies < len(self._inboxes):
+                self._replies[now] = replies
+                continue
+            self.complete_time = max(now, self.complete_time or now)
+            self._replies = dict((time, n) for time, n in
+                    self._replies.items() if time > now)
+
+    def set_layout(self, npixels, chip_codes, pixel_table):
+        '''Send a new pixel layout to every worker, clearing their
+        partial statistics.'''
+        self._new_generation()
+        self._send('layout', (self._generation, npixels, chip_codes,
+            pixel_table))
+
+    def reset(self):
+        '''Clear the workers' partial statistics.'''
+        self._new_generation()
+        self._send('reset', self._generation)
+
+    def close(self, timeout=None):
+        '''
+        Stop the worker processes.
+
+        :param timeout: the maximum time in seconds to wait for each
+            worker (optional, default: wait forever)
+        '''
+        self._send('stop', None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def _new_generation(self):
+        self._generation += 1
+        self.complete_time = None
+        self._replies = {}
+
+    def _send(self, command, value):
+        '''Send a control command to every worker. The control queues
+        are unbounded, so this never waits for a busy worker.'''
+        for control in self._controls:
+            control.put((command, value))
@@ -1,11 +1,48 @@
 import argparse
+import json
+import os
+import time
 
 from xylem import Consumer
 from xylem.EventHandler import EventHandler
 from larpix.logger.h5_logger import HDF5Logger
 
-from larpixdaq.packetformat import fromBytes
+from larpixdaq.packetformat import fromBytes, filter_packets, packet_count
+from larpixdaq.journal import JournalWriter
+from larpixdaq.run_index import IndexWriter
 from larpixdaq.core import CORE_PORT
+from larpixdaq.telemetry import acknowledge_state
+from larpixdaq.shm_transport import attach_reader
+
+#: The name of the run manifest file in the output directory
+MANIFEST_NAME = 'run_manifest.jsonl'
+
+def load_run_manifest(output_dir):
+    '''
+    Return the runs recorded in the run manifest in ``output_dir``.
+
+    Each storage writer appends one entry to the manifest when it
+    closes its output file. Entries whose ``[start, end]`` time
+    intervals overlap belong to the same run.
+
+    :param output_dir: the directory containing the manifest
+    :returns: a list of runs, each of which is a list of manifest entries
+        (dicts with keys ``'partition'``, ``'io_groups'``,
+        ``'io_channels'``, ``'format'``, ``'files'``, ``'start'`` and
+        ``'end'``), sorted by start time
+    '''
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry['start'])
+    runs = []
+    run_end = None
+    for entry in entries:
+        if run_end is None or entry['start'] > run_end:
+            runs.append([])
+            run_end = entry['end']
+        runs[-1].append(entry)
+        run_end = max(run_end, entry['end'])
+    return runs
 
 class OfflineStorage(object):
     """Record all received packets in offline storage.
@@ -13,44 +50,147 @@ class OfflineStorage(object):
     The offline storage script stores LArPix data to disk using the
     LArPix+HDF5 file format.
 
+    In raw mode, the received data messages are instead appended
+    verbatim to a segmented journal (see :py:mod:`larpixdaq.journal`),
+    which can be converted to LArPix+HDF5 after the run. This is the
+    cheapest write path and is intended for peak-rate runs.
+
+    LArPix+HDF5 files are written together with a sidecar index (see
+    :py:mod:`larpixdaq.run_index`) for fast chip and time range
+    queries.
+
+    Several offline storage processes can share the data stream by
+    each taking a disjoint partition of IO groups and/or IO channels.
+    Each partition writer drops the other packets at the byte level,
+    before decoding, and writes its own file. When a file is closed,
+    the writer appends an entry to the run manifest (see
+    :py:func:`load_run_manifest`) which ties the partition files
+    together. Timestamp packets are stored by every partition.
+
+    Example invocation of two partition writers::
+
+        python -m larpixdaq.offline_storage --partition a --io-groups 1 2
+        python -m larpixdaq.offline_storage --partition b --io-groups 3 4
+
     :var consumer: the xylem Consumer object used to receive data
+    :var shm: the :py:class:`~larpixdaq.shm_transport.RingReader` used
+        to read data sent through shared memory
     :var state: the DAQ State of the xylem Consumer component
-    :var logger: the LArPix Logger object used to save data to disk. Can
-        be ``None`` if current state is not READY or RUN.
+    :var logger: the LArPix Logger object (or
+        :py:class:`~larpixdaq.journal.JournalWriter` in raw mode) used
+        to save data to disk. Can be ``None`` if current state is not
+        READY or RUN.
+    :var index: the :py:class:`~larpixdaq.run_index.IndexWriter` for the
+        current LArPix+HDF5 file, or ``None``
+    :var received_packets: the number of packets received since the
+        process started
+    :var stored_packets: the number of packets stored since the process
+        started
 
     :param core_address: the full TCP address (including port number) of
         the DAQ core
     :param log_address: the full TCP address (including port number) of
         the DAQ Log
     :param output_dir: the directory to save all output files
+    :param raw: if ``True``, store data in a raw journal rather than in
+        LArPix+HDF5 (optional, default: ``False``)
+    :param segment_size: the journal segment size in bytes, used only in
+        raw mode (optional, default: 256 MiB)
+    :param partition: the name of this writer's partition, added to the
+        component and file names (optional, default or ``None`` means
+        no partitioning)
+    :param io_groups: the IO groups to store (optional, default or
+        ``None`` stores all IO groups)
+    :param io_channels: the IO channels to store (optional, default or
+        ``None`` stores all IO channels)
     """
 
-    def __init__(self, core_address, log_address, output_dir):
+    def __init__(self, core_address, log_address, output_dir, raw=False,
+            segment_size=2**28, partition=None, io_groups=None,
+            io_channels=None):
         consumer_args = {
                 'core_address': core_address,
                 'log_address': log_address,
                 'heartbeat_time_ms': 300,
         }
-        self.consumer = Consumer(name='Offline storage',
+        name = 'Offline storage'
+        if partition is not None:
+            name += ' (%s)' % partition
+        self.consumer = Consumer(name=name,
                 connections=['AGGREGATOR'], **consumer_args)
+        self.shm = attach_reader(self.consumer)
+        self.consumer.register_action('shm_stats', self.shm_stats,
+                self.shm_stats.__doc__)
+        self.consumer.register_action('data_stats', self.data_stats,
+                self.data_stats.__doc__)
         self.state = ''
         self.consumer.addHandler(EventHandler('data_message',
             self.handle_new_data))
         self.logger = None
+        self.index = None
         self.output_dir = output_dir
+        self.raw = raw
+        self.segment_size = segment_size
+        self.partition = partition
+        self.io_groups = io_groups
+        self.io_channels = io_channels
+        self._filter = io_groups is not None or io_channels is not None
+        self._start_time = None
+        self.received_packets = 0
+        self.stored_packets = 0
 
     def handle_new_data(self, origin, header, data):
         """Save new data to disk.
 
         Parameters are defined by the ``xylem.EventHandler`` interface.
         """
+        self.received_packets += packet_count(data)
         if ((self.state == 'RUN' or self.state == 'READY')
                 and self.logger is not None):
-            packets = fromBytes(data)
-            self.logger.record(packets)
+            if self._filter:
+                data = filter_packets(data, self.io_groups,
+                        self.io_channels)
+                if data is None:
+                    return
+            if self.raw:
+                self.logger.record(data)
+                self.stored_packets += packet_count(data)
+            else:
+                packets = fromBytes(data)
+                self.logger.record(packets)
+                self.index.record(data, time.time())
+                self.stored_packets += len(packets)
         else:
             return
 
+    def shm_stats(self):
+        """
+        shm_stats()
+
+        Return the shared-memory transport statistics: a dict with keys
+        ``'lost'`` (the number of data message payloads lost from
+        shared memory, and so not stored) and ``'rings'`` (the names of
+        the attached rings).
+
+        """
+        return self.shm.stats()
+
+    def data_stats(self):
+        """
+        data_stats()
+
+        Return the data counters since the process started: a dict with
+        keys ``'received_packets'``, ``'stored_packets'`` and
+        ``'shm_lost'`` (the number of data messages lost from shared
+        memory before they could be received).
+
+        """
+        return {
+                'received_packets': self.received_packets,
+                'stored_packets': self.stored_packets,
+                'shm_lost': self.shm.lost,
+                }
+
     def run(self):
         """Initiate the event loop of reading and saving data."""
         try:
@@ -59,21 +199,65 @@ class OfflineStorage(object):
                 if self.state != self.consumer.state:
                     old_state = self.state
                     new_state = self.consumer.state
-                    if old_state == 'RUN':
-                        if self.logger is not None:
-                            self.logger.flush()
-                            self.logger.disable()
-                            self.logger = None
+                    if (old_state in ('READY', 'RUN')
+                            and new_state != 'RUN'):
+                        self._close_output()
                     if new_state == 'READY':
-                        self.logger = HDF5Logger(directory=self.output_dir)
-                        self.logger.enable()
-                        self.consumer.log('INFO', 'Storing data in file'
-                                ' %s' % self.logger.filename)
+                        self._open_output()
                     self.state = new_state
+                    acknowledge_state(self.consumer)
         finally:
-            if self.logger is not None:
-                self.logger.flush()
-                self.logger.disable()
+            self._close_output()
+
+    def _open_output(self):
+        """Create the logger (and index) for a new run."""
+        self._start_time = time.time()
+        prefix = None
+        if self.partition is not None:
+            prefix = '%s_%s' % (time.strftime('%Y_%m_%d_%H_%M_%S_%Z'),
+                    self.partition)
+        if self.raw:
+            if prefix is not None:
+                prefix = 'rawlog_' + prefix
+            self.logger = JournalWriter(prefix=prefix,
+                    directory=self.output_dir,
+                    segment_size=self.segment_size)
+        else:
+            if prefix is not None:
+                prefix = 'datalog_%s.h5' % prefix
+            self.logger = HDF5Logger(filename=prefix,
+                    directory=self.output_dir)
+            self.index = IndexWriter(self.logger.filename)
+        self.logger.enable()
+        self.consumer.log('INFO', 'Storing data in file'
+                ' %s' % self.logger.filename)
+
+    def _close_output(self):
+        """Finalize the current logger (and index) and add it to the
+        run manifest."""
+        if self.logger is not None:
+            self.logger.flush()
+            self.logger.disable()
+            if self.raw:
+                files = self.logger.filenames
+            else:
+                files = [self.logger.filename]
+            entry = {
+                    'partition': self.partition,
+                    'io_groups': self.io_groups,
+                    'io_channels': self.io_channels,
+                    'format': 'raw' if self.raw else 'hdf5',
+                    'files': [os.path.basename(f) for f in files],
+                    'start': self._start_time,
+                    'end': time.time(),
+                    }
+            with open(os.path.join(self.output_dir, MANIFEST_NAME),
+                    'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.logger = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launch the data '
@@ -84,9 +268,22 @@ if __name__ == '__main__':
             help='Address to connect to global log, including port number')
     parser.add_argument('-o', '--output-dir', default='.',
             help='Directory to save output files (default: ".")')
+    parser.add_argument('--raw', action='store_true',
+            help='Append raw data messages to a journal instead of '
+            'writing LArPix+HDF5 (convert with python -m larpixdaq.journal)')
+    parser.add_argument('--segment-size', type=int, default=256,
+            help='Raw journal segment size in MiB (default: 256)')
+    parser.add_argument('--partition', default=None,
+            help='Name of this writer\'s partition of the data stream')
+    parser.add_argument('--io-groups', nargs='+', type=int, default=None,
+            help='IO groups to store (default: all)')
+    parser.add_argument('--io-channels', nargs='+', type=int,
+            default=None, help='IO channels to store (default: all)')
     args = parser.parse_args()
     offline_storage = OfflineStorage(args.core + (':%d' % CORE_PORT),
-            args.log_address, args.output_dir)
+            args.log_address, args.output_dir, args.raw,
+            args.segment_size * 2**20, args.partition, args.io_groups,
+            args.io_channels)
     try:
         offline_storage.run()
     except KeyboardInterrupt:
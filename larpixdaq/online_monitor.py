@@ -5,19 +5,28 @@ Record packets from the current run and compute various statistics.
 
 import time
 import logging
-from collections import deque, defaultdict
+from collections import deque
 import json
 import argparse
 
-import requests
+import numpy as np
 from xylem import Consumer, protocol
 from xylem.EventHandler import EventHandler
-from larpix.larpix import Packet
 from larpix.configs import load as load_pcb_config
-from larpixgeometry import layouts
 
 import larpixdaq.packetformat as pformat
+from larpixdaq.ringbuffer import RingBuffer
+from larpixdaq.publisher import WebPublisher
+from larpixdaq.snapshot import SnapshotEncoder
+from larpixdaq.snapshot import CONTENT_TYPE as SNAPSHOT_CONTENT_TYPE
+from larpixdaq.monitor_workers import MonitorWorkers
+from larpixdaq.layout_cache import LayoutCache, DEFAULT_CACHE_DIR
+import larpixdaq.monitor_stats as monitor_stats
+from larpixdaq.monitor_stats import (AdcHistograms, RateHistory,
+        ChannelHealth, AdaptiveSampler)
 from larpixdaq.core import CORE_PORT
+from larpixdaq.telemetry import acknowledge_state
+from larpixdaq.shm_transport import attach_reader
 
 class OnlineMonitor(object):
     """Record packets from the current run and compute various statistics.
@@ -27,13 +36,141 @@ class OnlineMonitor(object):
     It also tracks each pixel's recent and max data rate as well as an
     ADC histogram.
 
+    The most recent packets are kept as raw packet records (see
+    ``larpixdaq.packetformat.toArray``) in a fixed-capacity
+    :py:class:`~larpixdaq.ringbuffer.RingBuffer`, and are only decoded
+    into ``Packet`` objects when requested. The total numbers of
+    packets and bytes received are counted exactly.
+
+    :var packets: the ring buffer of recent raw packet records
+    :var packet_count: the number of packets received since the start
+        of the run
+    :var byte_count: the number of data bytes received since the start
+        of the run
+    :var messages: the most recent info messages, as a deque of
+        ``(sequence number, message)`` tuples
+    :var adc_histograms: the ADC histograms
+    :var rate_history: the total and per-pixel packet rate history
+    :var channel_health: the hot and dead pixel detector
+    :var sampled_packet_count: the number of packets included in the
+        per-pixel and ADC statistics since the start of the run
+    :var layout_cache: the :py:class:`~larpixdaq.layout_cache.LayoutCache`
+        of parsed pixel layouts and lookup tables
+
+    Pixel rates are accumulated per batch of packets using a dense
+    (chip key, channel) to pixel ID table which is built by
+    ``load_pixel_layout``. Parsed layouts and their lookup tables are
+    cached on disk, so loading a layout which has been used before does
+    not require parsing its YAML file.
+
+    Updates are sent to the webapp server by a background
+    :py:class:`~larpixdaq.publisher.WebPublisher`, so the data and info
+    message handlers never wait on the server.
+
+    Info messages are kept in a bounded store and numbered with
+    increasing sequence numbers. Message updates are sent at most
+    ``max_message_rate`` times per second and only contain the messages
+    that the server has not yet acknowledged (i.e. received
+    successfully).
+
+    ADC values are accumulated into fixed-bin histograms for each chip
+    and channel (see :py:class:`~larpixdaq.monitor_stats.AdcHistograms`),
+    either for the whole run or for a sliding window of recent data
+    packets. The histograms are reset when the DAQ enters the READY
+    state and can be retrieved with the ``adc_histogram`` action. The
+    per-second update contains only the sum of all histograms.
+
+    Total and per-pixel packet rates are kept at several resolutions
+    (1 s, 10 s, 1 min and 10 min by default) in preallocated circular
+    buckets (see :py:class:`~larpixdaq.monitor_stats.RateHistory`), and
+    can be retrieved with the ``rate_history`` action.
+
+    With ``workers`` greater than 0, the monitor runs in sharded mode
+    (see :py:mod:`larpixdaq.monitor_workers`): data messages are decoded
+    and histogrammed by that many worker processes, and their partial
+    per-pixel counts and ADC histograms are merged once per update tick.
+    Packet and byte counts, total rates and the recent packet buffer
+    remain exact. Per-pixel counts are credited to the rate bucket of
+    the second in which their messages were received, but the per-pixel
+    rates sent to the webserver and the hot and dead pixel checks use the
+    most recent second which every worker has reported, usually one
+    tick later than in single-process mode. Messages are dropped from
+    the per-pixel and ADC statistics if the workers fall behind.
+    Sliding-window ADC histograms are not supported in sharded mode.
+
+    In sampling mode, the packet and byte counts, total rates and recent
+    packet buffer remain exact, but only a fraction of data messages are
+    decoded for the per-pixel and ADC statistics. The fraction is
+    adapted to the measured processing lag (the time since the producer
+    sent the message) and duty cycle by an
+    :py:class:`~larpixdaq.monitor_stats.AdaptiveSampler`. The per-second
+    update reports the current ``sampling_fraction`` and the
+    ``sampling_factor`` (the ratio of received to processed packets)
+    used to scale the per-pixel rates and ADC histogram to estimates of
+    the full data stream. Sampling mode applies to the in-process
+    statistics and cannot be combined with sharded mode.
+
+    If ``snapshots`` is true, the per-second update is sent as a compact
+    binary snapshot to the server's ``/snapshot`` endpoint instead of as
+    JSON (see :py:mod:`larpixdaq.snapshot`). Snapshots contain the same
+    values, except that the recent packets are sent as raw packet
+    records, and are delta-encoded against the last snapshot the server
+    received.
+
+    Hot and dead pixels are detected from running per-pixel rate
+    statistics (see :py:class:`~larpixdaq.monitor_stats.ChannelHealth`),
+    updated once per completed 1-second bucket. Only pixels in the
+    loaded pixel layout are checked, and only on chips which have sent
+    data during the run or are listed in ``expected_chips`` (so that the
+    unused chips of a layout are not reported as dead). When pixels are
+    newly flagged, one summary warning is sent to the DAQ log and added
+    to the info messages. The current flags, and optionally a suggested
+    channel mask, can be retrieved with the ``channel_health`` action.
+
     :param core_address: the full TCP address (including port number)
         that data will be published to
     :param log_address: the full TCP address (including port number) of
         the DAQ Log
+    :param packet_capacity: the number of recent packets to keep
+        (optional, default: ``100000``)
+    :param message_capacity: the number of recent info messages to keep
+        (optional, default: ``1000``)
+    :param max_message_rate: the maximum number of message updates to
+        send to the server per second (optional, default: ``2``)
+    :param adc_window: the number of recent data packets to include in
+        the ADC histograms, or ``None`` to include the whole run
+        (optional, default: ``None``)
+    :param hot_rate: the mean pixel rate in Hz above which a pixel is
+        flagged as hot (optional, default: ``100``)
+    :param dead_rate: the mean pixel rate in Hz below which a pixel is
+        flagged as dead (optional, default: ``0.01``)
+    :param expected_chips: a list of chip keys (e.g. ``'1-1-3'``) whose
+        pixels are checked even if the chip sends no data (optional)
+    :param workers: the number of worker processes in sharded mode, or
+        0 to compute all statistics in this process (optional, default:
+        ``0``)
+    :param sampling: if ``True``, enable adaptive sampling mode
+        (optional, default: ``False``)
+    :param target_lag: the maximum acceptable processing lag in seconds
+        in sampling mode (optional, default: ``1``)
+    :param snapshots: if ``True``, send per-second updates as binary
+        snapshots (optional, default: ``False``)
+    :param layout_cache_dir: the directory of the pixel layout cache, or
+        ``None`` to only cache layouts in memory (optional, default:
+        ``larpixdaq.layout_cache.DEFAULT_CACHE_DIR``)
     """
 
-    def __init__(self, core_address, log_address):
+    def __init__(self, core_address, log_address, packet_capacity=100000,
+            message_capacity=1000, max_message_rate=2, adc_window=None,
+            hot_rate=100, dead_rate=0.01, workers=0, sampling=False,
+            target_lag=1, snapshots=False,
+            layout_cache_dir=DEFAULT_CACHE_DIR, expected_chips=None):
+        if workers > 0 and sampling:
+            raise ValueError('Sampling mode cannot be combined with '
+                    'sharded mode')
+        if workers > 0 and adc_window is not None:
+            raise ValueError('Sliding-window ADC histograms are not '
+                    'supported in sharded mode')
         consumer_args = {
                 'core_address': core_address,
                 'log_address': log_address,
@@ -52,10 +189,21 @@ class OnlineMonitor(object):
         }
         self._consumer = Consumer(name='Online monitor', connections=['AGGREGATOR'],
                 **consumer_args)
+        self._shm = attach_reader(self._consumer)
         self._consumer.register_action('retrieve_pixel_layout',
                 self.retrieve_pixel_layout, self.retrieve_pixel_layout.__doc__)
         self._consumer.register_action('load_pixel_layout',
                 self.load_pixel_layout, self.load_pixel_layout.__doc__)
+        self._consumer.register_action('adc_histogram',
+                self.adc_histogram, self.adc_histogram.__doc__)
+        self._consumer.register_action('rate_history',
+                self.get_rate_history, self.get_rate_history.__doc__)
+        self._consumer.register_action('channel_health',
+                self.get_channel_health, self.get_channel_health.__doc__)
+        self._consumer.register_action('shm_stats',
+                self.shm_stats, self.shm_stats.__doc__)
+        self._consumer.register_action('data_stats',
+                self.data_stats, self.data_stats.__doc__)
         self._consumer.addHandler(EventHandler('data_message',
             self.handle_new_data))
         self._consumer.addHandler(EventHandler('data_message',
@@ -64,28 +212,54 @@ class OnlineMonitor(object):
             self.handle_new_message))
         self._consumer.addHandler(EventHandler('info_message',
             self.send_message_update))
-        self._use_requests = True
-        self.packets = deque([], 100000)
-        self.timestamps = defaultdict(int)
-        self.pixel_rates=defaultdict(([0]*832).copy)
-        self.max_pixel_rates = [0]*832
-        self.messages = []
-        self.datarates = deque([], 100)
-        self.datarate_timestamps = deque([], 100)
-        self.adcs = deque([], 1000)
+        self._publisher = WebPublisher()
+        self._snapshots = SnapshotEncoder() if snapshots else None
+        self._publisher_dropped = 0
+        self.packets = RingBuffer(packet_capacity, np.uint8,
+                (pformat.PACKET_LENGTH,))
+        self.packet_count = 0
+        self.byte_count = 0
+        self.sampled_packet_count = 0
+        self._tick_counts = (0, 0)
+        self.sampling_factor = 1.0
+        self._sampler = None
+        if sampling:
+            self._sampler = AdaptiveSampler(target_lag)
+        self.npixels = 832
+        self.rate_history = RateHistory(self.npixels)
+        self.max_pixel_rates = self._new_pixel_counts()
+        self.messages = deque([], message_capacity)
+        self._message_seq = 0
+        self._acked_message_seq = 0
+        self._message_interval = 1.0 / max_message_rate
+        self._last_message_push = 0
+        self.adc_histograms = AdcHistograms(window=adc_window)
         self.start_time = 0
         self._sent_index = 0
         self.runno = 0
         self.state = self._consumer.state
         self.layout = {'chips':[], 'pixels':[], 'x': 0, 'y': 0, 'width':
                 1, 'height': 1}
+        self.layout_cache = LayoutCache(layout_cache_dir)
         self.pixel_lookup = {}
+        self.chip_lookup = {}
+        self._chip_codes, self._pixel_table = self.create_pixel_table([])
+        self.hot_rate = hot_rate
+        self.dead_rate = dead_rate
+        self.expected_chips = list(expected_chips or [])
+        self.channel_health = self._new_channel_health()
+        self._health_time = 0
+        self._workers = None
+        self._reported_drops = 0
+        if workers > 0:
+            self._workers = MonitorWorkers(workers, self.npixels,
+                    self._chip_codes, self._pixel_table)
         self.last_second = int(time.time())
         return
 
     def handle_new_message(self, origin, header, message):
         """Store new info messages."""
-        self.messages.append(message)
+        self._add_message(message)
         if (header['component'] == 'LArPix board' and message ==
                 'Beginning run'):
             self._consumer.log('INFO', 'Received start message')
@@ -95,76 +269,268 @@ class OnlineMonitor(object):
             self._consumer.log('INFO', 'Received end message')
             self._end_run()
 
+    def _add_message(self, message):
+        self._message_seq += 1
+        self.messages.append((self._message_seq, message))
+
     def handle_new_data(self, origin, header, data):
         """Store new data packets and save data rate and ADCs."""
-        packets = pformat.fromBytes(data)
-        self.packets.extend(packets)
-        now = int(time.time())
-        self.timestamps[now] += len(packets)
-        pixel_rates_now = self.pixel_rates[now]
-        for packet in packets:
-            if packet.packet_type == Packet.DATA_PACKET:
-                chip_key = str(packet.chip_key)
-                channelid = packet.channel_id
-                pixel_list = self.pixel_lookup.get(chip_key, None)
-                if pixel_list is not None:
-                    pixelid = pixel_list[channelid]
-                    if pixelid is not None:
-                        pixel_rates_now[pixelid] += 1
-                        if (pixel_rates_now[pixelid] >
-                                self.max_pixel_rates[pixelid]):
-                            self.max_pixel_rates[pixelid] = (
-                                    pixel_rates_now[pixelid])
-        self.adcs.extend(p.dataword for p in packets
-                if p.packet_type == Packet.DATA_PACKET)
+        now = time.time()
+        records = pformat.toArray(data)
+        self.packets.extend(records)
+        self.packet_count += len(records)
+        self.byte_count += len(data)
+        if self._workers is not None:
+            self.rate_history.add(now, len(records))
+            self._workers.submit(bytes(data), now)
+            return
+        if self._sampler is not None and not self._sampler.sample():
+            self.rate_history.add(now, len(records))
+            self._update_sampler(header, now)
+            return
+        self.sampled_packet_count += len(records)
+        decoded = pformat.decode(records)
+        data_packets = decoded[decoded['packet_type'] ==
+                pformat.DATA_PACKET_TYPE]
+        pixel_ids = monitor_stats.pixel_ids(data_packets,
+                self._chip_codes, self._pixel_table)
+        if len(pixel_ids) > 0:
+            pixel_counts = np.bincount(pixel_ids, minlength=self.npixels)
+        else:
+            pixel_counts = None
+        self.rate_history.add(now, len(records), pixel_counts)
+        if pixel_counts is not None and self._sampler is None:
+            np.maximum(self.max_pixel_rates,
+                    self.rate_history.current_pixels(),
+                    out=self.max_pixel_rates)
+        self.adc_histograms.fill(data_packets)
+        if self._sampler is not None:
+            self._update_sampler(header, now)
+
+    def _update_sampler(self, header, start):
+        """Report the lag and processing time of a data message to the
+        sampler."""
+        end = time.time()
+        lag = start - header.get('timestamp', start)
+        self._sampler.update(end, lag, end - start)
+
+    def _new_pixel_counts(self):
+        return np.zeros(self.npixels, dtype=np.int64)
+
+    def _merge_worker_results(self, now):
+        """Add the partial statistics received from the workers to
+        the totals, crediting the pixel counts to the seconds they were
+        received in, and request the next ones."""
+        for partial in self._workers.collect():
+            for second, pixel_counts in partial['pixel_counts']:
+                self.rate_history.add_pixels(second, pixel_counts)
+                np.maximum(self.max_pixel_rates,
+                        self.rate_history.pixels_at(second),
+                        out=self.max_pixel_rates)
+            self.adc_histograms.merge(partial['adc_chip_codes'],
+                    partial['adc_counts'], partial['adc_underflow'],
+                    partial['adc_overflow'])
+        self._workers.flush(now)
+        if self._workers.dropped > self._reported_drops:
+            self._consumer.log('WARNING', 'Monitor workers fell behind: '
+                    '%d data messages left out of pixel and ADC '
+                    'statistics' % (self._workers.dropped -
+                        self._reported_drops))
+            self._reported_drops = self._workers.dropped
+
+    def _new_channel_health(self):
+        """Create the channel health detector for the current layout,
+        with only the pixels of the expected chips active."""
+        self._pixel_rows = np.full(self.npixels, -1, dtype=np.int64)
+        rows, channels = np.nonzero(self._pixel_table >= 0)
+        self._pixel_rows[self._pixel_table[rows, channels]] = rows
+        self._reset_present_chips()
+        return ChannelHealth(self.npixels, self._active_pixels(),
+                self.hot_rate, self.dead_rate)
+
+    def _reset_present_chips(self):
+        """Mark only the expected chips of the layout as present."""
+        self._present_chips = np.zeros(len(self._chip_codes), dtype=bool)
+        for chip_key in self.expected_chips:
+            code = pformat.chip_key_code(chip_key)
+            row = np.searchsorted(self._chip_codes, code)
+            if (row < len(self._chip_codes)
+                    and self._chip_codes[row] == code):
+                self._present_chips[row] = True
+
+    def _active_pixels(self):
+        """Return the boolean array of pixels on present chips."""
+        connected = self._pixel_rows >= 0
+        active = np.zeros(self.npixels, dtype=bool)
+        active[connected] = self._present_chips[
+                self._pixel_rows[connected]]
+        return active
+
+    def _update_channel_health(self, until=None):
+        """Update the hot and dead pixel statistics with the 1-second
+        buckets completed since the last update (and starting before
+        ``until``, if given), and report newly flagged pixels."""
+        times, counts = self.rate_history.pixel_buckets(1,
+                self._health_time, until)
+        if self._sampler is not None:
+            counts = counts * self.sampling_factor
+        new_hot = set()
+        new_dead = set()
+        for bucket_time, bucket_counts in zip(times, counts):
+            rows = self._pixel_rows[bucket_counts > 0]
+            rows = rows[rows >= 0]
+            if not self._present_chips[rows].all():
+                self._present_chips[rows] = True
+                self.channel_health.active = self._active_pixels()
+            hot, dead = self.channel_health.update(bucket_counts)
+            new_hot.update(hot.tolist())
+            new_dead.update(dead.tolist())
+            self._health_time = bucket_time
+        # Only report pixels which are still flagged
+        new_hot = sorted(pixel for pixel in new_hot if
+                self.channel_health.hot[pixel])
+        new_dead = sorted(pixel for pixel in new_dead if
+                self.channel_health.dead[pixel])
+        if new_hot or new_dead:
+            self._report_channels(new_hot, new_dead)
+
+    def _report_channels(self, new_hot, new_dead, max_listed=10):
+        """Send one warning summarizing the newly flagged pixels,
+        listing at most ``max_listed`` of them."""
+        entries = []
+        for kind, pixels in (('hot', new_hot), ('dead', new_dead)):
+            for pixel in pixels:
+                location = self.chip_lookup.get(pixel, {})
+                entries.append('%s pixel %d (chip %s, channel %s, %.3g Hz)'
+                        % (kind, pixel, location.get('chip'),
+                            location.get('channel'),
+                            self.channel_health.mean[pixel]))
+        message = 'Newly flagged pixels: %d hot / %d dead: %s' % (
+                len(new_hot), len(new_dead),
+                ', '.join(entries[:max_listed]))
+        if len(entries) > max_listed:
+            message += (' and %d more (see the channel_health action)' %
+                    (len(entries) - max_listed))
+        self._consumer.log('WARNING', message)
+        self._add_message(message)
 
     def maybe_send_update(self, *args):
         """Send an update to the webserver once per second.
 
         :param args: ignored
         """
-        if not self._use_requests:
-            return
         now = int(time.time())
         next_tick = now != self.last_second
         if next_tick:
-            self.datarates.append(self.timestamps[self.last_second])
-            self.datarate_timestamps.append(self.last_second)
-            pixel_rates_last_second = self.pixel_rates[self.last_second][:]
-            del self.timestamps[self.last_second]
-            del self.pixel_rates[self.last_second]
+            if self._workers is not None:
+                self._merge_worker_results(now)
             self.last_second = now
-            try:
-                r = requests.post('http://localhost:5000/api/packets',
-                        json={'rate':self._data_rate(),
-                            'packets':self._packets(-100)[::-1],
-                            'messages':self._messages()[-100:][::-1],
-                            'rate_list':list(self.datarates),
-                            'rate_times':list(self.datarate_timestamps),
-                            'adcs': list(self.adcs),
-                            'rate_bypixel': pixel_rates_last_second,
-                            'maxrate_bypixel': self.max_pixel_rates,
-                            })
-            except requests.ConnectionError as e:
-                self._use_requests = False
-                self._consumer.log('WARNING', 'Failed to send packets '
-                        'to server: %s; turning off web requests' % e)
+            self.rate_history.advance(now)
+            resolution = self.rate_history.resolutions[0]
+            if self._workers is not None:
+                # Only seconds before the last complete flush have
+                # every worker's counts
+                complete = self._workers.complete_time
+                if complete is None:
+                    rate_bypixel = self._new_pixel_counts()
+                else:
+                    rate_bypixel = self.rate_history.pixels_at(
+                            complete - resolution)
+                self._update_channel_health(complete or 0)
+            else:
+                rate_bypixel = self.rate_history.latest_pixels(resolution)
+                if self._sampler is not None:
+                    rate_bypixel = self._scale_sampled(rate_bypixel)
+                self._update_channel_health()
+            rate_times, rate_list = self.rate_history.series(resolution)
+            fields = {
+                'rate':self._data_rate(),
+                'adc_range': list(self.adc_histograms.adc_range),
+                'sampling_fraction': (1.0 if self._sampler is None
+                    else self._sampler.fraction),
+                'sampling_factor': self.sampling_factor,
+                }
+            arrays = {
+                'rate_list': rate_list[-100:],
+                'rate_times': rate_times[-100:],
+                'adc_histogram': (self.adc_histograms.total()
+                    * self._run_sampling_factor()),
+                'rate_bypixel': rate_bypixel.copy(),
+                'maxrate_bypixel': self.max_pixel_rates.copy(),
+                }
+            if self._snapshots is None:
+                update = dict(fields)
+                for name, array in arrays.items():
+                    update[name] = array.tolist()
+                update['packets'] = self._packets(100)[::-1]
+                self._publisher.publish('packets', '/packets', update)
+            else:
+                arrays['packets'] = self.packets.tail(100)[::-1]
+                health = self._publisher.health()
+                if (health['healthy'] is False
+                        or health['dropped'] > self._publisher_dropped):
+                    # The server may have restarted (or rejected a delta
+                    # it has no base for), so send a keyframe
+                    self._snapshots.reset()
+                self._publisher_dropped = health['dropped']
+                seq, snapshot = self._snapshots.encode(fields, arrays)
+                self._publisher.publish('packets', '/snapshot', snapshot,
+                        on_success=lambda: self._snapshots.acknowledge(seq),
+                        content_type=SNAPSHOT_CONTENT_TYPE)
+
+    def _scale_sampled(self, pixel_counts):
+        """Scale the per-pixel counts of the last completed second by
+        the ratio of received to processed packets since the previous
+        tick, and update the max per-pixel rates with the result."""
+        total, sampled = self._tick_counts
+        new_total = self.packet_count - total
+        new_sampled = self.sampled_packet_count - sampled
+        self._tick_counts = (self.packet_count, self.sampled_packet_count)
+        if new_sampled > 0:
+            self.sampling_factor = float(new_total) / new_sampled
+        estimates = pixel_counts * self.sampling_factor
+        np.maximum(self.max_pixel_rates, estimates.astype(np.int64),
+                out=self.max_pixel_rates)
+        return estimates
+
+    def _run_sampling_factor(self):
+        """Return the ratio of received to processed packets since
+        the start of the run."""
+        if self._sampler is None or self.sampled_packet_count == 0:
+            return 1
+        return float(self.packet_count) / self.sampled_packet_count
 
     def send_message_update(self, *args):
-        """Send an update containing info messages.
+        """Send an update containing the info messages which have not
+        been acknowledged by the server, unless an update was sent too
+        recently.
+
+        The update contains the messages (newest first) and the
+        sequence numbers of the oldest and newest messages sent. If
+        unacknowledged messages were dropped from the store, the oldest
+        sequence number will be more than 1 greater than the last one
+        the server received.
 
         :param args: ignored
         """
-        if not self._use_requests:
+        now = time.time()
+        if now - self._last_message_push < self._message_interval:
             return
-        try:
-            r = requests.post('http://localhost:5000/api/packets',
-                    json={'messages':self._messages()[-100:][::-1],}
-                    )
-        except requests.ConnectionError as e:
-            self._use_requests = False
-            self._consumer.log('WARNING', 'Failed to send packets '
-                    'to server: %s; turning off web requests' % e)
+        acked = self._acked_message_seq
+        if self._message_seq == acked:
+            return
+        new_messages = [entry for entry in self.messages if entry[0] >
+                acked]
+        last_seq = new_messages[-1][0]
+        def acknowledge():
+            if last_seq > self._acked_message_seq:
+                self._acked_message_seq = last_seq
+        self._publisher.publish('messages', '/packets', {
+            'messages': [message for _, message in new_messages][::-1],
+            'first_seq': new_messages[0][0],
+            'last_seq': last_seq,
+            }, on_success=acknowledge)
+        self._last_message_push = now
 
     def create_pixel_lookup(self, chip_pixel_list):
         """Create a pixel lookup from a given list of chip-pixel
@@ -183,6 +549,33 @@ class OnlineMonitor(object):
             pixel_lookup[chipid] = pixels
         return pixel_lookup
 
+    def create_pixel_table(self, chip_pixel_list):
+        """Create a dense pixel ID table from a given list of
+        chip-pixel assignments.
+
+        chip_pixel_list has the same form as for
+        ``create_pixel_lookup``, with chip keys as strings.
+
+        The output is a tuple ``(chip_codes, pixel_table)``, where
+        ``chip_codes`` is a sorted array of chip keys encoded as
+        integers, and ``pixel_table[i, channel]`` is the pixel ID
+        connected to ``channel`` on the chip with code
+        ``chip_codes[i]``, or -1 if there is none.
+        """
+        entries = []
+        for (chipid, pixels) in chip_pixel_list:
+            entries.append((pformat.chip_key_code(chipid), pixels))
+        entries.sort(key=lambda entry: entry[0])
+        chip_codes = np.array([code for code, _ in entries],
+                dtype=np.int64)
+        # 7-bit channel ID
+        pixel_table = np.full((len(entries), 128), -1, dtype=np.int64)
+        for row, (_, pixels) in enumerate(entries):
+            for (channelid, pixelid) in enumerate(pixels):
+                if pixelid is not None:
+                    pixel_table[row, channelid] = pixelid
+        return chip_codes, pixel_table
+
     def create_chip_lookup(self, chip_pixel_list):
         """Create a chip+channel lookup based on pixel ID.
 
@@ -211,6 +604,134 @@ class OnlineMonitor(object):
                         }
         return chip_lookup
 
+    def adc_histogram(self, chip_key, channel=None):
+        '''
+        adc_histogram(chip_key, channel=None)
+
+        Return the ADC histograms for every channel of the given chip,
+        or for a single channel if one is specified.
+
+        The result is a dict with keys ``'bin_edges'`` (the list of
+        ``nbins + 1`` bin edges), ``'counts'`` (a list of counts, or
+        a list of lists of counts indexed by channel), ``'underflow'``
+        and ``'overflow'`` (the counts below and above the bins, or
+        lists of them indexed by channel) and ``'sampling_factor'`` (the
+        factor by which to scale the counts to estimate the full data
+        stream in sampling mode, otherwise 1).
+
+        '''
+        counts = self.adc_histograms.chip(chip_key)
+        underflow, overflow = self.adc_histograms.chip_out_of_range(
+                chip_key)
+        if channel is not None:
+            channel = int(channel)
+            counts = counts[channel]
+            underflow = underflow[channel]
+            overflow = overflow[channel]
+        return {
+                'bin_edges': self.adc_histograms.bin_edges.tolist(),
+                'counts': counts.tolist(),
+                'underflow': underflow.tolist(),
+                'overflow': overflow.tolist(),
+                'sampling_factor': self._run_sampling_factor(),
+                }
+
+    def get_rate_history(self, resolution=1, pixel=None):
+        '''
+        rate_history(resolution=1, pixel=None)
+
+        Return the packet counts in the completed time buckets of the
+        given resolution (in seconds), oldest first.
+
+        The result is a dict with keys ``'resolution'``, ``'times'``
+        (bucket start times) and ``'counts'`` (total packet counts). If
+        a pixel ID is given, ``'pixel_counts'`` contains that pixel's
+        counts.
+
+        '''
+        resolution = int(resolution)
+        times, counts = self.rate_history.series(resolution)
+        result = {
+                'resolution': resolution,
+                'times': times.tolist(),
+                'counts': counts.tolist(),
+                }
+        if pixel is not None:
+            result['pixel_counts'] = self.rate_history.pixel_series(
+                    resolution, int(pixel)).tolist()
+        return result
+
+    def get_channel_health(self, suggest_mask=False):
+        '''
+        channel_health(suggest_mask=False)
+
+        Return the pixels currently flagged as hot or dead.
+
+        The result is a dict with keys ``'hot'`` and ``'dead'``, each a
+        list of dicts with keys ``'pixel'``, ``'chip'``, ``'channel'``,
+        ``'rate'`` (the mean rate in Hz) and ``'std'`` (the standard
+        deviation of the rate in Hz). If ``suggest_mask`` is true,
+        ``'mask'`` maps each chip key with a hot channel to the sorted
+        list of hot channels to mask.
+
+        '''
+        health = self.channel_health
+        result = {}
+        for kind, flags in (('hot', health.hot), ('dead', health.dead)):
+            entries = []
+            for pixel in np.flatnonzero(flags):
+                location = self.chip_lookup.get(int(pixel), {})
+                entries.append({
+                    'pixel': int(pixel),
+                    'chip': location.get('chip'),
+                    'channel': location.get('channel'),
+                    'rate': float(health.mean[pixel]),
+                    'std': float(np.sqrt(health.variance[pixel])),
+                    })
+            result[kind] = entries
+        if suggest_mask:
+            mask = {}
+            for entry in result['hot']:
+                if entry['chip'] is not None:
+                    mask.setdefault(entry['chip'], []).append(
+                            entry['channel'])
+            for channels in mask.values():
+                channels.sort()
+            result['mask'] = mask
+        return result
+
+    def shm_stats(self):
+        '''
+        shm_stats()
+
+        Return the shared-memory transport statistics: a dict with keys
+        ``'lost'`` (the number of data message payloads lost from
+        shared memory) and ``'rings'`` (the names of the attached
+        rings).
+
+        '''
+        return self._shm.stats()
+
+    def data_stats(self):
+        '''
+        data_stats()
+
+        Return the data counters: a dict with keys
+        ``'received_packets'`` (since the start of the run),
+        ``'worker_dropped'`` (the number of data messages left out of
+        the per-pixel and ADC statistics because the workers fell
+        behind, 0 if not in sharded mode) and ``'shm_lost'`` (the
+        number of data messages lost from shared memory before they
+        could be received).
+
+        '''
+        return {
+                'received_packets': self.packet_count,
+                'worker_dropped': (0 if self._workers is None else
+                    self._workers.dropped),
+                'shm_lost': self._shm.lost,
+                }
+
     def retrieve_pixel_layout(self):
         '''
         retrieve_pixel_layout()
@@ -235,35 +756,59 @@ class OnlineMonitor(object):
         '''
         pcb_config = load_pcb_config('controller/%s_chip_info.json' % pcb_id)
         layout_version = pcb_config['layout']
-        self.layout = layouts.load('layout-%s.yaml' % layout_version)
-        for entry in self.layout['chips']:
-            entry[0] = '1-1-%d' % entry[0]
-        self.pixel_lookup = self.create_pixel_lookup(self.layout['chips'])
-        self.chip_lookup = self.create_chip_lookup(self.layout['chips'])
+        _, derived = self.layout_cache.load(layout_version,
+                self._derive_layout_lookups)
+        self.layout = derived['layout']
+        self.pixel_lookup = derived['pixel_lookup']
+        self.chip_lookup = derived['chip_lookup']
+        self._chip_codes = derived['chip_codes']
+        self._pixel_table = derived['pixel_table']
+        self.npixels = max(832,
+                int(self._pixel_table.max(initial=-1)) + 1)
+        self.rate_history = RateHistory(self.npixels)
+        self.max_pixel_rates = self._new_pixel_counts()
+        self.channel_health = self._new_channel_health()
+        if self._workers is not None:
+            self._workers.set_layout(self.npixels, self._chip_codes,
+                    self._pixel_table)
         return {
                 'layout': self.layout,
                 'lookup': self.chip_lookup,
                 }
 
+    def _derive_layout_lookups(self, layout):
+        '''
+        Return the monitor's layout (with chip keys) and lookup tables
+        for a parsed larpix-geometry layout, for the layout cache.
+
+        '''
+        layout = dict(layout)
+        layout['chips'] = [['1-1-%d' % chipid, pixels]
+                for chipid, pixels in layout['chips']]
+        chip_codes, pixel_table = self.create_pixel_table(layout['chips'])
+        return {
+                'layout': layout,
+                'pixel_lookup': self.create_pixel_lookup(layout['chips']),
+                'chip_lookup': self.create_chip_lookup(layout['chips']),
+                'chip_codes': chip_codes,
+                'pixel_table': pixel_table,
+                }
+
     def _data_rate(self):
         '''
         Return the average data rate for the packets received so far.
 
         '''
-        npackets = len(self.packets)
         time_elapsed = time.time() - self.start_time
-        return '%.2f' % (npackets/time_elapsed)
+        return '%.2f' % (self.packet_count/time_elapsed)
 
-    def _packets(self, start, end=None, step=None):
+    def _packets(self, n):
         '''
-        Return a list of dict representations of the packets.
-
-        The start, end and step parameters are treated as arguments to
-        the ``slice`` constructor.
+        Return a list of dict representations of the newest ``n``
+        packets, oldest first.
 
         '''
-        selection_slice = slice(start, end, step)
-        selection = list(self.packets).__getitem__(selection_slice)
+        selection = pformat.fromArray(self.packets.tail(n))
         return pformat.toDict(selection)
 
     def _messages(self):
@@ -271,15 +816,26 @@ class OnlineMonitor(object):
         Return the messages.
 
         '''
-        return self.messages
+        return [message for _, message in self.messages]
 
     def _prepare_run(self):
         self.packets.clear()
-        self.datarates.clear()
-        self.datarate_timestamps.clear()
-        self.pixel_rates.clear()
-        self.max_pixel_rates = [0] * 832
-        self.adcs.clear()
+        self.packet_count = 0
+        self.byte_count = 0
+        self.sampled_packet_count = 0
+        self._tick_counts = (0, 0)
+        self.sampling_factor = 1.0
+        if self._sampler is not None:
+            self._sampler.reset()
+        self.rate_history.reset()
+        self.max_pixel_rates = self._new_pixel_counts()
+        self.adc_histograms.reset()
+        self.channel_health.reset()
+        self._reset_present_chips()
+        self.channel_health.active = self._active_pixels()
+        self._health_time = time.time()
+        if self._workers is not None:
+            self._workers.reset()
 
     def _start_run(self):
         self.runno += 1
@@ -289,23 +845,18 @@ class OnlineMonitor(object):
         pass
 
     def run(self):
-        t_last_send = time.time()
-        try:
-            r = requests.post('http://localhost:5000/api/packets', json={'rate':0,
-                'packets':[]})
-        except requests.ConnectionError as e:
-            self._use_requests = False
-            self._consumer.log('WARNING', 'Failed to send packets '
-                    'to server: %s; turning off web requests' % e)
-        last_second = int(time.time())
+        self._publisher.publish('packets', '/packets', {'rate':0,
+            'packets':[]})
         while True:
             messages = self._consumer.receive(1)
+            self.send_message_update()
             if self.state != self._consumer.state:
                 old_state = self.state
                 new_state = self._consumer.state
                 if new_state == 'READY':
                     self._prepare_run()
                 self.state = self._consumer.state
+                acknowledge_state(self._consumer)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Launch the data '
@@ -314,12 +865,50 @@ if __name__ == '__main__':
             help='The address of the DAQ Core, not including port number')
     parser.add_argument('--log-address', default='tcp://127.0.0.1:56789',
             help='Address to connect to global log, including port number')
+    parser.add_argument('--adc-window', type=int, default=None,
+            help='Number of recent data packets in the ADC histograms '
+            '(default: the whole run)')
+    parser.add_argument('--hot-rate', type=float, default=100,
+            help='Mean pixel rate in Hz above which a pixel is hot '
+            '(default: 100)')
+    parser.add_argument('--dead-rate', type=float, default=0.01,
+            help='Mean pixel rate in Hz below which a pixel is dead '
+            '(default: 0.01)')
+    parser.add_argument('--expected-chips', nargs='+', default=[],
+            help='Chip keys (e.g. 1-1-3) whose pixels are checked for '
+            'dead channels even if the chip sends no data')
+    parser.add_argument('--workers', type=int, default=0,
+            help='Number of worker processes to compute pixel and ADC '
+            'statistics (default: 0, i.e. compute them in this process)')
+    parser.add_argument('--sampling', action='store_true',
+            help='Sample the data messages used for pixel and ADC '
+            'statistics when the monitor falls behind')
+    parser.add_argument('--target-lag', type=float, default=1,
+            help='Maximum processing lag in seconds in sampling mode '
+            '(default: 1)')
+    parser.add_argument('--snapshots', action='store_true',
+            help='Send per-second updates as binary snapshots')
+    parser.add_argument('--layout-cache', default=DEFAULT_CACHE_DIR,
+            help='Directory of the pixel layout cache (default: %s)'
+            % DEFAULT_CACHE_DIR)
+    parser.add_argument('--no-layout-cache', action='store_true',
+            help='Do not cache pixel layouts on disk')
     args = parser.parse_args()
+    if args.no_layout_cache:
+        args.layout_cache = None
     monitor = OnlineMonitor(args.core + (':%d' % CORE_PORT),
-            args.log_address)
+            args.log_address, adc_window=args.adc_window,
+            hot_rate=args.hot_rate, dead_rate=args.dead_rate,
+            workers=args.workers, sampling=args.sampling,
+            target_lag=args.target_lag, snapshots=args.snapshots,
+            layout_cache_dir=args.layout_cache,
+            expected_chips=args.expected_chips)
     try:
         monitor.run()
     except KeyboardInterrupt:
         pass
     finally:
+        monitor._publisher.close(1)
+        if monitor._workers is not None:
+            monitor._workers.close(1)
         monitor._consumer.cleanup()
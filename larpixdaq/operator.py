@@ -2,16 +2,33 @@
 The operator interface for the LArPix DAQ system.
 
 '''
+import asyncio
+import itertools
+import logging
+from collections import deque
+
 import xylem
+from xylem import protocol
+import zmq
+import zmq.asyncio
 
 from larpixdaq.core import CORE_PORT
 
+def _core_address(address):
+    '''Return the full address of the DAQ Core given an Operator
+    ``address`` parameter.'''
+    if address is None:
+        return 'tcp://127.0.0.1:%d' % CORE_PORT
+    return address + ':%d' % CORE_PORT
+
 end_receive_loop_headers = {
         'ACTIONS',
         'ACTION RESULT',
         'STATE',
         'STATE REQUEST',
         'CLIENTS',
+        'NOTIFIER',
+        'TELEMETRY',
         }
 
 class Operator(object):
@@ -50,7 +67,8 @@ class Operator(object):
         arrives later, it will be confused with future results.
         Operator objects do not maintain useful internal state, so it is
         acceptable (and recommended!) to initialize a new Operator if
-        the current Operator ran into a timeout issue.
+        the current Operator ran into a timeout issue. The
+        :py:class:`AsyncOperator` does not have this problem.
 
     :param address: the TCP address of the DAQ Core. The port will be
         added automatically. (Optional, if omitted or ``None``, will
@@ -58,11 +76,8 @@ class Operator(object):
     """
 
     def __init__(self, address=None):
-        if address is None:
-            address = 'tcp://127.0.0.1:%d' % CORE_PORT
-        else:
-            address += ':%d' % CORE_PORT
-        self._controller = xylem.Controller(address)
+        self._address = address
+        self._controller = xylem.Controller(_core_address(address))
 
     def cleanup(self):
         """Clean up the ZMQ objects used in the Operator.
@@ -130,6 +145,101 @@ class Operator(object):
         for result in self._receive_loop(timeout):
             yield result
 
+    def adc_histogram(self, chip, channel=None, timeout=None):
+        """Fetch the ADC histograms for a chip (or one of its channels)
+        from the online monitor.
+
+        :param chip: the chip key as a string
+        :param channel: the channel ID (optional, default or ``None``
+            returns the histograms for all channels)
+        """
+        self._controller.send_action('Online monitor', 'adc_histogram',
+                [chip, channel])
+        for result in self._receive_loop(timeout):
+            yield result
+
+    def rate_history(self, resolution=1, pixel=None, timeout=None):
+        """Fetch the packet rate history from the online monitor.
+
+        :param resolution: the time bucket width in seconds, one of 1,
+            10, 60 or 600 (optional, default: 1)
+        :param pixel: a pixel ID whose counts should also be returned
+            (optional)
+        """
+        self._controller.send_action('Online monitor', 'rate_history',
+                [resolution, pixel])
+        for result in self._receive_loop(timeout):
+            yield result
+
+    def channel_health(self, suggest_mask=False, timeout=None):
+        """Fetch the hot and dead pixels flagged by the online monitor.
+
+        :param suggest_mask: if ``True``, also return the hot channels
+            to mask on each chip (optional, default: ``False``)
+        """
+        self._controller.send_action('Online monitor', 'channel_health',
+                [suggest_mask])
+        for result in self._receive_loop(timeout):
+            yield result
+
+    def run_batch(self, actions, max_in_flight=64, timeout=None):
+        """Run many actions without waiting for each round trip, and
+        return their outcomes.
+
+        For example, to write and validate many chips' configurations::
+
+            actions = []
+            for chip in chips:
+                actions.append(('LArPix board', 'write_config', [chip]))
+                actions.append(('LArPix board', 'validate_config',
+                    [chip]))
+            for outcome in o.run_batch(actions, timeout=10):
+                if outcome['status'] != 'ok':
+                    print(outcome)
+
+        The actions are sent by an :py:class:`AsyncOperator` with its
+        own connection to the Core, so this method must not be called
+        from a running asyncio event loop (use
+        :py:meth:`AsyncOperator.batch` there instead). See
+        :py:meth:`AsyncOperator.batch` for the parameters and return
+        value.
+        """
+        async def run():
+            async_operator = AsyncOperator(self._address)
+            try:
+                return await async_operator.batch(actions, max_in_flight,
+                        timeout)
+            finally:
+                async_operator.close()
+        return asyncio.run(run())
+
+    def notifier_health(self, timeout=None):
+        """Fetch the health of the DAQ Core's webapp notifier.
+
+        The result includes whether the last notification succeeded,
+        the number of queued notifications and the number sent, failed
+        and dropped. See
+        :py:meth:`larpixdaq.publisher.WebPublisher.health`.
+        """
+        self._controller.send_message('NOTIFIER', '')
+        for result in self._receive_loop(timeout):
+            yield result
+
+    def telemetry(self, timeout=None):
+        """Fetch each component's heartbeat and state-change latency
+        telemetry from the DAQ Core.
+
+        A long state-change latency shows that a component's main loop
+        is overloaded. Heartbeats are sent from a separate thread, so
+        heartbeat intervals that drift above the nominal
+        ``heartbeat_ms``, or missed heartbeats, show that the whole
+        process is starved or hung. See
+        :py:class:`larpixdaq.telemetry.CoreTelemetry` for the format.
+        """
+        self._controller.send_message('TELEMETRY', '')
+        for result in self._receive_loop(timeout):
+            yield result
+
     ### Configurations
 
     def write_configuration(self, chip, timeout=None):
@@ -227,6 +337,19 @@ class Operator(object):
         for result in self._receive_loop(timeout):
             yield result
 
+    def profile_routine(self, name, *args, cprofile=False, timeout=None):
+        '''
+        Run the given routine and return the routine's output together
+        with its profile: wall time, IO wait, Python time, configuration
+        and data packet counts, and (if ``cprofile``) the ``cProfile``
+        statistics of the top functions.
+
+        '''
+        self._controller.send_action('LArPix board',
+                'profile_routine', [name, cprofile] + list(args))
+        for result in self._receive_loop(timeout):
+            yield result
+
 
     ### Physics runs
 
@@ -261,3 +384,310 @@ class Operator(object):
         for result in self._receive_loop(timeout):
             yield result
 
+
+class AsyncOperator(object):
+    """An asyncio interface to the DAQ Core with the same operations as
+    the :py:class:`Operator`.
+
+    Each method is a coroutine which sends one request and returns the
+    final response (the same dict that is the last value yielded by
+    the corresponding ``Operator`` method). Any number of requests can
+    be in flight at once, e.g. to query the online monitor while a
+    routine runs on the board::
+
+        async def main():
+            o = AsyncOperator()
+            try:
+                routine = asyncio.ensure_future(o.run_routine('example'))
+                rates = await o.rate_history(10, timeout=1)
+                print(rates['message']['result'])
+                print(await routine)
+            finally:
+                o.close()
+
+        asyncio.run(main())
+
+    Every request is tagged with a client-side correlation ID, returned
+    under the ``'request_id'`` key of the response. The Core answers
+    each request immediately and in order (for actions, with an ``ACTION
+    TICKET`` carrying the Core's action ID); action results arriving
+    later are routed to the right request by their action ID.
+
+    If ``timeout`` is given, a method raises ``asyncio.TimeoutError``
+    after that many seconds. Responses to requests which timed out are
+    discarded when they arrive, so they are never confused with the
+    results of other requests.
+
+    All methods must be called from the same event loop.
+
+    :param address: the TCP address of the DAQ Core. The port will be
+        added automatically. (Optional, if omitted or ``None``, will
+        default to ``tcp://127.0.0.1``.)
+    """
+
+    def __init__(self, address=None):
+        self._context = zmq.asyncio.Context()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.connect(_core_address(address))
+        self._request_ids = itertools.count(1)
+        self._awaiting_reply = deque()
+        self._awaiting_result = {}
+        self._reader = None
+
+    def close(self):
+        """Stop receiving responses and clean up the ZMQ objects."""
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        for _, future in self._awaiting_reply:
+            future.cancel()
+        for _, future in self._awaiting_result.values():
+            future.cancel()
+        self._socket.close(linger=0)
+        self._context.term()
+
+    async def request(self, header, message, timeout=None):
+        """Send a controller message to the Core and return the final
+        response.
+
+        :param header: the controller message header, e.g.
+            ``'ACTION'`` or ``'STATE'``
+        :param message: the controller message payload
+        :param timeout: the maximum time to wait in seconds (optional,
+            default or ``None`` waits forever)
+        :raises asyncio.TimeoutError: if the timeout expires
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._awaiting_reply.append((next(self._request_ids), future))
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+        await self._socket.send_multipart(protocol.controller_create(
+            header, message))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future.cancelled():
+                # Stop waiting for the result of an action which timed
+                # out (or whose caller was cancelled)
+                for action_id, (_, waiting) in list(
+                        self._awaiting_result.items()):
+                    if waiting is future:
+                        del self._awaiting_result[action_id]
+
+    async def send_action(self, client_name, action_name, params,
+            timeout=None):
+        """Run an action on a DAQ component and return the result.
+
+        :param client_name: the component name, e.g. ``'LArPix board'``
+        :param action_name: the action name
+        :param params: the list of action parameters
+        :param timeout: the maximum time to wait in seconds (optional)
+        """
+        return await self.request('ACTION', {
+            'client_name': client_name,
+            'action_name': action_name,
+            'params': params,
+            }, timeout)
+
+    async def batch(self, actions, max_in_flight=64, timeout=None):
+        """Run many actions concurrently and return their outcomes.
+
+        Up to ``max_in_flight`` actions are sent before waiting for any
+        results, so a long sequence of actions takes about as long as
+        the components need to execute them rather than the sum of the
+        round trip times. Components still execute their own actions
+        one at a time, in the order they were sent.
+
+        :param actions: a list of ``(client_name, action_name, params)``
+            tuples, as for :py:meth:`send_action`
+        :param max_in_flight: the maximum number of actions waiting for
+            results at any time (optional, default: ``64``)
+        :param timeout: the maximum time to wait in seconds for each
+            action's result (optional, default or ``None`` waits
+            forever)
+        :returns: a list with one dict per action, in the same order,
+            with keys ``'action'`` (the action tuple), ``'status'``
+            (``'ok'``, ``'error'`` or ``'timeout'``), ``'response'`` (the
+            final response, or ``None``) and, if the action did not
+            complete, ``'error'`` (a description of the problem)
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+        async def run(action):
+            client_name, action_name, params = action
+            outcome = {'action': action, 'response': None}
+            async with semaphore:
+                try:
+                    response = await self.send_action(client_name,
+                            action_name, list(params), timeout)
+                except asyncio.TimeoutError:
+                    outcome['status'] = 'timeout'
+                    outcome['error'] = 'No result after %s s' % timeout
+                    return outcome
+                except Exception as e:
+                    outcome['status'] = 'error'
+                    outcome['error'] = str(e)
+                    return outcome
+            outcome['response'] = response
+            result = response['message'].get('result')
+            if isinstance(result, str) and result.startswith('ERROR'):
+                outcome['status'] = 'error'
+            else:
+                outcome['status'] = 'ok'
+            return outcome
+        return await asyncio.gather(*[run(action) for action in actions])
+
+    async def _read(self):
+        """Receive responses from the Core until cancelled."""
+        try:
+            while True:
+                frames = await self._socket.recv_multipart()
+                self._dispatch(protocol.controller_parse(frames))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(e)
+            for _, future in self._awaiting_reply:
+                if not future.done():
+                    future.set_exception(e)
+            for _, future in self._awaiting_result.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._awaiting_reply.clear()
+            self._awaiting_result.clear()
+            self._reader = None
+
+    def _dispatch(self, response):
+        """Route a response from the Core to the waiting request."""
+        header = response['header']
+        payload = response['message']
+        action_id = None
+        if isinstance(payload, dict):
+            action_id = payload.get('metadata', payload).get('id')
+        if header == 'ACTION RESULT' and action_id in self._awaiting_result:
+            request_id, future = self._awaiting_result.pop(action_id)
+        elif self._awaiting_reply:
+            request_id, future = self._awaiting_reply.popleft()
+            if header == 'ACTION TICKET':
+                if not future.done():
+                    self._awaiting_result[action_id] = (request_id, future)
+                return
+        else:
+            logging.warning('Discarding unexpected response: %s',
+                    response)
+            return
+        if not future.done():
+            response['request_id'] = request_id
+            future.set_result(response)
+
+    async def get_state(self, timeout=None):
+        """Get the current DAQ state."""
+        return await self.request('STATE REQUEST', '', timeout)
+
+    async def get_clients(self, timeout=None):
+        """Get the list of components connected to the Core."""
+        return await self.request('CLIENTS', '', timeout)
+
+    async def get_actions(self, timeout=None):
+        """Get the actions available on each component."""
+        return await self.request('ACTIONS', '', timeout)
+
+    async def notifier_health(self, timeout=None):
+        """See :py:meth:`Operator.notifier_health`."""
+        return await self.request('NOTIFIER', '', timeout)
+
+    async def telemetry(self, timeout=None):
+        """See :py:meth:`Operator.telemetry`."""
+        return await self.request('TELEMETRY', '', timeout)
+
+    async def get_boards(self, timeout=None):
+        """See :py:meth:`Operator.get_boards`."""
+        return await self.send_action('LArPix board', 'get_boards', [],
+                timeout)
+
+    async def load_board(self, filename, timeout=None):
+        """See :py:meth:`Operator.load_board`."""
+        return await self.send_action('LArPix board', 'load_board',
+                [filename], timeout)
+
+    async def retrieve_pixel_layout(self, timeout=None):
+        """See :py:meth:`Operator.retrieve_pixel_layout`."""
+        return await self.send_action('Online monitor',
+                'retrieve_pixel_layout', [], timeout)
+
+    async def load_pixel_layout(self, pcb_id, timeout=None):
+        """See :py:meth:`Operator.load_pixel_layout`."""
+        return await self.send_action('Online monitor',
+                'load_pixel_layout', [pcb_id], timeout)
+
+    async def adc_histogram(self, chip, channel=None, timeout=None):
+        """See :py:meth:`Operator.adc_histogram`."""
+        return await self.send_action('Online monitor', 'adc_histogram',
+                [chip, channel], timeout)
+
+    async def rate_history(self, resolution=1, pixel=None, timeout=None):
+        """See :py:meth:`Operator.rate_history`."""
+        return await self.send_action('Online monitor', 'rate_history',
+                [resolution, pixel], timeout)
+
+    async def channel_health(self, suggest_mask=False, timeout=None):
+        """See :py:meth:`Operator.channel_health`."""
+        return await self.send_action('Online monitor', 'channel_health',
+                [suggest_mask], timeout)
+
+    async def write_configuration(self, chip, timeout=None):
+        """See :py:meth:`Operator.write_configuration`."""
+        return await self.send_action('LArPix board', 'write_config',
+                [chip], timeout)
+
+    async def read_configuration(self, chip, timeout=None):
+        """See :py:meth:`Operator.read_configuration`."""
+        return await self.send_action('LArPix board', 'read_config',
+                [chip], timeout)
+
+    async def validate_configuration(self, chip, timeout=None):
+        """See :py:meth:`Operator.validate_configuration`."""
+        return await self.send_action('LArPix board', 'validate_config',
+                [chip], timeout)
+
+    async def retrieve_configuration(self, chip, timeout=None):
+        """See :py:meth:`Operator.retrieve_configuration`."""
+        return await self.send_action('LArPix board', 'retrieve_config',
+                [chip], timeout)
+
+    async def send_configuration(self, updates, timeout=None):
+        """See :py:meth:`Operator.send_configuration`."""
+        return await self.send_action('LArPix board', 'send_config',
+                [updates], timeout)
+
+    async def list_routines(self, timeout=None):
+        """See :py:meth:`Operator.list_routines`."""
+        return await self.send_action('LArPix board', 'list_routines', [],
+                timeout)
+
+    async def load_routines(self, location, timeout=None):
+        """See :py:meth:`Operator.load_routines`."""
+        return await self.send_action('LArPix board', 'load_routines',
+                [location], timeout)
+
+    async def run_routine(self, name, *args, timeout=None):
+        """See :py:meth:`Operator.run_routine`."""
+        return await self.send_action('LArPix board', 'run_routine',
+                [name] + list(args), timeout)
+
+    async def profile_routine(self, name, *args, cprofile=False,
+            timeout=None):
+        """See :py:meth:`Operator.profile_routine`."""
+        return await self.send_action('LArPix board', 'profile_routine',
+                [name, cprofile] + list(args), timeout)
+
+    async def prepare_physics_run(self, timeout=None):
+        """See :py:meth:`Operator.prepare_physics_run`."""
+        return await self.request('STATE', 'READY', timeout)
+
+    async def begin_physics_run(self, timeout=None):
+        """See :py:meth:`Operator.begin_physics_run`."""
+        return await self.request('STATE', 'RUN', timeout)
+
+    async def end_physics_run(self, timeout=None):
+        """See :py:meth:`Operator.end_physics_run`."""
+        return await self.request('STATE', 'STOP', timeout)
@@ -5,8 +5,14 @@ Formatter for LArPix data packets + medatadata to/from bytestreams.
 import json
 import struct
 
+import numpy as np
 from larpix.larpix import Packet, TimestampPacket
 
+#: Number of bytes before the first packet (version + ``b'/'``)
+HEADER_LENGTH = 3
+#: Number of bytes used by each packet
+PACKET_LENGTH = 10
+
 def get_packet(packet_bytes):
     byte_marker = packet_bytes[0]
     if byte_marker == 0:
@@ -59,13 +65,140 @@ def toBytes(packets):
     return b'\x00\x01/' + b''.join(format_packet(p) for p in packets)
 
 def fromBytes(bytestream):
-    version, slash, stream = bytestream.partition(b'/')
+    version, slash, stream = bytes(bytestream).partition(b'/')
     if slash == b'':
         raise ValueError('No version found')
     split = [stream[n:n+10] for n in range(0, len(stream), 10)]
     packets = [get_packet(x) for x in split]
     return packets
 
+def toArray(bytestream):
+    '''
+    Return the packets in the bytestream as an array of raw packet
+    records, without decoding them.
+
+    The array has shape ``(npackets, PACKET_LENGTH)`` and dtype
+    ``uint8``, and each row is laid out as described in ``toBytes``.
+    The array is read-only since it shares memory with the bytestream.
+
+    '''
+    return np.frombuffer(bytestream, dtype=np.uint8,
+            offset=HEADER_LENGTH).reshape(-1, PACKET_LENGTH)
+
+#: The dtype of decoded packet records returned by ``decode``
+DECODED_DTYPE = np.dtype([
+    ('packet_type', 'u1'),
+    ('chipid', 'u1'),
+    ('channel', 'u1'),
+    ('timestamp', 'u8'),
+    ('dataword', 'u2'),
+    ('io_group', 'u1'),
+    ('io_channel', 'u1'),
+    ])
+
+#: The packet type of data packets (``Packet.DATA_PACKET``) in ``decode``
+DATA_PACKET_TYPE = 0
+#: The packet type assigned to timestamp packets by ``decode`` (the same
+#: as ``TimestampPacket.packet_type``)
+TIMESTAMP_PACKET_TYPE = 4
+
+def decode(records):
+    '''
+    Decode an array of raw packet records (see ``toArray``) into a
+    structured array with dtype ``DECODED_DTYPE``, without creating
+    ``Packet`` objects.
+
+    For data packets, the field values are the same as the
+    corresponding ``Packet`` properties (``packet_type``, ``chipid``,
+    ``channel_id``, ``timestamp``, ``dataword``) and chip key
+    components. For timestamp packets, ``packet_type`` is
+    ``TIMESTAMP_PACKET_TYPE``, ``timestamp`` is the full timestamp and
+    the other fields are 0.
+
+    '''
+    nrecords = len(records)
+    padded = np.zeros((nrecords, 8), dtype=np.uint8)
+    padded[:, :7] = records[:, 1:8]
+    # The UART bytes are the little-endian encoding of the packet bits
+    word = padded.view('<u8').reshape(nrecords)
+    is_data = records[:, 0] == 0
+    result = np.zeros(nrecords, dtype=DECODED_DTYPE)
+    result['packet_type'] = np.where(is_data, word & 0x3,
+            TIMESTAMP_PACKET_TYPE)
+    result['chipid'] = np.where(is_data, (word >> 2) & 0xFF, 0)
+    result['channel'] = np.where(is_data, (word >> 10) & 0x7F, 0)
+    result['timestamp'] = np.where(is_data, (word >> 17) & 0xFFFFFF, word)
+    # Packet.dataword drops the least significant bit
+    result['dataword'] = np.where(is_data, (word >> 41) & 0x3FE, 0)
+    result['io_group'] = np.where(is_data, records[:, 8], 0)
+    result['io_channel'] = np.where(is_data, records[:, 9], 0)
+    return result
+
+def chip_code(io_group, io_channel, chipid):
+    '''
+    Combine chip key components into a single integer (or array of
+    integers), e.g. for use as an array index or sort key.
+
+    '''
+    return ((np.asarray(io_group, dtype=np.int64) << 16)
+            | (np.asarray(io_channel, dtype=np.int64) << 8)
+            | np.asarray(chipid, dtype=np.int64))
+
+def chip_key_code(chip_key):
+    '''
+    Return the integer code (see ``chip_code``) of the given chip key
+    string, e.g. ``'1-1-3'``.
+
+    '''
+    io_group, io_channel, chipid = (int(x) for x in
+            str(chip_key).split('-'))
+    return int(chip_code(io_group, io_channel, chipid))
+
+def fromArray(records):
+    '''
+    Convert an array of raw packet records (see ``toArray``) into
+    packets.
+
+    '''
+    return [get_packet(record.tobytes()) for record in records]
+
+def packet_count(bytestream):
+    '''
+    Return the number of packets in the bytestream without decoding
+    them.
+
+    '''
+    return (len(bytestream) - HEADER_LENGTH) // PACKET_LENGTH
+
+def filter_packets(bytestream, io_groups=None, io_channels=None):
+    '''
+    Select the data packets from the given IO groups and/or IO channels
+    without decoding them.
+
+    Timestamp packets are not associated with a chip key and are always
+    kept.
+
+    :param bytestream: the bytestream to filter
+    :param io_groups: the IO groups to keep (optional, default or
+        ``None`` keeps all IO groups)
+    :param io_channels: the IO channels to keep (optional, default or
+        ``None`` keeps all IO channels)
+    :returns: the filtered bytestream, or ``None`` if no packets are
+        left
+    '''
+    records = toArray(bytestream)
+    keep = np.ones(len(records), dtype=bool)
+    if io_groups is not None:
+        keep &= np.isin(records[:, 8], list(io_groups))
+    if io_channels is not None:
+        keep &= np.isin(records[:, 9], list(io_channels))
+    keep |= records[:, 0] != 0
+    if keep.all():
+        return bytestream
+    elif not keep.any():
+        return None
+    return bytes(bytestream[:HEADER_LENGTH]) + records[keep].tobytes()
+
 def to_unicode_coding(packets):
     '''
     Return an encoding of the packet bytes as a Unicode string.
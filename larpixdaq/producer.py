@@ -17,8 +17,11 @@ import larpix.larpix as larpix
 
 from larpixdaq.packetformat import toBytes
 from larpixdaq.routines import ROUTINES, init_routines
+from larpixdaq.routine_profiler import RoutineProfile
 from larpixdaq.logger_producer import DAQLogger
 from larpixdaq.core import CORE_PORT
+from larpixdaq.telemetry import acknowledge_state
+from larpixdaq.shm_transport import RingWriter, attach_writer, DEFAULT_SIZE
 
 class LArPixProducer(object):
     """The entry point of LArPix data into the xylem DAQ pipeline.
@@ -56,6 +59,8 @@ class LArPixProducer(object):
     :var current_boardname: the short name of the layout/configuration
         used for the Controller object, e.g. ``'pcb-1'``.
     :var state: the DAQ State of the xylem Producer component
+    :var ring: the :py:class:`~larpixdaq.shm_transport.RingWriter`
+        used to send data through shared memory, or ``None``
 
     :param output_address: the full TCP address (including port number)
         that data will be published to
@@ -67,16 +72,31 @@ class LArPixProducer(object):
         optionally, the positional arguments to pass to the IO class
         constructor. E.g. ``['FakeIO']`` or ``['MultiZMQ_IO',
         'io/default.json']``.
+    :param fake_rate: the rate in packets per second of fake data to
+        generate in the RUN state if the IO class is ``FakeIO``
+        (optional, default: ``None``, i.e. 300 packets per event loop
+        iteration)
+    :param shm_ring: the name of a shared-memory ring to send data
+        message payloads through, for consumers on the same host (see
+        :py:mod:`larpixdaq.shm_transport`) (optional, default:
+        ``None``, i.e. send payloads over ZMQ)
+    :param shm_size: the size of the shared-memory ring in bytes
+        (optional)
     """
 
     def __init__(self, output_address, core_address, log_address,
-            io_config):
+            io_config, fake_rate=None, shm_ring=None,
+            shm_size=DEFAULT_SIZE):
         kwargs = {
                 'core_address': core_address,
                 'log_address': log_address,
                 'heartbeat_time_ms': 300,
         }
         self.producer = Producer(output_address, name='LArPix board', group='BOARD', **kwargs)
+        self.ring = None
+        if shm_ring is not None:
+            self.ring = RingWriter(shm_ring, shm_size)
+            attach_writer(self.producer, self.ring)
         self.board = larpix.Controller()
         io_class = io_config[0]
         io_args = io_config[1:]
@@ -93,6 +113,11 @@ class LArPixProducer(object):
         self.current_boardname = 'pcb-1'
         self.board.logger = DAQLogger(self.producer)
         self.state = ''
+        self.fake_rate = fake_rate
+        self.fake_packets_generated = 0
+        self._fake_timestamp = 0
+        self._fake_time = time.time()
+        self._fake_owed = 0
         run = False
         configurations = {
                 'startup': 'startup.json',
@@ -111,7 +136,10 @@ class LArPixProducer(object):
         self.producer.register_action(*self._get_register_action_args('load_board'))
         self.producer.register_action(*self._get_register_action_args('list_routines'))
         self.producer.register_action(*self._get_register_action_args('run_routine'))
+        self.producer.register_action(*self._get_register_action_args('profile_routine'))
         self.producer.register_action(*self._get_register_action_args('sleep'))
+        self.producer.register_action(*self._get_register_action_args('set_fake_rate'))
+        self.producer.register_action(*self._get_register_action_args('shm_stats'))
         self.producer.request_state()
 
     def _get_register_action_args(self, name):
@@ -247,6 +275,7 @@ class LArPixProducer(object):
             'name': name,
             'params': [{'name': p, 'type': 'input'} for p in
                 r.params],
+            'doc': r.doc,
             }
             for name, r in ROUTINES.items()
             ]
@@ -257,7 +286,7 @@ class LArPixProducer(object):
         :param location: the directory to load routines from
         """
         init_routines(location)
-        return self.list_routines()
+        return LArPixProducer.list_routines()
     def run_routine(self, name, *args):
         """Run the given routine.
 
@@ -272,6 +301,26 @@ class LArPixProducer(object):
                 self.producer.send_info, *args)
         return result
 
+    def profile_routine(self, name, cprofile=False, *args):
+        """Run the given routine and return its result and profile.
+
+        :param name: the name of the routine to run
+        :param cprofile: if true, include the ``cProfile`` statistics
+            of the top functions in the profile
+        :param args: all subsequent arguments are passed in order to the
+            routine as parameters
+        :returns: a dict with keys ``'result'`` (the routine's result)
+            and ``'profile'`` (see
+            :py:meth:`larpixdaq.routine_profiler.RoutineProfile.summary`)
+        """
+        def send_data(packet_list, metadata=None):
+            self.producer.produce(toBytes(packet_list), metadata)
+            return
+        profile = RoutineProfile(name, cprofile=bool(cprofile))
+        self.board, result = profile.run(ROUTINES[name].func, self.board,
+                send_data, self.producer.send_info, args)
+        return {'result': result, 'profile': profile.summary()}
+
     @staticmethod
     def sleep(time_in_sec):
         """Sleep and return success."""
@@ -279,6 +328,63 @@ class LArPixProducer(object):
         time.sleep(delay)
         return 'success'
 
+    def set_fake_rate(self, rate):
+        """Set the rate of fake data generated in the RUN state when
+        using ``FakeIO``.
+
+        :param rate: the rate in packets per second, or ``None`` or
+            ``0`` for the default of 300 packets per event loop iteration
+        :returns: a dict with the new ``'rate'`` and the number of fake
+            packets ``'generated'`` so far
+        """
+        self.fake_rate = float(rate) if rate else None
+        return {'rate': self.fake_rate, 'generated':
+                self.fake_packets_generated}
+
+    def shm_stats(self):
+        """Return the usage of the shared-memory ring, or ``None`` if
+        data is not sent through shared memory.
+
+        :returns: see
+            :py:meth:`larpixdaq.shm_transport.RingWriter.stats`
+        """
+        if self.ring is None:
+            return None
+        return self.ring.stats()
+
+    def _fake_packets(self, npackets):
+        """Return a list of ``npackets`` fake data packets from random
+        chips and channels on the board."""
+        chips = list(self.board.chips.values())
+        packets = []
+        for _ in range(npackets):
+            p = larpix.Packet()
+            p.timestamp = self._fake_timestamp % 16777216
+            # Approximately the sum of 256 uniform random numbers
+            p.dataword = int(random.gauss(128, 4.62))
+            chip = random.choice(chips)
+            p.chipid = chip.chip_id
+            p.channel_id = random.randint(0, 31)
+            self._fake_timestamp += 1
+            p.assign_parity()
+            p.chip_key = '%d-%d-%d' % (1, 1, chip.chip_id)
+            packets.append(p)
+        self.fake_packets_generated += npackets
+        return packets
+
+    def _fake_packet_count(self):
+        """Return the number of fake packets to generate now to keep
+        up with ``fake_rate``, generating at most 1 second's worth at
+        once."""
+        if not self.fake_rate:
+            return 300
+        now = time.time()
+        owed = self._fake_owed + self.fake_rate * (now - self._fake_time)
+        self._fake_time = now
+        npackets = int(min(owed, self.fake_rate))
+        self._fake_owed = min(owed, self.fake_rate) - npackets
+        return npackets
+
     def run(self):
         """Event loop of checking for DAQ commands, checking for new
         data, and repeating.
@@ -289,10 +395,11 @@ class LArPixProducer(object):
         not be send down the pipeline.
 
         If the IO object on ``self.board`` is a FakeIO object, fake data
-        will be generated to mimic data arriving from the LArPix board.
+        will be generated to mimic data arriving from the LArPix board,
+        at ``self.fake_rate`` packets per second if it is set.
         """
         while True:
-            self.producer.receive(0.25)
+            self.producer.receive(0.02 if self.fake_rate else 0.25)
             if self.state != self.producer.state:
                 old_state = self.state
                 new_state = self.producer.state
@@ -303,27 +410,24 @@ class LArPixProducer(object):
                 if new_state == 'RUN':
                     self.producer.send_info('Beginning run')
                     self.board.logger.enable()
-                    fake_timestamp = 0
+                    self._fake_timestamp = 0
+                    self._fake_time = time.time()
+                    self._fake_owed = 0
                 self.state = self.producer.state
+                acknowledge_state(self.producer)
             if self.state == 'RUN':
                 if not self.board.io.is_listening:
                     logging.debug('about to start listening')
                     self.board.start_listening()
                 if isinstance(self.board.io, FakeIO):
-                    packets = []
-                    for _ in range(300):
-                        p = larpix.Packet()
-                        p.timestamp = fake_timestamp % 16777216
-                        p.dataword = int(sum(random.random() for _ in range(256)))
-                        chip = random.choice(list(self.board.chips.values()))
-                        p.chipid = chip.chip_id
-                        p.channel_id = random.randint(0, 31)
-                        fake_timestamp += 1
-                        p.assign_parity()
-                        p.chip_key = '%d-%d-%d' % (1, 1, chip.chip_id)
-                        packets.append(p)
-                    self.board.io.queue.append((packets, p.bytes() + b'\x00'))
-                data = self.board.read()
+                    npackets = self._fake_packet_count()
+                    if npackets > 0:
+                        packets = self._fake_packets(npackets)
+                        self.board.io.queue.append((packets,
+                            packets[-1].bytes() + b'\x00'))
+                if (not isinstance(self.board.io, FakeIO)
+                        or self.board.io.queue):
+                    data = self.board.read()
             else:
                 if self.board.io.is_listening:
                     self.board.stop_listening()
@@ -340,6 +444,15 @@ if __name__ == '__main__':
             help='Address to connect to global log, including port number')
     parser.add_argument('--io-config', nargs='+', required=True,
             help='<IO class> [constructor arguments], e.g. "ZMQ_IO io/default.json"')
+    parser.add_argument('--fake-rate', type=float, default=None,
+            help='Rate of fake data in packets per second when using '
+            'FakeIO (default: 300 packets per event loop iteration)')
+    parser.add_argument('--shm-ring', default=None,
+            help='Send data through a shared-memory ring with this name, '
+            'for consumers on the same host')
+    parser.add_argument('--shm-size', type=int, default=DEFAULT_SIZE//2**20,
+            help='Size of the shared-memory ring in MiB (default: %d)' %
+            (DEFAULT_SIZE//2**20))
     parser.add_argument('-d', '--debug', action='store_true',
             help='Enter debug (verbose) mode')
     args = parser.parse_args()
@@ -356,10 +469,12 @@ if __name__ == '__main__':
             parsed_arg = arg
         io_config.append(parsed_arg)
     producer = LArPixProducer(address, core_address, args.log_address,
-            io_config)
+            io_config, args.fake_rate, args.shm_ring, args.shm_size * 2**20)
     try:
         producer.run()
     except KeyboardInterrupt:
         pass
     finally:
         producer.producer.cleanup()
+        if producer.ring is not None:
+            producer.ring.close()
@@ -0,0 +1,233 @@
+'''
+Send updates to the LArPix webapp server without blocking the DAQ.
+
+'''
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+
+import requests
+
+#: The default base URL of the LArPix webapp API
+DEFAULT_SERVER = 'http://localhost:5000/api'
+
+class WebPublisher(object):
+    '''
+    Publish updates to the webapp server from a background thread.
+
+    Updates are identified by a key. Publishing an update only stores
+    it and returns immediately; the background thread sends it with a
+    persistent, pooled HTTP session. If a newer update with the same
+    key is published before the previous one has been sent, the
+    previous one is discarded (latest value wins). Failed requests are
+    retried with exponential backoff, as long as no newer update with
+    the same key has replaced them. An optional callback is called (from
+    the background thread) once an update has been sent successfully.
+
+    Events, in contrast, are never coalesced: each published event is
+    sent once, in order, before any pending updates. Failed events are
+    retried like updates. At most ``max_events`` events are queued; if
+    the queue is full, the oldest event is dropped.
+
+    The publisher keeps statistics about its own health, available from
+    :py:meth:`health`. Only the first failure after a successful request
+    and the recovery are logged as warnings; further failed attempts are
+    logged at DEBUG level.
+
+    :param server: the base URL of the webapp API (optional, default:
+        ``DEFAULT_SERVER``)
+    :param timeout: the timeout for each request in seconds (optional,
+        default: ``2``)
+    :param min_backoff: the delay in seconds before the first retry
+        (optional, default: ``0.5``)
+    :param max_backoff: the maximum delay in seconds between retries
+        (optional, default: ``30``)
+    :param max_events: the maximum number of queued events (optional,
+        default: ``1000``)
+    '''
+    def __init__(self, server=DEFAULT_SERVER, timeout=2, min_backoff=0.5,
+            max_backoff=30, max_events=1000):
+        self.server = server
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                pool_maxsize=2)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._pending = OrderedDict()
+        self._events = deque()
+        self.max_events = max_events
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+        self._healthy = None
+        self._last_success = None
+        self._last_error = None
+        self._condition = threading.Condition()
+        self._closed = False
+        self._backoff = 0
+        self._retry_at = 0
+        self._thread = threading.Thread(target=self._run,
+                name='WebPublisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, key, path, payload, method='POST', on_success=None,
+            content_type=None):
+        '''
+        Queue an update to be sent, replacing any unsent update with the
+        same key.
+
+        :param key: the update identifier used for coalescing
+        :param path: the URL path relative to the server, e.g.
+            ``'/packets'``
+        :param payload: the JSON-encodable payload, or the raw body if
+            ``content_type`` is given. It must not be modified after it
+            is published.
+        :param method: the HTTP method (optional, default: ``'POST'``)
+        :param on_success: a function with no arguments to call after
+            the update has been sent successfully (optional)
+        :param content_type: the content type of a raw (non-JSON)
+            payload (optional, default: send the payload as JSON)
+        '''
+        with self._condition:
+            self._pending[key] = (method, path, payload, on_success,
+                    content_type)
+            self._condition.notify()
+
+    def publish_event(self, path, payload, method='POST'):
+        '''
+        Queue an event to be sent. Events are sent in order and are not
+        coalesced.
+
+        :param path: the URL path relative to the server, e.g.
+            ``'/component'``
+        :param payload: the JSON-encodable payload. It must not be
+            modified after it is published.
+        :param method: the HTTP method (optional, default: ``'POST'``)
+        '''
+        with self._condition:
+            if len(self._events) >= self.max_events:
+                self._events.popleft()
+                self._dropped += 1
+            self._events.append((method, path, payload, None, None))
+            self._condition.notify()
+
+    def health(self):
+        '''
+        Return statistics about the publisher's health.
+
+        :returns: a dict with keys ``'healthy'`` (whether the last
+            request succeeded, or ``None`` before the first request),
+            ``'pending_updates'``, ``'queued_events'``, ``'sent'``,
+            ``'failed'`` (failed attempts), ``'dropped'`` (events dropped
+            from a full queue or rejected by the server),
+            ``'backoff'`` (the current retry delay in seconds),
+            ``'last_success'`` (Unix time, or ``None``) and
+            ``'last_error'`` (a description, or ``None``)
+        '''
+        with self._condition:
+            return {
+                    'healthy': self._healthy,
+                    'pending_updates': len(self._pending),
+                    'queued_events': len(self._events),
+                    'sent': self._sent,
+                    'failed': self._failed,
+                    'dropped': self._dropped,
+                    'backoff': self._backoff,
+                    'last_success': self._last_success,
+                    'last_error': self._last_error,
+                    }
+
+    def close(self, timeout=None):
+        '''
+        Stop the background thread, discarding any unsent updates.
+
+        :param timeout: the maximum time in seconds to wait for the
+            thread to finish (optional, default: wait forever)
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        self._session.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    delay = self._retry_at - time.time()
+                    if (self._events or self._pending) and delay <= 0:
+                        break
+                    self._condition.wait(delay if delay > 0 else None)
+                if self._closed:
+                    return
+                if self._events:
+                    key, update = None, self._events.popleft()
+                else:
+                    key, update = self._pending.popitem(last=False)
+            method, path, payload, on_success, content_type = update
+            if content_type is None:
+                body = {'json': payload}
+            else:
+                body = {'data': payload,
+                        'headers': {'Content-Type': content_type}}
+            try:
+                response = self._session.request(method, self.server +
+                        path, timeout=self.timeout, **body)
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500:
+                    # The server rejected the update; retrying won't help
+                    logging.warning('Server rejected %s: %s', key or path,
+                            e)
+                    with self._condition:
+                        self._healthy = True
+                        self._dropped += 1
+                        self._last_error = str(e)
+                    continue
+                self._retry(key, update, e)
+            except requests.RequestException as e:
+                self._retry(key, update, e)
+            else:
+                with self._condition:
+                    recovered = self._healthy is False
+                    self._backoff = 0
+                    self._sent += 1
+                    self._healthy = True
+                    self._last_success = time.time()
+                if recovered:
+                    logging.warning('Sending updates to server again')
+                if on_success is not None:
+                    try:
+                        on_success()
+                    except Exception:
+                        # Keep the thread alive for the other updates
+                        logging.exception('Callback for %s failed',
+                                key or path)
+
+    def _retry(self, key, update, error):
+        '''Requeue a failed update or event (``key`` is ``None``) and
+        schedule the next attempt.'''
+        with self._condition:
+            first_failure = self._healthy is not False
+            self._backoff = min(self.max_backoff,
+                    max(self.min_backoff, 2 * self._backoff))
+            backoff = self._backoff
+            self._failed += 1
+            self._healthy = False
+            self._last_error = str(error)
+            self._retry_at = time.time() + self._backoff
+            if key is None:
+                self._events.appendleft(update)
+            elif key not in self._pending:
+                self._pending[key] = update
+                self._pending.move_to_end(key, last=False)
+        # Retries are expected while no server is running, so only the
+        # first failure is a warning
+        logging.log(logging.WARNING if first_failure else logging.DEBUG,
+                'Failed to send %s to server (retrying in %.1f s): %s',
+                key or update[1], backoff, error)
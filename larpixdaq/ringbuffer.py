@@ -0,0 +1,86 @@
+'''
+Fixed-capacity ring buffer backed by a NumPy array.
+
+'''
+import numpy as np
+
+class RingBuffer(object):
+    '''
+    A fixed-capacity FIFO buffer of NumPy values.
+
+    Appending is O(number of new items) and never allocates once the
+    buffer is created. When the buffer is full, the oldest items are
+    overwritten. Items are indexed from oldest (``0``) to newest
+    (``-1``), and slicing returns a copy in that order.
+
+    :var capacity: the maximum number of items stored
+    :var total: the number of items added since creation or the last
+        call to ``clear``, including those that have been overwritten
+
+    :param capacity: the maximum number of items to store
+    :param dtype: the NumPy dtype of each item
+    :param shape: the shape of each item (optional, default: ``()``,
+        i.e. scalar items)
+    '''
+    def __init__(self, capacity, dtype, shape=()):
+        self.capacity = capacity
+        self.total = 0
+        self._data = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def _physical(self, indices):
+        '''Convert logical (oldest-first) indices to array indices.'''
+        oldest = (self.total - len(self)) % self.capacity
+        return (oldest + indices) % self.capacity
+
+    def __getitem__(self, key):
+        length = len(self)
+        if isinstance(key, slice):
+            indices = np.arange(*key.indices(length))
+        elif isinstance(key, (int, np.integer)):
+            if not -length <= key < length:
+                raise IndexError('RingBuffer index out of range')
+            indices = key % length
+        else:
+            indices = np.arange(length)[key]
+        return self._data[self._physical(indices)]
+
+    def tail(self, n):
+        '''Return a copy of the newest ``n`` items, oldest first.'''
+        n = min(n, len(self))
+        indices = np.arange(self.total - n, self.total) % self.capacity
+        return self._data[indices]
+
+    def extend(self, values):
+        '''
+        Append the given items.
+
+        :param values: an array of items, with shape ``(n,) + shape``
+        :returns: the items that were overwritten (evicted) to make
+            room, oldest first
+        '''
+        values = np.asarray(values, dtype=self._data.dtype)
+        n = len(values)
+        nevicted = max(0, len(self) + n - self.capacity)
+        evicted_old = self._data[self._physical(np.arange(min(nevicted,
+            len(self))))]
+        if n >= self.capacity:
+            evicted = np.concatenate((evicted_old,
+                values[:n - self.capacity]))
+            values = values[n - self.capacity:]
+            self.total += n - self.capacity
+            n = self.capacity
+        else:
+            evicted = evicted_old
+        start = self.total % self.capacity
+        first = min(n, self.capacity - start)
+        self._data[start:start + first] = values[:first]
+        self._data[:n - first] = values[first:]
+        self.total += n
+        return evicted
+
+    def clear(self):
+        '''Remove all items and reset ``total``.'''
+        self.total = 0
@@ -0,0 +1,234 @@
+'''
+Profile the execution of a DAQ routine.
+
+A :py:class:`RoutineProfile` runs a routine function with an
+instrumented board and instrumented ``send_data``/``send_info``
+functions, and records:
+
+- the wall time
+- the time spent in board IO calls (sending packets, reading and
+  waiting for data, configuration writes and reads), per method
+- the time spent sending data and info messages down the pipeline
+- the remaining time, spent in the routine's own Python code
+- the numbers of configuration write and read packets sent to the
+  board and of configuration read packets received
+- the numbers of data packets and ``send_data`` calls
+- optionally, a ``cProfile`` profile of the whole routine
+
+Used by :py:func:`larpixdaq.routines.test_routine` (``profile=True``)
+and by the producer's ``profile_routine`` action. For example::
+
+    board, result, profile = test_routine('pedestal', board,
+            profile=True)
+    print(profile.summary()['python_time'])
+    profile.export('pedestal-profile.json')
+
+'''
+import cProfile
+import io
+import json
+import pstats
+import time
+
+from larpix.larpix import Packet
+
+#: The board (``larpix.larpix.Controller``) methods timed as IO
+IO_METHODS = (
+        'send',
+        'read',
+        'run',
+        'start_listening',
+        'stop_listening',
+        'write_configuration',
+        'read_configuration',
+        'multi_write_configuration',
+        'multi_read_configuration',
+        'verify_configuration',
+        )
+
+class RoutineProfile(object):
+    '''
+    The profile of one routine execution.
+
+    :param name: the routine name
+    :param cprofile: if ``True``, also profile the routine with
+        ``cProfile`` (optional, default: ``False``)
+    :param top: the number of functions to include in the ``cProfile``
+        summary (optional, default: ``30``)
+    '''
+    def __init__(self, name, cprofile=False, top=30):
+        self.name = name
+        self.cprofile = cprofile
+        self.top = top
+        self.wall_time = 0
+        self.io_calls = dict((method, {'calls': 0, 'time': 0.0}) for
+                method in IO_METHODS)
+        self.send_data_time = 0.0
+        self.send_info_time = 0.0
+        self.send_data_calls = 0
+        self.data_packets_sent = 0
+        self.info_messages_sent = 0
+        self.config_writes = 0
+        self.config_read_requests = 0
+        self.config_reads_received = 0
+        self.error = None
+        self._depth = 0
+        self._profiler = None
+        self._saved = {}
+
+    def run(self, func, board, send_data, send_info, args=()):
+        '''
+        Run a routine function and record its profile.
+
+        :param func: the routine function (``Routine.func``)
+        :param board: the ``larpix.larpix.Controller``
+        :param send_data: the function to send data down the pipeline
+        :param send_info: the function to send info messages
+        :param args: the routine's own arguments
+        :returns: the routine's return value
+        '''
+        self._instrument(board)
+        if self.cprofile:
+            self._profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if self._profiler is not None:
+                return self._profiler.runcall(func, board,
+                        self._wrap_send_data(send_data),
+                        self._wrap_send_info(send_info), *args)
+            return func(board, self._wrap_send_data(send_data),
+                    self._wrap_send_info(send_info), *args)
+        except Exception as e:
+            self.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            self.wall_time = time.perf_counter() - start
+            self._restore(board)
+
+    def summary(self):
+        '''
+        Return the profile as a JSON-encodable dict.
+
+        The times are in seconds. ``'io_wait'`` is the total time in
+        board IO calls, and ``'python_time'`` is the wall time not spent
+        in board IO or in ``send_data``/``send_info``.
+        '''
+        io_wait = sum(c['time'] for c in self.io_calls.values())
+        result = {
+                'routine': self.name,
+                'wall_time': self.wall_time,
+                'io_wait': io_wait,
+                'send_data_time': self.send_data_time,
+                'send_info_time': self.send_info_time,
+                'python_time': max(0.0, self.wall_time - io_wait -
+                    self.send_data_time - self.send_info_time),
+                'io_calls': dict((method, dict(c)) for method, c in
+                    self.io_calls.items() if c['calls'] > 0),
+                'config_writes': self.config_writes,
+                'config_read_requests': self.config_read_requests,
+                'config_reads_received': self.config_reads_received,
+                'send_data_calls': self.send_data_calls,
+                'data_packets_sent': self.data_packets_sent,
+                'info_messages_sent': self.info_messages_sent,
+                'error': self.error,
+                }
+        if self._profiler is not None:
+            result['cprofile'] = self.cprofile_text()
+        return result
+
+    def cprofile_text(self, sort='cumulative'):
+        '''Return the ``cProfile`` statistics of the top functions as
+        text, or ``None`` if ``cProfile`` was not used.'''
+        if self._profiler is None:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=output)
+        stats.sort_stats(sort).print_stats(self.top)
+        return output.getvalue()
+
+    def export(self, filename):
+        '''Write the summary to a JSON file, e.g. to compare it with
+        other runs.'''
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def dump_stats(self, filename):
+        '''Write the ``cProfile`` statistics to a file readable by
+        ``pstats`` (and tools such as snakeviz).'''
+        if self._profiler is None:
+            raise ValueError('The routine was not run with cProfile')
+        self._profiler.dump_stats(filename)
+
+    def _instrument(self, board):
+        '''Replace the board's IO methods with timed versions.'''
+        for method in IO_METHODS:
+            original = getattr(board, method, None)
+            if original is not None:
+                self._saved[method] = board.__dict__.get(method)
+                setattr(board, method, self._timed(method, original))
+
+    def _restore(self, board):
+        '''Put back the board's original IO methods.'''
+        for method, saved in self._saved.items():
+            if saved is None:
+                del board.__dict__[method]
+            else:
+                board.__dict__[method] = saved
+        self._saved = {}
+
+    def _timed(self, method, original):
+        '''Return a version of a board method which records its time,
+        excluding IO calls made within another IO call.'''
+        stats = self.io_calls[method]
+        def timed(*args, **kwargs):
+            if method == 'send':
+                self._count_sent(args[0] if args else kwargs['packets'])
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self._depth -= 1
+                if self._depth == 0:
+                    stats['calls'] += 1
+                    stats['time'] += elapsed
+            if method == 'read':
+                self._count_received(result[0])
+            return result
+        return timed
+
+    def _count_sent(self, packets):
+        for packet in packets:
+            packet_type = getattr(packet, 'packet_type', None)
+            if packet_type == Packet.CONFIG_WRITE_PACKET:
+                self.config_writes += 1
+            elif packet_type == Packet.CONFIG_READ_PACKET:
+                self.config_read_requests += 1
+
+    def _count_received(self, packets):
+        for packet in packets:
+            if (getattr(packet, 'packet_type', None) ==
+                    Packet.CONFIG_READ_PACKET):
+                self.config_reads_received += 1
+
+    def _wrap_send_data(self, send_data):
+        def profiled_send_data(packets, *args, **kwargs):
+            self.send_data_calls += 1
+            self.data_packets_sent += len(packets)
+            start = time.perf_counter()
+            try:
+                return send_data(packets, *args, **kwargs)
+            finally:
+                self.send_data_time += time.perf_counter() - start
+        return profiled_send_data
+
+    def _wrap_send_info(self, send_info):
+        def profiled_send_info(*args, **kwargs):
+            self.info_messages_sent += 1
+            start = time.perf_counter()
+            try:
+                return send_info(*args, **kwargs)
+            finally:
+                self.send_info_time += time.perf_counter() - start
+        return profiled_send_info
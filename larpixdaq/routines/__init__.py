@@ -49,40 +49,59 @@ A global repository of LArPix DAQ routines is being set up at
 <https://github.com/larpix/larpix-daq-routines>. Contact the LBNL LArPix
 contacts for help, and/or file an issue or pull request.
 """
+import ast
 import importlib
+import inspect
 import os
 import sys
 
+from larpixdaq.routine_profiler import RoutineProfile
+
 ROUTINES = {}
 _routine_files = {}
 
 def init_routines(location=None):
     """Collect and register routines.
 
+    Routine files are scanned incrementally: a file is only read again
+    if its modification time or size has changed since the last call,
+    so calling this function repeatedly (e.g. every time the routines
+    are listed) is cheap. Each file's routine names, parameters and
+    docstrings are read by parsing its source, without importing it.
+    The module is imported (or reloaded, if it has changed) the first
+    time one of its routines' functions is needed. Files whose
+    ``registration`` dict is not a plain literal are imported
+    immediately instead.
+
     :param location: The directory to look for routines files.
         (optional. If absent or ``None`` then look inside the
         ``larpixdaq.routines`` package directory.)
     """
     if location is None:
         location = os.path.dirname(__file__)
+    location = os.path.abspath(location)
     if location not in sys.path:
         sys.path.insert(0, location)
-    importlib.invalidate_caches()
-    routine_files = [os.path.splitext(x)[0] for x in os.listdir(location) if (
-        x.endswith('.py') and x != __file__)]
-    for routine_file in routine_files:
-        if routine_file in _routine_files:
-            module_old = _routine_files[routine_file]
-            module = importlib.reload(module_old)
-        else:
-            module = importlib.import_module(routine_file)
-        _routine_files[routine_file] = module
-        if hasattr(module, 'registration'):
-            ROUTINES.update(module.registration)
-    print(ROUTINES)
+    found = set()
+    for filename in os.listdir(location):
+        module_name, ext = os.path.splitext(filename)
+        if ext != '.py' or filename == '__init__.py':
+            continue
+        found.add(module_name)
+        path = os.path.join(location, filename)
+        routine_file = _routine_files.get(module_name)
+        if routine_file is None or routine_file.path != path:
+            routine_file = _RoutineFile(module_name, path)
+            _routine_files[module_name] = routine_file
+        routine_file.scan()
+    for module_name, routine_file in list(_routine_files.items()):
+        if (os.path.dirname(routine_file.path) == location
+                and module_name not in found):
+            routine_file.unregister()
+            del _routine_files[module_name]
 
 def test_routine(name, controller, send_data=None, send_info=None,
-        args=()):
+        args=(), profile=False):
     """Run the given routine in a test or custom environment.
 
     This is useful during development, where a routine can be executed
@@ -105,7 +124,12 @@ def test_routine(name, controller, send_data=None, send_info=None,
         If there's only one argument, it's recommended to use a list
         (``[arg1]``) since a 1-tuple requires a comma which is easy to
         forget (``(arg1,)``). (optional, default: ``()``)
-    :returns: the return value of the routine
+    :param profile: if ``True``, profile the routine; if ``'cprofile'``,
+        also profile it with ``cProfile`` (optional, default:
+        ``False``)
+    :returns: the return value of the routine, with the
+        :py:class:`~larpixdaq.routine_profiler.RoutineProfile` appended
+        if ``profile`` is set, e.g. ``(controller, result, profile)``
     """
     if send_data is None:
         def send_data(to_send):
@@ -115,7 +139,13 @@ def test_routine(name, controller, send_data=None, send_info=None,
             return None
     routine = ROUTINES[name]
     func = routine.func
-    return func(controller, send_data, send_info, *args)
+    if not profile:
+        return func(controller, send_data, send_info, *args)
+    routine_profile = RoutineProfile(name, cprofile=profile ==
+            'cprofile')
+    result = routine_profile.run(func, controller, send_data, send_info,
+            args)
+    return tuple(result) + (routine_profile,)
 
 class Routine(object):
     '''
@@ -147,4 +177,146 @@ class Routine(object):
         self.name = name
         self.func = func
         self.params = params
+        self.doc = inspect.getdoc(func)
+
+class _RoutineStub(Routine):
+    '''
+    A registered routine whose metadata is known but whose module may
+    not have been imported yet. Accessing ``func`` imports or reloads
+    the module as needed.
+
+    '''
+    def __init__(self, name, params, doc, routine_file):
+        self.name = name
+        self.params = params
+        self.doc = doc
+        self._routine_file = routine_file
+
+    @property
+    def func(self):
+        return self._routine_file.load().registration[self.name].func
+
+class _RoutineFile(object):
+    '''
+    The cached state of one routine file: its modification time and
+    size when it was last scanned, the routines it registers and its
+    module, if imported.
+
+    '''
+    def __init__(self, module_name, path):
+        self.module_name = module_name
+        self.path = path
+        self.module = None
+        self.routines = []
+        self._stat = None
+        self._imported_stat = None
+
+    def _current_stat(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def scan(self):
+        '''Update the registered routines if the file has changed.'''
+        current = self._current_stat()
+        if current == self._stat:
+            return
+        self._stat = current
+        with open(self.path, 'rb') as f:
+            source = f.read()
+        metadata = _parse_registration(source, self.path)
+        if metadata is None:
+            module = self.load()
+            metadata = [(name, r.params, r.doc) for name, r in
+                    getattr(module, 'registration', {}).items()]
+        self.unregister()
+        self.routines = [name for name, _, _ in metadata]
+        for name, params, doc in metadata:
+            ROUTINES[name] = _RoutineStub(name, params, doc, self)
+
+    def load(self):
+        '''Return the module, importing or reloading it if the file has
+        changed since it was imported.'''
+        current = self._current_stat()
+        if self.module is None or current != self._imported_stat:
+            importlib.invalidate_caches()
+            if self.module is None:
+                self.module = importlib.import_module(self.module_name)
+            else:
+                self.module = importlib.reload(self.module)
+            self._imported_stat = current
+        return self.module
+
+    def unregister(self):
+        '''Remove this file's routines from ``ROUTINES``.'''
+        for name in self.routines:
+            stub = ROUTINES.get(name)
+            if getattr(stub, '_routine_file', None) is self:
+                del ROUTINES[name]
+        self.routines = []
+
+def _parse_registration(source, filename):
+    '''
+    Find the routines registered in a routine file without importing it.
+
+    :returns: a list of ``(name, params, doc)`` tuples, or ``None`` if
+        the registration can't be determined statically
+
+    '''
+    try:
+        tree = ast.parse(source, filename)
+    except SyntaxError:
+        return None
+    docs = {}
+    routines = {}
+    registration = None
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            docs[node.name] = ast.get_docstring(node)
+        mentions = any(isinstance(n, ast.Name) and n.id == 'registration'
+                for n in ast.walk(node))
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            if mentions:
+                return None
+            continue
+        target = node.targets[0].id if isinstance(node.targets[0],
+                ast.Name) else None
+        if target == 'registration':
+            if registration is not None or not isinstance(node.value,
+                    ast.Dict):
+                return None
+            registration = node.value
+        elif mentions:
+            return None
+        elif target is not None and _is_routine_call(node.value):
+            routines[target] = node.value
+    if registration is None:
+        return []
+    metadata = []
+    for key, value in zip(registration.keys, registration.values):
+        if isinstance(value, ast.Name):
+            value = routines.get(value.id)
+        if (not isinstance(key, ast.Constant) or value is None
+                or not _is_routine_call(value)):
+            return None
+        try:
+            params = []
+            if len(value.args) > 2:
+                params = ast.literal_eval(value.args[2])
+            for keyword in value.keywords:
+                if keyword.arg == 'params':
+                    params = ast.literal_eval(keyword.value)
+        except ValueError:
+            return None
+        if params is None:
+            params = []
+        func = value.args[1] if len(value.args) > 1 else None
+        if not isinstance(func, ast.Name) or func.id not in docs:
+            return None
+        metadata.append((key.value, params, docs[func.id]))
+    return metadata
+
+def _is_routine_call(node):
+    '''Return whether an AST node is a call to ``Routine(...)``.'''
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id == 'Routine')
 
@@ -0,0 +1,250 @@
+'''
+Built-in calibration routines: threshold scan, pedestal and noise
+measurement.
+
+Every step of a routine configures all chips at once with a single
+batched configuration write, reads data from the whole board, sends it
+down the DAQ pipeline in one ``send_data`` call and accumulates
+per-channel statistics with NumPy. The chips' original threshold and
+channel mask registers are restored at the end of each routine.
+
+Results are keyed by chip key, with one value per channel, e.g.
+``{'1-1-3': [...32 values...], ...}``. Channels without data are
+``None``.
+
+'''
+import numpy as np
+from larpix.larpix import Configuration
+
+import larpixdaq.packetformat as pformat
+from larpixdaq.routines import Routine
+
+NCHANNELS = 32
+
+_THRESHOLD_REGISTERS = (Configuration.pixel_trim_threshold_addresses
+        + [Configuration.global_threshold_address]
+        + Configuration.channel_mask_addresses)
+
+class _BoardData(object):
+    '''
+    Read data from all chips on a board and index it by chip and
+    channel.
+
+    '''
+    def __init__(self, board, send_data):
+        self.board = board
+        self.send_data = send_data
+        self.chip_keys = list(board.chips.keys())
+        codes = np.array([pformat.chip_key_code(key) for key in
+            self.chip_keys], dtype=np.int64)
+        self._order = np.argsort(codes)
+        self._codes = codes[self._order]
+        self.nbins = len(self.chip_keys) * NCHANNELS
+
+    def write(self, registers):
+        '''Write the given registers to every chip in one batch.'''
+        self.board.multi_write_configuration([(key, registers) for key in
+            self.chip_keys])
+
+    def collect(self, run_time, message):
+        '''
+        Read data for ``run_time`` seconds and send it down the pipeline.
+
+        :returns: a tuple ``(index, adc)`` of the flat ``chip * 32 +
+            channel`` index and the ADC value of each data packet from
+            a known chip
+        '''
+        self.board.run(run_time, message)
+        packets = self.board.reads[-1].packets
+        if len(packets) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        self.send_data(packets)
+        data = pformat.decode(pformat.toArray(pformat.toBytes(packets)))
+        data = data[data['packet_type'] == pformat.DATA_PACKET_TYPE]
+        codes = pformat.chip_code(data['io_group'], data['io_channel'],
+                data['chipid'])
+        position = np.searchsorted(self._codes, codes)
+        position[position == len(self._codes)] = 0
+        known = (self._codes[position] == codes) & (data['channel'] <
+                NCHANNELS)
+        chips = self._order[position[known]]
+        index = chips * NCHANNELS + data['channel'][known]
+        return index, data['dataword'][known].astype(float)
+
+    def by_chip(self, values, decimals=2):
+        '''
+        Convert a flat array of per-channel values into the result
+        format, rounding floats and replacing NaN with ``None``.
+
+        '''
+        values = np.asarray(values).reshape(-1, NCHANNELS)
+        if values.dtype.kind == 'f':
+            values = np.round(values, decimals)
+        result = {}
+        for key, row in zip(self.chip_keys, values.tolist()):
+            result[str(key)] = [None if x != x else x for x in row]
+        return result
+
+    def save_thresholds(self):
+        '''Return the threshold and channel mask configuration of every
+        chip.'''
+        return [(chip.config.pixel_trim_thresholds[:],
+            chip.config.global_threshold, chip.config.channel_mask[:])
+            for chip in self.board.chips.values()]
+
+    def restore_thresholds(self, saved):
+        '''Restore the configuration returned by
+        :py:meth:`save_thresholds`.'''
+        for chip, (trims, threshold, mask) in zip(
+                self.board.chips.values(), saved):
+            chip.config.pixel_trim_thresholds = trims
+            chip.config.global_threshold = threshold
+            chip.config.channel_mask = mask
+        self.write(_THRESHOLD_REGISTERS)
+
+def _threshold_scan(board, send_data, send_info, start=255, stop=0,
+        step=5, run_time=0.1, rate_limit=10):
+    '''
+    threshold_scan(start=255, stop=0, step=5, run_time=0.1,
+    rate_limit=10)
+
+    Lower the global threshold of all chips together from ``start`` to
+    ``stop`` and find, for each channel, the highest global threshold
+    at which it triggers at ``rate_limit`` Hz or more. Each channel is
+    masked as soon as it reaches the limit.
+
+    Returns ``{'thresholds': [scanned values], 'onset': {chip key:
+    [global threshold per channel]}}``.
+
+    '''
+    start, stop, step = int(start), int(stop), abs(int(step))
+    run_time, rate_limit = float(run_time), float(rate_limit)
+    data = _BoardData(board, send_data)
+    saved = data.save_thresholds()
+    onset = np.full(data.nbins, np.nan)
+    thresholds = list(range(start, stop - 1, -step))
+    send_info('Threshold scan of %d chips from %d to %d' %
+            (len(data.chip_keys), start, stop))
+    try:
+        for chip in board.chips.values():
+            chip.config.enable_channels()
+        data.write(Configuration.channel_mask_addresses)
+        for threshold in thresholds:
+            for chip in board.chips.values():
+                chip.config.global_threshold = threshold
+            data.write([Configuration.global_threshold_address])
+            index, _ = data.collect(run_time, 'threshold scan %d' %
+                    threshold)
+            rates = np.bincount(index, minlength=data.nbins) / run_time
+            new = (rates >= rate_limit) & np.isnan(onset)
+            onset[new] = threshold
+            if new.any():
+                for chip_index, channel in zip(*np.nonzero(new.reshape(-1,
+                    NCHANNELS))):
+                    chip = board.chips[data.chip_keys[chip_index]]
+                    chip.config.disable_channels([int(channel)])
+                data.write(Configuration.channel_mask_addresses)
+            if not np.isnan(onset).any():
+                break
+    finally:
+        data.restore_thresholds(saved)
+    send_info('Threshold scan complete')
+    return board, {
+            'thresholds': thresholds,
+            'onset': data.by_chip(onset, 0),
+            }
+
+def _pedestal(board, send_data, send_info, run_time=0.1):
+    '''
+    pedestal(run_time=0.1)
+
+    Measure the pedestal of every channel: with the global threshold at
+    0, enable one channel per chip at a time (at trim 0, the others at
+    31) and read for ``run_time`` seconds. All chips are measured in
+    parallel, so this takes 32 steps regardless of the number of chips.
+
+    Returns ``{'mean': {chip key: [...]}, 'std': {...}, 'count':
+    {...}}`` of the ADC values.
+
+    '''
+    run_time = float(run_time)
+    data = _BoardData(board, send_data)
+    saved = data.save_thresholds()
+    count = np.zeros(data.nbins)
+    total = np.zeros(data.nbins)
+    total_sq = np.zeros(data.nbins)
+    send_info('Pedestal measurement of %d chips' % len(data.chip_keys))
+    try:
+        for channel in range(NCHANNELS):
+            for chip in board.chips.values():
+                chip.config.global_threshold = 0
+                chip.config.pixel_trim_thresholds = [31] * NCHANNELS
+                chip.config.pixel_trim_thresholds[channel] = 0
+                chip.config.disable_channels()
+                chip.config.enable_channels([channel])
+            data.write(_THRESHOLD_REGISTERS)
+            index, adc = data.collect(run_time, 'pedestal channel %d' %
+                    channel)
+            count += np.bincount(index, minlength=data.nbins)
+            total += np.bincount(index, adc, minlength=data.nbins)
+            total_sq += np.bincount(index, adc * adc,
+                    minlength=data.nbins)
+    finally:
+        data.restore_thresholds(saved)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0))
+    send_info('Pedestal measurement complete')
+    return board, {
+            'mean': data.by_chip(mean),
+            'std': data.by_chip(std),
+            'count': data.by_chip(count.astype(int)),
+            }
+
+def _noise(board, send_data, send_info, global_threshold, run_time=1):
+    '''
+    noise(global_threshold, run_time=1)
+
+    Measure the noise trigger rate of every channel with all channels
+    enabled at the given global threshold (keeping the current trims)
+    for ``run_time`` seconds.
+
+    Returns ``{'rate': {chip key: [Hz per channel]}, 'adc_mean': {...},
+    'adc_std': {...}}``.
+
+    '''
+    global_threshold, run_time = int(global_threshold), float(run_time)
+    data = _BoardData(board, send_data)
+    saved = data.save_thresholds()
+    send_info('Noise measurement of %d chips at global threshold %d' %
+            (len(data.chip_keys), global_threshold))
+    try:
+        for chip in board.chips.values():
+            chip.config.global_threshold = global_threshold
+            chip.config.enable_channels()
+        data.write(_THRESHOLD_REGISTERS)
+        index, adc = data.collect(run_time, 'noise %d' % global_threshold)
+    finally:
+        data.restore_thresholds(saved)
+    count = np.bincount(index, minlength=data.nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(index, adc, minlength=data.nbins) / count
+        std = np.sqrt(np.maximum(np.bincount(index, adc * adc,
+            minlength=data.nbins) / count - mean * mean, 0))
+    send_info('Noise measurement complete')
+    return board, {
+            'rate': data.by_chip(count / run_time),
+            'adc_mean': data.by_chip(mean),
+            'adc_std': data.by_chip(std),
+            }
+
+threshold_scan = Routine('threshold_scan', _threshold_scan, ['start',
+    'stop', 'step', 'run_time', 'rate_limit'])
+pedestal = Routine('pedestal', _pedestal, ['run_time'])
+noise = Routine('noise', _noise, ['global_threshold', 'run_time'])
+
+registration = {
+        'threshold_scan': threshold_scan,
+        'pedestal': pedestal,
+        'noise': noise,
+        }
@@ -0,0 +1,250 @@
+'''
+Sidecar index for fast range queries on stored runs.
+
+While :py:class:`~larpixdaq.offline_storage.OfflineStorage` writes a
+LArPix+HDF5 file, it also writes a compact index next to it (the data
+file name plus ``.index``). The packets dataset is divided into chunks
+of consecutive rows, and for each chunk the index stores:
+
+- the first row and number of rows
+- the minimum and maximum receive time (Unix timestamp)
+- the minimum and maximum data packet timestamp
+- the number of data packets from each chip key
+
+The index is a JSON-lines file: the first line is a header and each
+following line describes one chunk, so it can be appended to as the
+run progresses.
+
+A :py:class:`RunIndex` uses the index to read only the rows that can
+match a query::
+
+    from larpixdaq.run_index import RunIndex
+    index = RunIndex('datalog_2019_07_15_12_48_04_PDT_.h5')
+    packets = index.read(chip_key='1-1-3', time_range=(t0, t0 + 300))
+
+Receive times are only known per chunk, so ``time_range`` selects whole
+chunks, whereas ``chip_key`` and ``timestamp_range`` are also applied
+row by row.
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+
+import numpy as np
+import h5py
+
+import larpixdaq.packetformat as pformat
+
+#: The file extension for index files (appended to the data file name)
+INDEX_EXTENSION = '.index'
+#: The index format version
+INDEX_VERSION = 1
+
+class IndexWriter(object):
+    '''
+    Build the index for a LArPix+HDF5 file as packets are written.
+
+    Data messages must be passed to :py:meth:`record` in the same order
+    as their packets are written to the file.
+
+    :param filename: the name of the data file being indexed
+    :param chunk_rows: the number of rows per index chunk (optional,
+        default: ``100000``)
+    '''
+    def __init__(self, filename, chunk_rows=100000):
+        self.filename = filename + INDEX_EXTENSION
+        self.chunk_rows = chunk_rows
+        self._row = 0
+        self._chunk = None
+        with open(self.filename, 'w') as f:
+            header = {
+                    'version': INDEX_VERSION,
+                    'file': os.path.basename(filename),
+                    'chunk_rows': chunk_rows,
+                    }
+            f.write(json.dumps(header) + '\n')
+
+    def record(self, data, receive_time):
+        '''
+        Add the packets in a data message to the index.
+
+        :param data: the data message payload (see
+            :py:func:`larpixdaq.packetformat.toBytes`) whose packets were
+            written to the data file
+        :param receive_time: the Unix timestamp when the packets were
+            received
+        '''
+        records = pformat.decode(pformat.toArray(data))
+        start = 0
+        while start < len(records):
+            if self._chunk is None:
+                self._chunk = {
+                        'row_start': self._row,
+                        'nrows': 0,
+                        'time_min': receive_time,
+                        'time_max': receive_time,
+                        'timestamp_min': None,
+                        'timestamp_max': None,
+                        'chip_counts': {},
+                        }
+            chunk = self._chunk
+            end = min(len(records), start + self.chunk_rows -
+                    chunk['nrows'])
+            self._add(chunk, records[start:end], receive_time)
+            self._row += end - start
+            start = end
+            if chunk['nrows'] == self.chunk_rows:
+                self.flush()
+
+    @staticmethod
+    def _add(chunk, records, receive_time):
+        '''Add decoded packet records to a chunk.'''
+        chunk['nrows'] += len(records)
+        chunk['time_max'] = receive_time
+        data = records[records['packet_type'] == pformat.DATA_PACKET_TYPE]
+        if len(data) == 0:
+            return
+        timestamp_min = int(data['timestamp'].min())
+        timestamp_max = int(data['timestamp'].max())
+        if (chunk['timestamp_min'] is None
+                or timestamp_min < chunk['timestamp_min']):
+            chunk['timestamp_min'] = timestamp_min
+        if (chunk['timestamp_max'] is None
+                or timestamp_max > chunk['timestamp_max']):
+            chunk['timestamp_max'] = timestamp_max
+        codes, counts = np.unique(pformat.chip_code(data['io_group'],
+            data['io_channel'], data['chipid']), return_counts=True)
+        chip_counts = chunk['chip_counts']
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            chip_key = '%d-%d-%d' % (code >> 16, (code >> 8) & 0xFF,
+                    code & 0xFF)
+            chip_counts[chip_key] = chip_counts.get(chip_key, 0) + count
+
+    def flush(self):
+        '''Write the current (possibly partial) chunk to the index.'''
+        if self._chunk is None:
+            return
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(self._chunk) + '\n')
+        self._chunk = None
+
+    def close(self):
+        '''Write any remaining data to the index.'''
+        self.flush()
+
+class RunIndex(object):
+    '''
+    Query a LArPix+HDF5 file using its sidecar index.
+
+    :var chunks: the list of chunk dicts read from the index
+
+    :param filename: the name of the data file (not the index file)
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename + INDEX_EXTENSION, 'r') as f:
+            lines = f.readlines()
+        self.header = json.loads(lines[0])
+        self.chunks = [json.loads(line) for line in lines[1:]
+                if line.strip()]
+
+    def chip_counts(self):
+        '''Return the total number of data packets for each chip key.'''
+        totals = {}
+        for chunk in self.chunks:
+            for chip_key, count in chunk['chip_counts'].items():
+                totals[chip_key] = totals.get(chip_key, 0) + count
+        return totals
+
+    def row_ranges(self, chip_key=None, time_range=None,
+            timestamp_range=None):
+        '''
+        Return the row ranges of chunks which can match the query.
+
+        Adjacent chunks are merged into a single range.
+
+        :param chip_key: only select chunks containing this chip key
+            (optional)
+        :param time_range: only select chunks received during
+            ``(start, end)``, in Unix time (optional)
+        :param timestamp_range: only select chunks containing data
+            packet timestamps in ``(start, end)`` (optional)
+        :returns: a list of ``(start_row, end_row)`` tuples
+        '''
+        if chip_key is not None:
+            chip_key = str(chip_key)
+        ranges = []
+        for chunk in self.chunks:
+            if (chip_key is not None
+                    and chip_key not in chunk['chip_counts']):
+                continue
+            if time_range is not None and (
+                    chunk['time_max'] < time_range[0]
+                    or chunk['time_min'] > time_range[1]):
+                continue
+            if timestamp_range is not None and (
+                    chunk['timestamp_min'] is None
+                    or chunk['timestamp_max'] < timestamp_range[0]
+                    or chunk['timestamp_min'] > timestamp_range[1]):
+                continue
+            start = chunk['row_start']
+            end = start + chunk['nrows']
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def read(self, chip_key=None, time_range=None, timestamp_range=None):
+        '''
+        Read the packets matching the query.
+
+        The file is memory-mapped if the packets dataset is stored
+        contiguously (e.g. after ``h5repack -l packets:CONTI``);
+        otherwise only the selected row ranges are read through h5py.
+
+        Parameters are the same as for :py:meth:`row_ranges`.
+
+        :returns: a structured array of the matching rows of the
+            ``packets`` dataset
+        '''
+        ranges = self.row_ranges(chip_key, time_range, timestamp_range)
+        with h5py.File(self.filename, 'r') as f:
+            dset = f['packets']
+            offset = dset.id.get_offset()
+            if (offset is not None and dset.chunks is None
+                    and dset.compression is None):
+                source = np.memmap(self.filename, dtype=dset.dtype,
+                        mode='r', offset=offset, shape=dset.shape)
+            else:
+                source = dset
+            selected = [source[start:end] for start, end in ranges]
+            if selected:
+                rows = np.concatenate(selected)
+            else:
+                rows = np.zeros((0,), dtype=dset.dtype)
+        if chip_key is not None:
+            rows = rows[rows['chip_key'] == str(chip_key).encode()]
+        if timestamp_range is not None:
+            rows = rows[(rows['chip_key'] != b'')
+                    & (rows['timestamp'] >= timestamp_range[0])
+                    & (rows['timestamp'] <= timestamp_range[1])]
+        return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query a stored run '
+            'using its sidecar index')
+    parser.add_argument('filename', help='The LArPix+HDF5 data file')
+    parser.add_argument('--chip', default=None,
+            help='Select a chip key, e.g. 1-1-3')
+    parser.add_argument('--time-range', nargs=2, type=float, default=None,
+            help='Select a receive time window (Unix time)')
+    parser.add_argument('--timestamp-range', nargs=2, type=int,
+            default=None, help='Select a data packet timestamp window')
+    args = parser.parse_args()
+    index = RunIndex(args.filename)
+    ranges = index.row_ranges(args.chip, args.time_range,
+            args.timestamp_range)
+    print('Row ranges: %s' % ranges)
+    print('Rows to read: %d' % sum(end - start for start, end in ranges))
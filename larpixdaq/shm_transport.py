@@ -0,0 +1,489 @@
+'''
+Pass data message payloads between components on one host through
+shared memory.
+
+By default every data message payload is copied into and out of a ZMQ
+socket at each hop: producer to aggregator, and aggregator to each
+consumer. When the components run on the same host, the producer can
+instead write each payload once into a shared-memory ring
+(:py:class:`RingWriter`) and send only a small descriptor down the
+pipeline, in the message metadata under the key ``'shm'``. The
+aggregator forwards the descriptor unchanged, and each consumer reads
+the payload in place from the ring (:py:class:`RingReader`), as a
+``memoryview``.
+
+The ring is enabled on the producer only::
+
+    python -m larpixdaq.producer tcp://127.0.0.1:50001 --io-config FakeIO \\
+        --shm-ring larpix
+
+The offline storage and online monitor always accept descriptors and
+attach to the ring named in the first descriptor they receive, so they
+need no configuration.
+
+Reference counting
+------------------
+
+Space in the ring is only reused once every consumer has released the
+messages in it. Each consumer that attaches takes a reader slot in the
+ring header and records in it how far through the ring it has
+released; since messages arrive in order, this single cursor per
+reader counts the references to every message. The producer only
+overwrites data that every active reader has released. Readers whose
+process has died are detected by process ID and their slots are
+freed. Slots are claimed under a lock file, so that concurrent readers
+never share a slot.
+
+If the ring is full (because a consumer is slow), the producer sends
+the payload inline in the ZMQ message, as without the ring, rather than
+overwriting unreleased data. The fallbacks are counted in
+:py:attr:`RingWriter.overflows`.
+
+A reader can still lose payloads which it cannot protect: those written
+before it attached (a reader only takes a slot when it receives its
+first descriptor, and until then the producer may reuse the space), and
+those overwritten while its slot was freed. Lost payloads are counted
+in :py:attr:`RingReader.lost`, logged as warnings by the consumer, and
+reported by the offline storage's and online monitor's ``shm_stats``
+action. A reader whose slot was freed claims a new one.
+
+A payload is only valid during the data message handlers: the consumer
+releases the message as soon as its handlers return, so a handler must
+copy the data (e.g. with ``bytes(data)``) to keep it.
+'''
+import fcntl
+import os
+import struct
+import tempfile
+import time
+import uuid
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+from xylem import protocol
+
+#: The metadata key of the shared-memory descriptor
+DESCRIPTOR_KEY = 'shm'
+#: The default size of the ring data area in bytes
+DEFAULT_SIZE = 2**26
+#: The default maximum number of readers of one ring
+MAX_READERS = 16
+
+_MAGIC = 0x4c41525049585348
+# Header words (int64)
+_TOKEN, _CAPACITY, _HEAD, _NREADERS, _WRITER_PID = 1, 2, 3, 4, 5
+_READERS = 8
+# Reader slot words: owner token (0 if free), process ID, cursor
+_SLOT_WORDS = 4
+_OWNER, _PID, _CURSOR = 0, 1, 2
+# Record header: absolute position, payload length
+_RECORD = struct.Struct('<qq')
+_ALIGN = 8
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def _header_size(max_readers):
+    return _align(8 * (_READERS + _SLOT_WORDS * max_readers))
+
+def _record_size(length):
+    return _RECORD.size + _align(length)
+
+def _new_token():
+    '''Return a random nonzero 63-bit integer.'''
+    return (uuid.uuid4().int >> 65) or 1
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _claim_lock_path(name):
+    '''Return the lock file which serializes reader slot claims.'''
+    return os.path.join(tempfile.gettempdir(),
+            'larpixdaq-shm-%s.lock' % name.strip('/'))
+
+def payload_size(metadata, data):
+    '''
+    Return the size of a data message payload in bytes, whether it is
+    inline or in shared memory, without reading it.
+
+    :param metadata: the data message metadata dict
+    :param data: the data message payload
+    '''
+    descriptor = metadata.get(DESCRIPTOR_KEY)
+    if descriptor is None:
+        return len(data)
+    return descriptor[3]
+
+class RingWriter(object):
+    '''
+    Write data message payloads into a shared-memory ring.
+
+    The ring is created when the writer is constructed, replacing any
+    ring of the same name left behind by a previous process.
+
+    :var overflows: the number of payloads sent inline because the
+        ring was full
+    :var written: the number of payloads written to the ring
+
+    :param name: the name of the shared memory segment
+    :param size: the size of the ring data area in bytes (optional,
+        default: :py:data:`DEFAULT_SIZE`)
+    :param max_readers: the maximum number of readers (optional,
+        default: :py:data:`MAX_READERS`)
+    :param reap_interval: how often to check for dead readers, in
+        seconds (optional, default: ``1``)
+    '''
+    def __init__(self, name, size=DEFAULT_SIZE, max_readers=MAX_READERS,
+            reap_interval=1):
+        self.name = name
+        self.capacity = _align(size)
+        self.max_readers = max_readers
+        self.reap_interval = reap_interval
+        self.overflows = 0
+        self.written = 0
+        self._data_start = _header_size(max_readers)
+        total = self._data_start + self.capacity
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                    size=total)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                    size=total)
+        self._buf = self._shm.buf
+        self._header = np.ndarray((self._data_start // 8,), np.int64,
+                self._buf)
+        self._header[:] = 0
+        self._slots = self._header[_READERS:_READERS + _SLOT_WORDS *
+                max_readers].reshape(max_readers, _SLOT_WORDS)
+        self.token = _new_token()
+        self._header[_TOKEN] = self.token
+        self._header[_CAPACITY] = self.capacity
+        self._header[_NREADERS] = max_readers
+        self._header[_WRITER_PID] = os.getpid()
+        self._header[0] = _MAGIC
+        self._head = 0
+        self._last_reap = time.time()
+
+    def encode(self, data, metadata=None):
+        '''
+        Write a payload into the ring and return the data message to
+        send in its place.
+
+        :param data: the data message payload (bytes)
+        :param metadata: the data message metadata dict (optional)
+        :returns: a tuple ``(data, metadata)``: an empty payload and the
+            metadata with the descriptor added, or the original payload
+            and metadata if the ring is full
+        '''
+        if metadata is None:
+            metadata = {}
+        length = len(data)
+        record = _record_size(length)
+        if record > self.capacity:
+            self.overflows += 1
+            return data, metadata
+        position = self._head
+        offset = position % self.capacity
+        if offset + record > self.capacity:
+            # Records are contiguous, so skip the end of the ring
+            position += self.capacity - offset
+            offset = 0
+        end = position + record
+        if end - self._oldest() > self.capacity:
+            self.overflows += 1
+            return data, metadata
+        start = self._data_start + offset
+        # The record header is written first so that a reader attaching
+        # to a partly overwritten record does not accept it
+        _RECORD.pack_into(self._buf, start, position, length)
+        self._buf[start + _RECORD.size:start + _RECORD.size + length] = data
+        self._head = end
+        self._header[_HEAD] = end
+        self.written += 1
+        metadata[DESCRIPTOR_KEY] = [self.name, self.token, position,
+                length]
+        return b'', metadata
+
+    def readers(self):
+        '''Return the number of active readers.'''
+        return int(np.count_nonzero(self._slots[:, _OWNER]))
+
+    def stats(self):
+        '''Return a dict of the ring usage.'''
+        return {
+                'name': self.name,
+                'capacity': self.capacity,
+                'used': self._head - self._oldest(),
+                'readers': self.readers(),
+                'written': self.written,
+                'overflows': self.overflows,
+                }
+
+    def close(self):
+        '''Remove the shared memory segment. Readers which are attached
+        keep their mapping until they next attach.'''
+        del self._slots, self._header, self._buf
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _oldest(self):
+        '''Return the oldest position not yet released by every active
+        reader.'''
+        now = time.time()
+        if now - self._last_reap > self.reap_interval:
+            self._last_reap = now
+            self._reap()
+        active = self._slots[:, _OWNER] != 0
+        if not active.any():
+            return self._head
+        return min(self._head, int(self._slots[active, _CURSOR].min()))
+
+    def _reap(self):
+        '''Free the slots of readers whose process has died.'''
+        for slot in self._slots:
+            if slot[_OWNER] != 0 and not _pid_alive(int(slot[_PID])):
+                slot[_OWNER] = 0
+
+class _Attachment(object):
+    '''A reader's attachment to one ring.'''
+    def __init__(self, name, token, position):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name, track=False)
+            untrack = False
+        except TypeError:
+            # Python < 3.13 always tracks the segment, and the resource
+            # tracker would remove it when this process exits
+            self.shm = shared_memory.SharedMemory(name)
+            untrack = True
+        self.buf = self.shm.buf
+        self.header = np.ndarray((_READERS,), np.int64, self.buf)
+        if untrack and self.header[_WRITER_PID] != os.getpid():
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        if self.header[0] != _MAGIC or self.header[_TOKEN] != token:
+            self._close_views()
+            raise ValueError('Shared memory segment %s is not the '
+                    'expected ring' % name)
+        self.token = token
+        self.capacity = int(self.header[_CAPACITY])
+        max_readers = int(self.header[_NREADERS])
+        self.data_start = _header_size(max_readers)
+        header = np.ndarray((self.data_start // 8,), np.int64, self.buf)
+        self.slots = header[_READERS:_READERS + _SLOT_WORDS *
+                max_readers].reshape(max_readers, _SLOT_WORDS)
+        self.slot = None
+        self.owner = None
+        if not self.claim(position):
+            self._close_views()
+            raise ValueError('No free reader slot in ring %s' % name)
+
+    def claim(self, position):
+        '''
+        Take a free reader slot, with its cursor at ``position``.
+
+        :returns: ``True`` if a slot was free
+        '''
+        owner = _new_token()
+        with open(_claim_lock_path(self.name), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for index in range(len(self.slots)):
+                slot = self.slots[index]
+                if slot[_OWNER] != 0:
+                    continue
+                # The owner is written last, so the writer never sees an
+                # active slot with another reader's cursor or process ID
+                slot[_CURSOR] = position
+                slot[_PID] = os.getpid()
+                slot[_OWNER] = owner
+                self.slot = slot
+                self.owner = owner
+                return True
+        return False
+
+    def reaped(self):
+        '''Return whether the writer has freed this reader's slot.'''
+        return self.slot[_OWNER] != self.owner
+
+    def view(self, position, length):
+        '''Return a memoryview of a payload, or ``None`` if it has been
+        overwritten.'''
+        if position < self.slot[_CURSOR]:
+            return None
+        start = self.data_start + position % self.capacity
+        if _RECORD.unpack_from(self.buf, start) != (position, length):
+            return None
+        start += _RECORD.size
+        return self.buf[start:start + length]
+
+    def release(self, position, length):
+        if self.reaped():
+            # The writer has freed this slot, so the data is no longer
+            # protected
+            return
+        self.slot[_CURSOR] = position + _record_size(length)
+
+    def close(self):
+        if self.slot is not None and self.slot[_OWNER] == self.owner:
+            self.slot[_OWNER] = 0
+        self._close_views()
+
+    def _close_views(self):
+        self.slot = self.slots = self.header = None
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A payload view is still in use; the segment is unmapped
+            # when it is garbage collected
+            pass
+
+class RingReader(object):
+    '''
+    Read data message payloads from shared-memory rings.
+
+    A reader attaches to each ring the first time it receives a
+    descriptor naming it, and reattaches if the ring is recreated (e.g.
+    when the producer restarts).
+
+    :var lost: the number of payloads which could not be read, because
+        the ring could not be attached or the payload had been
+        overwritten
+    '''
+    def __init__(self):
+        self.lost = 0
+        self._rings = {}
+
+    def resolve(self, metadata, data):
+        '''
+        Return the payload of a data message.
+
+        :param metadata: the data message metadata dict
+        :param data: the data message payload as received
+        :returns: ``data`` if the message has no descriptor, a
+            ``memoryview`` of the payload in shared memory, or ``None``
+            if the payload is lost
+        '''
+        descriptor = metadata.get(DESCRIPTOR_KEY)
+        if descriptor is None:
+            return data
+        name, token, position, length = descriptor
+        ring = self._rings.get(name)
+        if ring is None or ring.token != token:
+            if ring is not None:
+                ring.close()
+                del self._rings[name]
+            try:
+                ring = _Attachment(name, token, position)
+            except (OSError, ValueError):
+                self.lost += 1
+                return None
+            self._rings[name] = ring
+        elif ring.reaped() and not ring.claim(position):
+            self.lost += 1
+            return None
+        payload = ring.view(position, length)
+        if payload is None:
+            self.lost += 1
+        return payload
+
+    def release(self, metadata):
+        '''Release the payload of a data message returned by
+        :py:meth:`resolve`, allowing the ring to reuse its space.'''
+        descriptor = metadata.get(DESCRIPTOR_KEY)
+        if descriptor is None:
+            return
+        name, token, position, length = descriptor
+        ring = self._rings.get(name)
+        if ring is not None and ring.token == token:
+            ring.release(position, length)
+
+    def stats(self):
+        '''Return a dict with the number of ``'lost'`` payloads and the
+        names of the attached ``'rings'``.'''
+        return {'lost': self.lost, 'rings': sorted(self._rings)}
+
+    def close(self):
+        '''Detach from all rings, freeing the reader slots.'''
+        for ring in self._rings.values():
+            ring.close()
+        self._rings = {}
+
+def attach_writer(producer, writer):
+    '''
+    Send a xylem Producer's data message payloads through a
+    :py:class:`RingWriter`.
+
+    :param producer: the xylem ``Producer``
+    :param writer: the :py:class:`RingWriter`
+    '''
+    produce = producer.produce
+    def produce_shm(data, metadata=None):
+        data, metadata = writer.encode(data, metadata)
+        produce(data, metadata)
+    producer.produce = produce_shm
+
+def attach_reader(consumer, reader=None, warn_interval=1):
+    '''
+    Resolve shared-memory descriptors in the data messages received by
+    a xylem Consumer, so that its data message handlers receive the
+    payload. Each message is released once its handlers return.
+
+    Messages whose payload is lost are dropped before the handlers, and
+    a WARNING is logged (at most once per ``warn_interval``) when the
+    number of lost payloads increases.
+
+    :param consumer: the xylem ``Consumer``
+    :param reader: the :py:class:`RingReader` (optional, default: a
+        new one)
+    :param warn_interval: the minimum time between warnings, in seconds
+        (optional, default: ``1``)
+    :returns: the :py:class:`RingReader`
+    '''
+    if reader is None:
+        reader = RingReader()
+    reported = {'lost': reader.lost, 'time': 0}
+    def warn_lost():
+        now = time.time()
+        if now - reported['time'] < warn_interval:
+            return
+        consumer.log('WARNING', 'Lost %d data message payloads from '
+                'shared memory (%d in total)' % (reader.lost -
+                    reported['lost'], reader.lost))
+        reported['lost'] = reader.lost
+        reported['time'] = now
+    def handle_in_socket():
+        message_list = consumer.in_socket.recv_multipart()
+        if message_list[0] == b'DATA':
+            message = protocol.data_parse(message_list)
+            metadata = message['header']
+            data = reader.resolve(metadata, message['data'])
+            if data is None:
+                warn_lost()
+                return None
+            try:
+                for handler in consumer._event_handlers['data_message']:
+                    handler.handle(consumer.name, metadata, data)
+            finally:
+                reader.release(metadata)
+            return 'DATA', metadata, data
+        elif message_list[0] == b'INFO':
+            message = protocol.info_parse(message_list)
+            header = message['header']
+            info_message = message['message']
+            for handler in consumer._event_handlers['info_message']:
+                handler.handle(consumer.name, header, info_message)
+            return 'INFO', header, info_message
+    consumer.handlers[consumer.in_socket] = handle_in_socket
+    return reader
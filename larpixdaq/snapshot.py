@@ -0,0 +1,300 @@
+'''
+Compact binary snapshots of the online monitor state.
+
+A snapshot is a set of named NumPy arrays plus a few JSON-encodable
+fields. It is much cheaper to serialize and send than the equivalent
+JSON, especially for per-pixel arrays of large detectors.
+
+Snapshot layout
+---------------
+
+- the magic bytes ``b'LPXS'``
+- the format version (1 byte) and flags (1 byte; bit 0 means the body
+  is zlib-compressed)
+- the length of the header in bytes (4-byte little-endian unsigned
+  int)
+- the header, a UTF-8 JSON object with keys:
+
+  - ``'seq'``: the snapshot sequence number
+  - ``'base'``: the sequence number of the snapshot which the deltas
+    are relative to, or ``null`` for a keyframe
+  - ``'fields'``: the JSON fields
+  - ``'arrays'``: a list of ``{'name', 'dtype', 'shape', 'delta'}``
+    dicts describing the arrays in the body, in order
+
+- the body, the concatenated raw bytes of the arrays (in C order)
+
+Arrays with ``'delta': true`` are stored relative to the array with the
+same name in the base snapshot: integer arrays as the (wrapping)
+difference and other arrays as the XOR of the raw bytes. Unchanged
+values therefore become zero bytes, which compress very well.
+
+Use :py:class:`SnapshotEncoder` to produce snapshots, delta-encoding
+against the last snapshot the receiver acknowledged, and
+:py:class:`SnapshotDecoder` on the receiving side, e.g. in the webapp
+server::
+
+    decoder = SnapshotDecoder()
+
+    @app.route('/api/snapshot', methods=['POST'])
+    def snapshot():
+        fields, arrays = decoder.decode(request.get_data())
+        update = monitor_update(fields, arrays)
+        ...
+'''
+import json
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import larpixdaq.packetformat as pformat
+
+#: The magic bytes at the start of every snapshot
+MAGIC = b'LPXS'
+#: The snapshot format version
+VERSION = 1
+#: The HTTP content type of snapshots
+CONTENT_TYPE = 'application/x-larpix-snapshot'
+#: The flag for a zlib-compressed body
+FLAG_ZLIB = 1
+
+_PREFIX = struct.Struct('<4sBBI')
+
+def _delta(array, base, inverse=False):
+    '''Return the delta of ``array`` against ``base`` (or undo it if
+    ``inverse``), as an array of the same dtype.'''
+    if array.dtype.kind in 'iu':
+        unsigned = np.dtype('u%d' % array.dtype.itemsize)
+        a = array.view(unsigned)
+        b = base.view(unsigned)
+        result = a + b if inverse else a - b
+        return result.view(array.dtype)
+    raw = np.dtype('u1')
+    result = np.bitwise_xor(array.view(raw), base.view(raw))
+    return result.view(array.dtype).reshape(array.shape)
+
+def encode_snapshot(seq, fields, arrays, base=None, base_seq=None,
+        compress=True):
+    '''
+    Encode a snapshot.
+
+    :param seq: the snapshot sequence number
+    :param fields: a dict of JSON-encodable fields
+    :param arrays: a dict of NumPy arrays
+    :param base: the arrays of the snapshot to delta-encode against
+        (optional, default: send a keyframe)
+    :param base_seq: the sequence number of ``base``
+    :param compress: if ``True``, compress the body with zlib (optional,
+        default: ``True``)
+    :returns: the encoded snapshot (bytes)
+    '''
+    descriptions = []
+    chunks = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        base_array = None if base is None else base.get(name)
+        delta = (base_array is not None
+                and base_array.dtype == array.dtype
+                and base_array.shape == array.shape)
+        if delta:
+            array = _delta(array, base_array)
+        descriptions.append({
+            'name': name,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'delta': delta,
+            })
+        chunks.append(array.tobytes())
+    header = json.dumps({
+        'seq': seq,
+        'base': base_seq if base is not None else None,
+        'fields': fields,
+        'arrays': descriptions,
+        }).encode('utf-8')
+    body = b''.join(chunks)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_ZLIB
+    return _PREFIX.pack(MAGIC, VERSION, flags, len(header)) + header + body
+
+def _read_header(data):
+    '''Return the header, flags and body offset of a snapshot.'''
+    if len(data) < _PREFIX.size:
+        raise ValueError('Snapshot is too short')
+    magic, version, flags, header_length = _PREFIX.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a snapshot')
+    if version != VERSION:
+        raise ValueError('Unsupported snapshot version: %d' % version)
+    header_end = _PREFIX.size + header_length
+    header = json.loads(data[_PREFIX.size:header_end].decode('utf-8'))
+    return header, flags, header_end
+
+def snapshot_header(data):
+    '''
+    Return the decoded JSON header of a snapshot without decoding its
+    arrays.
+
+    :param data: the encoded snapshot (bytes)
+    :raises ValueError: if the data is not a valid snapshot
+    '''
+    return _read_header(data)[0]
+
+def decode_snapshot(data, base=None):
+    '''
+    Decode a snapshot.
+
+    :param data: the encoded snapshot (bytes)
+    :param base: the arrays of the base snapshot, required if the
+        snapshot is delta-encoded (optional)
+    :returns: a tuple ``(header, arrays)`` where ``header`` is the
+        decoded JSON header and ``arrays`` is a dict of NumPy arrays
+    :raises ValueError: if the data is not a valid snapshot or the base
+        is missing
+    '''
+    header, flags, header_end = _read_header(data)
+    body = data[header_end:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    arrays = {}
+    offset = 0
+    for description in header['arrays']:
+        dtype = np.dtype(description['dtype'])
+        shape = tuple(description['shape'])
+        size = dtype.itemsize * int(np.prod(shape))
+        array = np.frombuffer(body, dtype=dtype, count=size //
+                dtype.itemsize, offset=offset).reshape(shape)
+        offset += size
+        if description['delta']:
+            if base is None or description['name'] not in base:
+                raise ValueError('Missing base snapshot %s for array %s'
+                        % (header['base'], description['name']))
+            array = _delta(array, base[description['name']], inverse=True)
+        arrays[description['name']] = array
+    return header, arrays
+
+class SnapshotEncoder(object):
+    '''
+    Encode a stream of snapshots, delta-encoding each one against the
+    most recent snapshot which the receiver has acknowledged.
+
+    A keyframe is sent if no snapshot has been acknowledged yet, and
+    every ``keyframe_interval`` snapshots, so that a receiver which has
+    lost its state (e.g. after a restart) recovers.
+
+    :py:meth:`acknowledge` may be called from another thread (e.g. the
+    publisher's) than :py:meth:`encode`.
+
+    :param keyframe_interval: the maximum number of snapshots between
+        keyframes (optional, default: ``60``)
+    :param compress: if ``True``, compress snapshots with zlib
+        (optional, default: ``True``)
+    :param history: the number of unacknowledged snapshots to remember
+        (optional, default: ``8``)
+    '''
+    def __init__(self, keyframe_interval=60, compress=True, history=8):
+        self.keyframe_interval = keyframe_interval
+        self.compress = compress
+        self.history = history
+        self.seq = 0
+        self._sent = {}
+        # (sequence number, arrays) of the acknowledged base snapshot
+        self._base = (None, None)
+        self._keyframe_seq = 0
+        self._lock = threading.Lock()
+
+    def encode(self, fields, arrays):
+        '''
+        Encode the next snapshot.
+
+        :param fields: a dict of JSON-encodable fields
+        :param arrays: a dict of NumPy arrays, which must not be modified
+            afterwards
+        :returns: a tuple ``(seq, data)`` of the sequence number to
+            acknowledge and the encoded snapshot
+        '''
+        with self._lock:
+            self.seq += 1
+            seq = self.seq
+            base_seq, base = self._base
+            if seq - self._keyframe_seq >= self.keyframe_interval:
+                base_seq, base = None, None
+            if base is None:
+                self._keyframe_seq = seq
+            self._sent[seq] = arrays
+            for old_seq in [s for s in self._sent if s <= seq -
+                    self.history]:
+                del self._sent[old_seq]
+        data = encode_snapshot(seq, fields, arrays, base, base_seq,
+                self.compress)
+        return seq, data
+
+    def acknowledge(self, seq):
+        '''
+        Record that the receiver has decoded the given snapshot, so it
+        can be used as a base.
+
+        :param seq: the sequence number returned by :py:meth:`encode`
+        '''
+        with self._lock:
+            arrays = self._sent.get(seq)
+            base_seq = self._base[0]
+            if arrays is not None and (base_seq is None or seq > base_seq):
+                self._base = (seq, arrays)
+
+    def reset(self):
+        '''Send a keyframe next, e.g. after the receiver restarts.'''
+        with self._lock:
+            self._sent.clear()
+            self._base = (None, None)
+
+class SnapshotDecoder(object):
+    '''
+    Decode a stream of snapshots produced by a
+    :py:class:`SnapshotEncoder`.
+
+    :param history: the number of decoded snapshots to keep as possible
+        bases (optional, default: ``8``)
+    '''
+    def __init__(self, history=8):
+        self.history = history
+        self._decoded = {}
+
+    def decode(self, data):
+        '''
+        Decode a snapshot.
+
+        :param data: the encoded snapshot (bytes)
+        :returns: a tuple ``(fields, arrays)``
+        :raises ValueError: if the snapshot is invalid or its base is no
+            longer available (the sender should not acknowledge it, so
+            that it falls back to a keyframe)
+        '''
+        base_seq = snapshot_header(data)['base']
+        header, arrays = decode_snapshot(data, self._decoded.get(base_seq))
+        seq = header['seq']
+        self._decoded[seq] = arrays
+        for old_seq in sorted(self._decoded)[:-self.history]:
+            del self._decoded[old_seq]
+        return header['fields'], arrays
+
+def monitor_update(fields, arrays):
+    '''
+    Convert a decoded online monitor snapshot to the equivalent JSON
+    update dict, with lists instead of arrays and the raw packet records
+    in ``'packets'`` converted to packet dicts.
+
+    :param fields: the decoded snapshot fields
+    :param arrays: the decoded snapshot arrays
+    :returns: a dict
+    '''
+    update = dict(fields)
+    for name, array in arrays.items():
+        if name == 'packets':
+            update[name] = pformat.toDict(pformat.fromArray(array))
+        else:
+            update[name] = array.tolist()
+    return update
@@ -0,0 +1,242 @@
+'''
+Heartbeat and state-change telemetry for the DAQ components.
+
+The Core receives a heartbeat (``PING``) from every component every
+``heartbeat_time_ms``. In xylem, heartbeats are sent by the component's
+backend thread, independently of its main loop, so late or missed
+heartbeats show that the whole process is starved (e.g. of the GIL by
+CPU-bound threads, or of CPU time by the host) or hung, not that the
+main loop is falling behind.
+
+The main loop is measured by the state-change latency instead: a
+component calls :py:func:`acknowledge_state` from its main loop once it
+has finished handling a new DAQ state, so a main loop which is busy
+handling a backlog of messages acknowledges late.
+:py:class:`CoreTelemetry` records, for each component:
+
+- the interval between heartbeats, and the number of missed heartbeats
+  (intervals of 1.5 or more heartbeat periods)
+- the latency between the Core broadcasting a new DAQ state and the
+  component acknowledging it
+
+Each is kept as a rolling histogram of the most recent samples. The
+Core serves the summary through the ``TELEMETRY`` controller message,
+available as :py:meth:`larpixdaq.operator.Operator.telemetry`.
+'''
+import time
+from collections import deque
+
+import numpy as np
+
+#: The header of the state acknowledgement message sent by components
+STATE_ACK = b'STATE ACK'
+#: The default histogram bin edges for heartbeat intervals, in ms
+INTERVAL_BINS = [0, 100, 200, 250, 275, 300, 325, 350, 400, 500, 750,
+        1000, 1500, 2000]
+#: The default histogram bin edges for state-change latency, in ms
+LATENCY_BINS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def acknowledge_state(component):
+    '''
+    Tell the Core that a component has finished handling a state
+    change.
+
+    Call this from the component's main loop after it has acted on a
+    new ``component.state``.
+
+    :param component: the xylem component (e.g. a ``Producer`` or
+        ``Consumer``)
+    '''
+    component.core.send_multipart([STATE_ACK,
+        component.state.encode('utf-8')])
+
+class RollingHistogram(object):
+    '''
+    A histogram of the most recent samples of a quantity.
+
+    :param bins: the bin edges. Samples above the last edge are counted
+        in the last bin.
+    :param size: the number of samples to keep (optional, default:
+        ``1000``)
+    '''
+    def __init__(self, bins, size=1000):
+        self.bins = np.asarray(bins, dtype=float)
+        self._samples = deque(maxlen=size)
+
+    def add(self, value):
+        '''Add a sample, discarding the oldest if the histogram is
+        full.'''
+        self._samples.append(value)
+
+    def summary(self):
+        '''
+        Return the summary of the samples.
+
+        :returns: a dict with keys ``'count'``, ``'mean'``, ``'std'``,
+            ``'p50'``, ``'p99'``, ``'max'`` (``None`` if there are no
+            samples), ``'bins'`` (the bin edges) and ``'counts'``
+        '''
+        samples = np.fromiter(self._samples, dtype=float,
+                count=len(self._samples))
+        clipped = np.minimum(samples, self.bins[-1])
+        counts, _ = np.histogram(clipped, self.bins)
+        result = {
+                'count': len(samples),
+                'bins': self.bins.tolist(),
+                'counts': counts.tolist(),
+                }
+        if len(samples) > 0:
+            p50, p99 = np.percentile(samples, [50, 99])
+            result.update(mean=float(samples.mean()),
+                    std=float(samples.std()), p50=float(p50),
+                    p99=float(p99), max=float(samples.max()))
+        else:
+            result.update(mean=None, std=None, p50=None, p99=None,
+                    max=None)
+        return result
+
+class ComponentTelemetry(object):
+    '''
+    The telemetry of one component.
+
+    :var heartbeat_ms: the component's nominal heartbeat period
+    :var intervals: the :py:class:`RollingHistogram` of heartbeat
+        intervals in ms
+    :var state_latency: the :py:class:`RollingHistogram` of
+        state-change acknowledgement latencies in ms
+    :var missed: the number of missed heartbeats since the component
+        connected
+
+    :param heartbeat_ms: the nominal heartbeat period in ms
+    :param size: the number of samples in each histogram
+    '''
+    def __init__(self, heartbeat_ms, size):
+        self.heartbeat_ms = heartbeat_ms
+        self.intervals = RollingHistogram(INTERVAL_BINS, size)
+        self.state_latency = RollingHistogram(LATENCY_BINS, size)
+        self.missed = 0
+        self.last_heartbeat = None
+
+    def heartbeat(self, now):
+        '''Record a heartbeat received at ``now``.'''
+        if self.last_heartbeat is not None:
+            interval_ms = (now - self.last_heartbeat) * 1000
+            self.intervals.add(interval_ms)
+            periods = int(interval_ms / self.heartbeat_ms + 0.5)
+            if periods > 1:
+                self.missed += periods - 1
+        self.last_heartbeat = now
+
+    def summary(self, now):
+        '''Return the summary dict of this component's telemetry. The
+        heartbeat jitter is the ``'std'`` of the heartbeat intervals.'''
+        since_heartbeat = None
+        if self.last_heartbeat is not None:
+            since_heartbeat = (now - self.last_heartbeat) * 1000
+        return {
+                'heartbeat_ms': self.heartbeat_ms,
+                'heartbeat_intervals': self.intervals.summary(),
+                'missed_heartbeats': self.missed,
+                'since_last_heartbeat': since_heartbeat,
+                'state_latency': self.state_latency.summary(),
+                }
+
+class CoreTelemetry(object):
+    '''
+    Record heartbeat and state-change telemetry in a xylem Core.
+
+    The Core's message handler is wrapped so that heartbeats and state
+    acknowledgements are timed as they arrive, and a ``TELEMETRY``
+    controller handler is added. Its response has the format::
+
+        {
+            'state': <the latest state broadcast>,
+            'state_sent': <Unix time of the broadcast>,
+            'pending_acks': [<components which haven't acknowledged it>],
+            'components': {
+                <name>: <ComponentTelemetry.summary()>,
+                ...
+            }
+        }
+
+    :var components: a dict of component name to
+        :py:class:`ComponentTelemetry`
+
+    :param core: the ``xylem.Core``
+    :param size: the number of samples in each rolling histogram
+        (optional, default: ``1000``)
+    '''
+    def __init__(self, core, size=1000):
+        self.core = core
+        self.size = size
+        self.components = {}
+        self._state = None
+        self._state_sent = None
+        self._pending_acks = set()
+        self._handle = core.handle
+        core.handle = self.handle
+        core.controller_handlers['TELEMETRY'] = self.telemetry_handler
+
+    def handle(self, message):
+        '''Record the telemetry of an incoming message and pass it on to
+        the Core.'''
+        now = time.time()
+        client_id = message[0]
+        header = message[1]
+        if header == b'PING':
+            client = self.core.get_client(client_id)
+            if client is not None:
+                self._component(client).heartbeat(now)
+        elif header == STATE_ACK:
+            client = self.core.get_client(client_id)
+            if client is not None:
+                self._acknowledge(client, message[2].decode('utf-8'), now)
+            return
+        old_state = self.core.state
+        self._handle(message)
+        if header == b'NEW':
+            client = self.core.get_client(client_id)
+            if client is not None:
+                self.components[client.name] = ComponentTelemetry(
+                        client.heartbeat_ms, self.size)
+        elif self.core.state != old_state:
+            self._state = self.core.state
+            self._state_sent = now
+            self._pending_acks = set(c.name for c in self.core.clients)
+        for name in list(self.components):
+            if self.core.get_client_id(name) is None:
+                del self.components[name]
+                self._pending_acks.discard(name)
+
+    def telemetry_handler(self, message):
+        '''Respond to a ``TELEMETRY`` controller message.'''
+        now = time.time()
+        return {
+                'header': 'TELEMETRY',
+                'message': {
+                    'result': {
+                        'state': self._state,
+                        'state_sent': self._state_sent,
+                        'pending_acks': sorted(self._pending_acks),
+                        'components': dict((name, telemetry.summary(now))
+                            for name, telemetry in
+                            self.components.items()),
+                    }
+                }
+        }
+
+    def _component(self, client):
+        '''Return the telemetry for a client, creating it if needed.'''
+        telemetry = self.components.get(client.name)
+        if telemetry is None:
+            telemetry = ComponentTelemetry(client.heartbeat_ms, self.size)
+            self.components[client.name] = telemetry
+        return telemetry
+
+    def _acknowledge(self, client, state, now):
+        '''Record a component's acknowledgement of a state change.'''
+        if state != self._state or client.name not in self._pending_acks:
+            return
+        self._pending_acks.discard(client.name)
+        latency_ms = (now - self._state_sent) * 1000
+        self._component(client).state_latency.add(latency_ms)